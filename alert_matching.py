@@ -0,0 +1,290 @@
+import logging
+import math
+import multiprocessing
+import zlib
+
+from fuzzywuzzy import fuzz
+from fuzzywuzzy import utils as fuzz_utils
+
+"""
+Decides which alerts match a deal. An alert matches when its search terms' average fuzz.token_set_ratio against the
+deal's description is over DESCRIPTION_SCORE_THRESHOLD, and its best one against the deal's name is over
+NAME_SCORE_THRESHOLD.
+
+token_set_ratio cleans up and tokenizes both of its strings on every call, and the deal's description is long - so the
+engine here tokenizes each deal once (see PreparedDeal) and each search term once (they're cached across deals), then
+does the rest of token_set_ratio's work on the token sets. The scores come out exactly the same, since the final
+string comparisons are still fuzz.ratio's. Lots of alerts share popular search terms, so each distinct term (by its
+tokens - "Down Jacket" and "jacket down" score the same) is scored against a deal at most once, in a ScoreTable.
+
+Most alerts can't possibly match a given deal, and AlertIndex finds the ones that might without scoring anything (see
+AlertIndex.candidate_ids), so only those get scored. When that still leaves a lot of alerts, they can be scored
+across several worker processes (see filter_relevant's processes argument).
+"""
+
+DESCRIPTION_SCORE_THRESHOLD = 90.0
+NAME_SCORE_THRESHOLD = 90.0
+
+# bump this whenever a change here can change which alerts match a deal
+MATCHING_RULES_REVISION = 1
+# identifies the rules (and thresholds) matches were decided by, so that saved matches aren't reused across a change
+SCORING_VERSION = zlib.crc32("%d:%r:%r" % (MATCHING_RULES_REVISION, DESCRIPTION_SCORE_THRESHOLD,
+                                           NAME_SCORE_THRESHOLD)) & 0x7fffffff
+
+# fewer alerts than this are scored in-process even when asked for worker processes, since starting them costs more
+PARALLEL_SCORING_MIN_ALERTS = 2000
+# each worker gets about this many chunks of the alerts, so that one slow chunk doesn't hold up the rest for long
+CHUNKS_PER_WORKER = 4
+
+
+def tokenize(text):
+    """ The token set fuzz.token_set_ratio would pull out of text, or None if it wouldn't score it at all. """
+    if text is None:
+        return None
+    processed = fuzz_utils.full_process(text, force_ascii=True)
+    if not fuzz_utils.validate_string(processed):
+        return None
+    return frozenset(processed.split())
+
+
+def joined_length(tokens):
+    """ The length of the string token_set_ratio would make out of these tokens. """
+    return sum(len(t) for t in tokens) + len(tokens) - 1
+
+
+class PreparedText(object):
+    """ One of a deal's texts, tokenized (and sorted) once for scoring lots of search terms against. """
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.sorted_tokens = [] if self.tokens is None else sorted(self.tokens)
+        self.joined_length = None if self.tokens is None else joined_length(self.tokens)
+
+
+class PreparedDeal(object):
+    """ A deal's name and description, ready to score search terms against. """
+
+    def __init__(self, current_steal):
+        self.deal_id = current_steal.deal_id
+        self.name = PreparedText(current_steal.product_name)
+        self.description = PreparedText(current_steal.product_description)
+
+
+def token_set_ratio(term_tokens, prepared_text):
+    """ fuzz.token_set_ratio(term, text), given term's tokens and the prepared text. """
+    if term_tokens is None or prepared_text.tokens is None:
+        return 0
+    # the same strings token_set_ratio builds, but from the text's already-sorted tokens
+    sorted_sect = " ".join(t for t in prepared_text.sorted_tokens if t in term_tokens)
+    sorted_term_rest = " ".join(sorted(term_tokens - prepared_text.tokens))
+    sorted_text_rest = " ".join(t for t in prepared_text.sorted_tokens if t not in term_tokens)
+    combined_term = (sorted_sect + " " + sorted_term_rest).strip()
+    combined_text = (sorted_sect + " " + sorted_text_rest).strip()
+    return max(
+        fuzz.ratio(sorted_sect, combined_term),
+        fuzz.ratio(sorted_sect, combined_text),
+        fuzz.ratio(combined_term, combined_text)
+    )
+
+
+class ScoreTable(object):
+    """ Search term scores against one deal's name and description, keyed by the terms' tokens so that each distinct
+    term is only scored once however many alerts have it. """
+
+    def __init__(self, prepared_deal):
+        self.prepared_deal = prepared_deal
+        self.__description_scores = {}
+        self.__name_scores = {}
+
+    def __len__(self):
+        """ How many term scores have been worked out. """
+        return len(self.__description_scores) + len(self.__name_scores)
+
+    @staticmethod
+    def __score(scores, term_tokens, prepared_text):
+        score = scores.get(term_tokens)
+        if score is None:
+            score = scores[term_tokens] = token_set_ratio(term_tokens, prepared_text)
+        return score
+
+    def description_score(self, term_tokens):
+        return self.__score(self.__description_scores, term_tokens, self.prepared_deal.description)
+
+    def name_score(self, term_tokens):
+        return self.__score(self.__name_scores, term_tokens, self.prepared_deal.name)
+
+
+class MatchingEngine(object):
+    """ Scores alerts against deals, caching each search term's tokens (up to max_cached_terms of them). """
+
+    def __init__(self, max_cached_terms=100000):
+        self.max_cached_terms = max_cached_terms
+        self.__term_tokens = {}
+
+    def term_tokens(self, search_term):
+        tokens = self.__term_tokens.get(search_term)
+        if tokens is None and search_term not in self.__term_tokens:
+            if len(self.__term_tokens) >= self.max_cached_terms:
+                self.__term_tokens.clear()
+            tokens = self.__term_tokens[search_term] = tokenize(search_term)
+        return tokens
+
+    def is_relevant(self, alert, prepared_deal, score_table=None):
+        """ True if the alert matches the deal. Pass the same ScoreTable for the deal when checking lots of alerts
+        against it, so that search terms they share are only scored once. """
+        if score_table is None:
+            score_table = ScoreTable(prepared_deal)
+        term_count = len(alert.search_terms)
+        needed = DESCRIPTION_SCORE_THRESHOLD * term_count
+        description_total = 0
+        for i, search_term in enumerate(alert.search_terms):
+            description_total += score_table.description_score(self.term_tokens(search_term))
+            # stop once even perfect scores for the rest couldn't lift the average over the threshold
+            if description_total + 100 * (term_count - i - 1) <= needed:
+                return False
+        if float(description_total) / float(term_count) <= DESCRIPTION_SCORE_THRESHOLD:
+            return False
+        for search_term in alert.search_terms:
+            if score_table.name_score(self.term_tokens(search_term)) > NAME_SCORE_THRESHOLD:
+                return True
+        return False
+
+    def filter_relevant(self, alerts, current_steal, alert_index=None, processes=0, timeout_seconds=600,
+                        min_parallel_alerts=PARALLEL_SCORING_MIN_ALERTS):
+        """ Returns the alerts that match the deal, in the same order. Given an AlertIndex holding (at least) these
+        alerts, only scores the ones it says might match. Given processes > 1, scores them in that many worker
+        processes if there are at least min_parallel_alerts of them - raising multiprocessing.TimeoutError if that
+        takes longer than timeout_seconds. """
+        prepared_deal = PreparedDeal(current_steal)
+        if alert_index is not None:
+            candidate_ids = alert_index.candidate_ids(prepared_deal)
+            alerts = [alert for alert in alerts if alert.alert_id in candidate_ids]
+        if processes > 1 and len(alerts) >= min_parallel_alerts:
+            matching_ids = set(_score_in_parallel(alerts, prepared_deal, processes, timeout_seconds))
+            return [alert for alert in alerts if alert.alert_id in matching_ids]
+        score_table = ScoreTable(prepared_deal)
+        return [alert for alert in alerts if self.is_relevant(alert, prepared_deal, score_table)]
+
+
+class _ScoredAlert(object):
+    """ Just the parts of an alert that scoring needs, to keep what's pickled over to the workers small. """
+
+    def __init__(self, alert):
+        self.alert_id = alert.alert_id
+        self.search_terms = alert.search_terms
+
+
+# each scoring worker process' engine, deal and score table, set up once per worker by _init_scoring_worker
+_worker_engine = None
+_worker_deal = None
+_worker_scores = None
+
+
+def _init_scoring_worker(prepared_deal):
+    global _worker_engine, _worker_deal, _worker_scores
+    _worker_engine = MatchingEngine()
+    _worker_deal = prepared_deal
+    _worker_scores = ScoreTable(prepared_deal)
+
+
+def _matching_ids_in_worker(alerts):
+    return [alert.alert_id for alert in alerts if _worker_engine.is_relevant(alert, _worker_deal, _worker_scores)]
+
+
+def _score_in_parallel(alerts, prepared_deal, processes, timeout_seconds):
+    """ Returns the IDs of the alerts that match, in order, scoring them in chunks across worker processes. """
+    chunk_size = max(int(math.ceil(len(alerts) / float(processes * CHUNKS_PER_WORKER))), 1)
+    scored_alerts = [_ScoredAlert(alert) for alert in alerts]
+    chunks = [scored_alerts[i:i + chunk_size] for i in range(0, len(scored_alerts), chunk_size)]
+    logging.info("Scoring %d alerts in %d chunks across %d processes" % (len(alerts), len(chunks), processes))
+    # the prepared deal goes to each worker once, as it starts
+    pool = multiprocessing.Pool(processes=processes, initializer=_init_scoring_worker, initargs=(prepared_deal,))
+    try:
+        results = pool.map_async(_matching_ids_in_worker, chunks).get(timeout_seconds)
+        pool.close()
+    except multiprocessing.TimeoutError:
+        logging.error("Parallel alert scoring timed out after %d seconds" % timeout_seconds)
+        pool.terminate()
+        raise
+    except Exception:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return [alert_id for chunk_ids in results for alert_id in chunk_ids]
+
+
+def _length_window(text_length, threshold):
+    """ The range of token string lengths that could score over threshold against a text token string this long
+    without sharing a token with it. Then token_set_ratio is just fuzz.ratio of the two token strings, which can't be
+    more than 2 * shorter length / total length - so lengths have to be close. Padded by one for float rounding. """
+    passing_ratio = (math.floor(threshold) + 0.5) / 100.0  # the lowest ratio that rounds to a passing score
+    lowest = int(math.floor(text_length * passing_ratio / (2 - passing_ratio))) - 1
+    highest = int(math.ceil(text_length * (2 - passing_ratio) / passing_ratio)) + 1
+    return max(lowest, 1), highest
+
+
+class AlertIndex(object):
+    """ Inverted index from search term tokens (and token string lengths) to the alerts with those search terms.
+    Keep it up to date with add_alert/remove_alert as alerts change. """
+
+    def __init__(self, engine, alerts=()):
+        self.engine = engine
+        self.__ids_by_token = {}
+        self.__ids_by_length = {}
+        self.__keys_by_id = {}  # alert ID -> (its terms' tokens, their token string lengths), for removal
+        for alert in alerts:
+            self.add_alert(alert)
+
+    def __len__(self):
+        return len(self.__keys_by_id)
+
+    def add_alert(self, alert):
+        """ Indexes an alert - replacing what was indexed for it before, if anything. """
+        self.remove_alert(alert.alert_id)
+        tokens = set()
+        lengths = set()
+        for search_term in alert.search_terms:
+            term_tokens = self.engine.term_tokens(search_term)
+            if term_tokens is not None:
+                tokens.update(term_tokens)
+                lengths.add(joined_length(term_tokens))
+        for token in tokens:
+            self.__ids_by_token.setdefault(token, set()).add(alert.alert_id)
+        for length in lengths:
+            self.__ids_by_length.setdefault(length, set()).add(alert.alert_id)
+        self.__keys_by_id[alert.alert_id] = (tokens, lengths)
+
+    def remove_alert(self, alert_id):
+        keys = self.__keys_by_id.pop(alert_id, None)
+        if keys is None:
+            return
+        tokens, lengths = keys
+        for index, keys_of_kind in ((self.__ids_by_token, tokens), (self.__ids_by_length, lengths)):
+            for key in keys_of_kind:
+                ids = index[key]
+                ids.discard(alert_id)
+                if not ids:
+                    del index[key]
+
+    def __plausible_ids(self, prepared_text, threshold):
+        # alerts with a search term that might score over threshold against the text: it either shares a token
+        # with the text, or its token string is close enough in length to the text's (see _length_window)
+        if prepared_text.tokens is None:
+            return set()
+        ids = set()
+        for token in prepared_text.tokens:
+            ids.update(self.__ids_by_token.get(token, ()))
+        lowest, highest = _length_window(prepared_text.joined_length, threshold)
+        for length in range(lowest, highest + 1):
+            ids.update(self.__ids_by_length.get(length, ()))
+        return ids
+
+    def candidate_ids(self, prepared_deal):
+        """ The IDs of the indexed alerts that might match the deal - a superset of the ones that do. A matching alert
+        has a term scoring over NAME_SCORE_THRESHOLD against the name, and (to average over it) a term scoring over
+        DESCRIPTION_SCORE_THRESHOLD against the description. """
+        ids = self.__plausible_ids(prepared_deal.name, NAME_SCORE_THRESHOLD)
+        if ids:
+            ids &= self.__plausible_ids(prepared_deal.description, DESCRIPTION_SCORE_THRESHOLD)
+        return ids
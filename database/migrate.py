@@ -0,0 +1,322 @@
+import argparse
+import logging
+
+import model
+import mysql
+from model import normalize_search_term
+from utils import properties
+
+"""
+Versioned schema migrations, applied on top of schema.ddl. Each one runs once, in order, and is recorded in the
+schema_migrations table. They also check the current schema before changing it, so a migration that failed
+part-way can simply be re-run.
+
+    python -m database.migrate            # apply any pending migrations
+    python -m database.migrate --explain  # check that the hot DAO queries use an index
+
+These are MySQL-only - the SQLite backend's schema (schema_sqlite.sql) already has every migration applied.
+"""
+
+BACKFILL_BATCH_SIZE = 500
+
+
+def _table_exists(cursor, table):
+    cursor.execute(
+        "select count(*) from information_schema.tables where table_schema = database() and table_name = %s",
+        (table,)
+    )
+    return cursor.fetchall()[0][0] > 0
+
+
+def _column_exists(cursor, table, column):
+    cursor.execute(
+        "select count(*) from information_schema.columns "
+        "where table_schema = database() and table_name = %s and column_name = %s",
+        (table, column)
+    )
+    return cursor.fetchall()[0][0] > 0
+
+
+def _column_definition(cursor, table, column):
+    """ (data type, nullable, default) of the column, lowercased - with MariaDB's "current_timestamp()" as MySQL's
+    "current_timestamp" - or None if there's no such column. """
+    cursor.execute(
+        "select data_type, is_nullable, column_default from information_schema.columns "
+        "where table_schema = database() and table_name = %s and column_name = %s",
+        (table, column)
+    )
+    rs = cursor.fetchall()
+    if len(rs) == 0:
+        return None
+    data_type, is_nullable, column_default = rs[0]
+    if column_default is not None:
+        column_default = column_default.lower().replace("current_timestamp()", "current_timestamp")
+    return data_type.lower(), is_nullable.upper() == "YES", column_default
+
+
+def _has_index_on(cursor, table, columns):
+    """ True if some index on the table starts with exactly these columns, in this order. """
+    cursor.execute(
+        "select index_name, column_name from information_schema.statistics "
+        "where table_schema = database() and table_name = %s "
+        "order by index_name, seq_in_index",
+        (table,)
+    )
+    indexes = {}
+    for index_name, column_name in cursor.fetchall():
+        indexes.setdefault(index_name, []).append(column_name.lower())
+    wanted = [c.lower() for c in columns]
+    for index_columns in indexes.values():
+        if index_columns[:len(wanted)] == wanted:
+            return True
+    return False
+
+
+def _add_index(cursor, table, index_name, columns):
+    if not _has_index_on(cursor, table, columns):
+        cursor.execute("alter table %s add index %s (%s)" % (table, index_name, ", ".join(columns)))
+
+
+#
+# the migrations themselves
+#
+
+def _add_sent_alerts_user_id(cursor):
+    # the alerting job has always written sent_alerts.user_id, but schema.ddl never defined it
+    if not _column_exists(cursor, "sent_alerts", "user_id"):
+        cursor.execute("alter table sent_alerts add user_id int after id")
+    # and nothing ever sets sent_alerts.sent explicitly
+    if _column_definition(cursor, "sent_alerts", "sent") != ("timestamp", True, "current_timestamp"):
+        cursor.execute("alter table sent_alerts modify sent timestamp null default current_timestamp")
+
+
+def _add_hot_query_indexes(cursor):
+    _add_index(cursor, "deals", "deals_created", ["created"])  # load_all_steals_since, iter_steals_since
+    _add_index(cursor, "sent_alerts", "sent_alerts_deal_id", ["deal_id"])  # load_sent_alerts_by_deal_id
+    _add_index(cursor, "sent_alerts", "sent_alerts_user_id", ["user_id"])  # sent alert counts per user
+    _add_index(cursor, "alerts", "alerts_user_id_active", ["user_id", "active"])  # the alerts API
+    _add_index(cursor, "users", "users_username", ["username"])  # auth - normally the unique key already
+
+
+def _add_activation_key_indexes(cursor):
+    _add_index(cursor, "account_activation_keys", "account_activation_keys_pn_key", ["phone_number", "activation_key"])
+    _add_index(cursor, "account_activation_keys", "account_activation_keys_created", ["created"])
+
+
+def _add_alert_search_terms(cursor):
+    # search terms get their own table, so we can look up alerts by (normalized) term
+    # (alerts.search_terms is still written, pipe-joined, for older code)
+    if not _table_exists(cursor, "alert_search_terms"):
+        cursor.execute(
+            "create table alert_search_terms ("
+            "id int primary key auto_increment, "
+            "alert_id int not null, "
+            "position int not null, "
+            "search_term varchar(1024), "
+            "normalized_term varchar(255), "
+            "index alert_search_terms_alert_id (alert_id, position), "
+            "index alert_search_terms_normalized_term (normalized_term), "
+            "foreign key (alert_id) references alerts(id)"
+            ") ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_bin"
+        )
+    # backfill the alerts that don't have any rows in it yet
+    while True:
+        cursor.execute(
+            "select alerts.id, alerts.search_terms "
+            "from alerts "
+            "left join alert_search_terms "
+            "on alert_search_terms.alert_id = alerts.id "
+            "where alert_search_terms.id is null and alerts.search_terms is not null "
+            "limit %s",
+            (BACKFILL_BATCH_SIZE,)
+        )
+        rs = cursor.fetchall()
+        rows = []
+        for alert_id, search_terms in rs:
+            for position, search_term in enumerate(search_terms.split("|")):
+                rows.append((alert_id, position, search_term, normalize_search_term(search_term)))
+        if len(rows) > 0:
+            cursor.executemany(
+                "insert into alert_search_terms (alert_id, position, search_term, normalized_term) "
+                "values (%s, %s, %s, %s)",
+                rows
+            )
+        logging.info("Backfilled search terms for %d alerts" % len(rs))
+        if len(rs) < BACKFILL_BATCH_SIZE:
+            break
+
+
+def _add_sent_alert_counts(cursor):
+    # per-user, per-day sent alert counters, so capping doesn't have to count all of sent_alerts every run
+    if not _table_exists(cursor, "sent_alert_counts"):
+        cursor.execute(
+            "create table sent_alert_counts ("
+            "user_id int not null, "
+            "day date not null, "
+            "sent_count int not null default 0, "
+            "primary key (user_id, day), "
+            "index sent_alert_counts_day (day)"
+            ") ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_bin"
+        )
+    # seed them from the history (only if nothing has been counted yet, so that a re-run doesn't double up)
+    cursor.execute("select count(*) from sent_alert_counts")
+    if cursor.fetchall()[0][0] == 0:
+        cursor.execute(
+            "insert into sent_alert_counts (user_id, day, sent_count) "
+            "select user_id, date(sent), count(*) from sent_alerts "
+            "where user_id is not null and sent is not null "
+            "group by user_id, date(sent)"
+        )
+
+
+def _add_alert_versions(cursor):
+    # alerts get a version, bumped by every update and archive, and the time they last changed (kept up to date by
+    # MySQL itself), so the alerting job can pick up just the alerts that changed
+    if not _column_exists(cursor, "alerts", "version"):
+        cursor.execute("alter table alerts add version int not null default 1")
+    if not _column_exists(cursor, "alerts", "updated"):
+        cursor.execute("alter table alerts add updated timestamp null default current_timestamp "
+                       "on update current_timestamp")
+    _add_index(cursor, "alerts", "alerts_updated", ["updated"])
+
+
+def _add_alert_match_results(cursor):
+    # whether each alert (at a given version, scored by a given version of the matching rules) matched the current
+    # deal, so the alerting job's runs while a deal is up only score the alerts that are new or have been edited since
+    # the last run
+    if not _table_exists(cursor, "alert_match_results"):
+        cursor.execute(
+            "create table alert_match_results ("
+            "deal_id int not null, "
+            "alert_id int not null, "
+            "alert_version int not null, "
+            "scoring_version int not null, "
+            "matched tinyint(1) not null, "
+            "primary key (deal_id, alert_id)"
+            ") ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_bin"
+        )
+
+
+def _add_alert_match_results_scoring_version(cursor):
+    # for alert_match_results tables created by migration 7 before it had the column - scoring version 0 matches no
+    # real SCORING_VERSION, so those results get rescored once
+    if not _column_exists(cursor, "alert_match_results", "scoring_version"):
+        cursor.execute("alter table alert_match_results add scoring_version int not null default 0")
+
+
+MIGRATIONS = [
+    (1, "add sent_alerts.user_id and a default for sent_alerts.sent", _add_sent_alerts_user_id),
+    (2, "add indexes for the hot DAO queries", _add_hot_query_indexes),
+    (3, "add account activation key indexes", _add_activation_key_indexes),
+    (4, "add and backfill alert_search_terms", _add_alert_search_terms),
+    (5, "add and backfill sent_alert_counts", _add_sent_alert_counts),
+    (6, "add alerts.version and alerts.updated", _add_alert_versions),
+    (7, "add alert_match_results", _add_alert_match_results),
+    (8, "add alert_match_results.scoring_version", _add_alert_match_results_scoring_version),
+]
+
+
+def run_migrations(db_conn):
+    """ Applies every migration that hasn't been applied yet, in order. Returns the list of versions applied. """
+    cursor = db_conn.cursor()
+    cursor.execute(
+        "create table if not exists schema_migrations ("
+        "version int primary key, "
+        "description varchar(255), "
+        "applied timestamp default current_timestamp"
+        ") ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_bin"
+    )
+    cursor.execute("select version from schema_migrations")
+    already_applied = set(r[0] for r in cursor.fetchall())
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        if version in already_applied:
+            continue
+        logging.info("Applying migration %d: %s" % (version, description))
+        migration(cursor)
+        cursor.execute("insert into schema_migrations (version, description) values (%s, %s)", (version, description))
+        db_conn.commit()
+        applied.append(version)
+    logging.info("Schema is up to date - applied %d migrations" % len(applied))
+    return applied
+
+
+#
+# query plan checks
+#
+
+# the DAO's hot queries, with sample parameters (selective ones - a range covering the whole of a test database's
+# tiny tables would rightly be scanned)
+HOT_QUERIES = [
+    ("load_user_by_username", model.LOAD_USER_BY_USERNAME_SQL, ("someone",)),
+    ("is_valid_activation_key_pair", model.IS_VALID_ACTIVATION_KEY_PAIR_SQL, ("+10000000000", "abcdef", 120)),
+    ("purge_expired_activation_keys", model.PURGE_EXPIRED_ACTIVATION_KEYS_SQL, (120,)),
+    ("load_active_alerts_for_user", model.LOAD_ACTIVE_ALERTS_FOR_USER_SQL, (1,)),
+    ("load_active_alert_for_user", model.LOAD_ACTIVE_ALERT_FOR_USER_SQL, (1, 1)),
+    ("load_active_alert_ids_by_search_term", model.LOAD_ACTIVE_ALERT_IDS_BY_SEARCH_TERM_SQL, ("patagonia",)),
+    ("load_alerts_changed_since", model.LOAD_ALERTS_CHANGED_SINCE_SQL, ("2100-01-01 00:00:00",)),
+    ("load_current_steal", model.LOAD_CURRENT_STEAL_SQL, ()),
+    ("load_latest_deal_id", model.LOAD_LATEST_DEAL_ID_SQL, ()),
+    ("load_all_steals_since", model.LOAD_STEALS_SINCE_SQL, ("2100-01-01 00:00:00",)),
+    ("iter_steals_since", model.LOAD_STEALS_SINCE_PAGE_SQL, ("2000-01-01 00:00:00", 0, 500)),
+    ("load_sent_alerts_by_deal_id", model.LOAD_SENT_ALERTS_BY_DEAL_ID_SQL, (1,)),
+    ("load_recent_sent_alert_counts_by_user_id", model.LOAD_RECENT_SENT_ALERT_COUNTS_SQL, (0,)),
+    ("load_alert_match_results", model.LOAD_ALERT_MATCH_RESULTS_SQL.format("%s, %s"), (1, 1, 2)),
+    ("load_alert_match_results (whole deal)", model.LOAD_DEAL_ALERT_MATCH_RESULTS_SQL, (1,)),
+    ("has_alert_match_results_before", model.HAS_ALERT_MATCH_RESULTS_BEFORE_SQL, (1,)),
+]
+
+# EXPLAIN "Extra" notes meaning the table never needed scanning at all
+_NO_SCAN_NOTES = ("impossible where", "no matching row", "optimized away", "no tables used")
+
+
+def check_query_plans(db_conn):
+    """ EXPLAINs each hot query. Returns a list of (query name, True if every table access uses an index, the
+    EXPLAIN rows as dicts). An index the optimizer passed over for a full scan doesn't count. """
+    cursor = db_conn.cursor()
+    results = []
+    for name, sql, params in HOT_QUERIES:
+        cursor.execute("explain " + sql, params)
+        columns = [d[0].lower() for d in cursor.description]
+        rows = [dict(zip(columns, r)) for r in cursor.fetchall()]
+        results.append((name, all(_uses_index(row) for row in rows), rows))
+    return results
+
+
+def _uses_index(explain_row):
+    extra = (explain_row.get("extra") or "").lower()
+    if any(note in extra for note in _NO_SCAN_NOTES):
+        return True
+    return explain_row.get("key") is not None and (explain_row.get("type") or "").upper() != "ALL"
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s  -  %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Apply schema migrations, or check the hot queries' plans")
+    parser.add_argument("--explain", action="store_true", help="check query plans instead of migrating")
+    args = parser.parse_args()
+    if properties.DB_BACKEND == "sqlite":
+        logging.info("DB_BACKEND is sqlite - its schema is created up to date, so there's nothing to migrate")
+        return 0
+    conn_pool = mysql.DBConnPool(conn_count=1)
+    db_conn = conn_pool.get_conn()
+    exit_code = 0
+    try:
+        if args.explain:
+            for name, ok, rows in check_query_plans(db_conn):
+                print("%-40s %s  %s" % (name, "ok  " if ok else "SCAN", [(r.get("table"), r.get("key")) for r in rows]))
+                if not ok:
+                    exit_code = 1
+        else:
+            run_migrations(db_conn)
+    except Exception as e:
+        logging.exception(e)
+        exit_code = 1
+    finally:
+        conn_pool.return_conn(db_conn)
+        conn_pool.close_all()
+    return exit_code
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,7 +1,106 @@
 import logging
-from datetime import datetime, timedelta
+from contextlib import contextmanager
 
 import mysql
+import sqlite
+from replicas import ReplicaRoutingPool
+from query_stats import InstrumentedConnPool, QueryStats, instrument_dao_methods, log_slow_queries_to
+from utils import properties
+from utils.cache import TTLCache
+
+# account activation keys texted out at signup are only good for this long
+ACTIVATION_KEY_LIFETIME_MINUTES = 120
+
+# statements shared by the single-row and batched write methods
+_SAVE_ALERT_SQL = "insert into alerts (user_id, alert_name, search_terms) values (%s, %s, %s)"
+_UPDATE_ALERT_SQL = "update alerts " \
+                    "set " \
+                    "alerts.user_id = %s, " \
+                    "alerts.alert_name = %s, " \
+                    "alerts.search_terms = %s, " \
+                    "alerts.version = alerts.version + 1 " \
+                    "where alerts.id = %s"
+_ARCHIVE_ALERT_SQL = "update alerts set alerts.active = 0, alerts.version = alerts.version + 1 where alerts.id = %s"
+_SAVE_SENT_ALERT_SQL = "insert into sent_alerts (user_id, deal_id, alert_id) values (%s, %s, %s)"
+# one atomic upsert per counter, so that concurrent writers can't both try to create the same one - and "today" is
+# the DB's, like the day window the counters are read back with
+_ADD_TO_SENT_ALERT_COUNT_SQL = "insert into sent_alert_counts (user_id, day, sent_count) " \
+                               "values (%s, current_date, %s) " \
+                               "on duplicate key update sent_count = sent_count + values(sent_count)"
+_SAVE_ALERT_MATCH_RESULT_SQL = "replace into alert_match_results " \
+                               "(deal_id, alert_id, alert_version, scoring_version, matched) " \
+                               "values (%s, %s, %s, %s, %s)"
+_SAVE_ALERT_SEARCH_TERM_SQL = "insert into alert_search_terms (alert_id, position, search_term, normalized_term) " \
+                              "values (%s, %s, %s, %s)"
+
+# the DAO's hot queries - shared with migrate.check_query_plans, which EXPLAINs them
+LOAD_USER_BY_USERNAME_SQL = "select users.id, users.phone_number, users.username, users.password " \
+                            "from users where users.username = %s and users.active = 1"
+IS_VALID_ACTIVATION_KEY_PAIR_SQL = "select 1 from account_activation_keys " \
+                                   "where phone_number = %s and activation_key = %s " \
+                                   "and created > now() - interval %s minute " \
+                                   "limit 1"
+PURGE_EXPIRED_ACTIVATION_KEYS_SQL = "delete from account_activation_keys where created <= now() - interval %s minute"
+LOAD_ACTIVE_ALERTS_FOR_USER_SQL = "select alerts.id, alerts.user_id, alerts.alert_name, alerts.search_terms, " \
+                                  "users.phone_number " \
+                                  "from alerts " \
+                                  "join users " \
+                                  "on users.id = alerts.user_id " \
+                                  "where alerts.user_id = %s and alerts.active = 1"
+LOAD_ACTIVE_ALERT_FOR_USER_SQL = "select alerts.id, alerts.user_id, alerts.alert_name, alerts.search_terms, " \
+                                 "users.phone_number " \
+                                 "from alerts " \
+                                 "join users " \
+                                 "on users.id = alerts.user_id " \
+                                 "where alerts.id = %s and alerts.user_id = %s and alerts.active = 1"
+LOAD_ACTIVE_ALERT_IDS_BY_SEARCH_TERM_SQL = "select distinct alert_search_terms.alert_id " \
+                                           "from alert_search_terms " \
+                                           "join alerts " \
+                                           "on alerts.id = alert_search_terms.alert_id " \
+                                           "where alert_search_terms.normalized_term = %s and alerts.active = 1"
+LOAD_ALERTS_CHANGED_SINCE_SQL = "select alerts.id, alerts.user_id, alerts.alert_name, alerts.search_terms, " \
+                                "users.phone_number, alerts.version, alerts.updated, alerts.active " \
+                                "from alerts " \
+                                "join users " \
+                                "on users.id = alerts.user_id " \
+                                "where alerts.updated >= %s"
+LOAD_CURRENT_STEAL_SQL = "select " \
+                         "deals.id, deals.product_name, deals.product_description, deals.brand_name, " \
+                         "deals.sale_price, deals.url, deals.created " \
+                         "from deals " \
+                         "order by deals.id desc limit 1"
+LOAD_LATEST_DEAL_ID_SQL = "select max(deals.id) from deals"
+LOAD_STEALS_SINCE_SQL = "select " \
+                        "deals.id, deals.product_name, deals.product_description, deals.brand_name, " \
+                        "deals.sale_price, deals.url, deals.created " \
+                        "from deals where deals.created > %s and deals.url is not null"
+LOAD_STEALS_SINCE_PAGE_SQL = "select " \
+                             "deals.id, deals.product_name, deals.product_description, deals.brand_name, " \
+                             "deals.sale_price, deals.url, deals.created " \
+                             "from deals where deals.created > %s and deals.url is not null and deals.id > %s " \
+                             "order by deals.id limit %s"
+LOAD_SENT_ALERTS_BY_DEAL_ID_SQL = "select sent_alerts.alert_id from sent_alerts where sent_alerts.deal_id = %s"
+LOAD_RECENT_SENT_ALERT_COUNTS_SQL = "select user_id, sum(sent_count) from sent_alert_counts " \
+                                    "where day > current_date - interval %s day group by user_id"
+# format() in a placeholder per alert ID
+LOAD_ALERT_MATCH_RESULTS_SQL = "select alert_id, alert_version, scoring_version, matched from alert_match_results " \
+                               "where deal_id = %s and alert_id in ({})"
+LOAD_DEAL_ALERT_MATCH_RESULTS_SQL = "select alert_id, alert_version, scoring_version, matched " \
+                                    "from alert_match_results where deal_id = %s"
+HAS_ALERT_MATCH_RESULTS_BEFORE_SQL = "select 1 from alert_match_results where deal_id < %s limit 1"
+
+NORMALIZED_SEARCH_TERM_MAX_LENGTH = 255
+
+# alert match results are looked up by alert ID for up to this many alerts - past that, every result for the deal is
+# read instead (one range read of the primary key) and the ones not asked for are dropped
+ALERT_MATCH_RESULTS_LOAD_BATCH_SIZE = 500
+
+_CURRENT_STEAL_CACHE_KEY = "current_steal"
+
+
+def normalize_search_term(search_term):
+    """ The form search terms are indexed under - lowercased, with runs of whitespace collapsed to one space. """
+    return " ".join(search_term.lower().split())[:NORMALIZED_SEARCH_TERM_MAX_LENGTH]
 
 
 class Alert(object):
@@ -10,7 +109,8 @@ class Alert(object):
     {"search_terms": ["liberty ridge", "waterproof", "leather"], "name": "hello world", "id": 1}
     """
 
-    def __init__(self, user_id, alert_id, alert_name, search_terms, phone_number):
+    def __init__(self, user_id, alert_id, alert_name, search_terms, phone_number, version=None, updated=None,
+                 active=True):
         self.user_id = user_id
         self.alert_id = alert_id
         self.alert_name = alert_name
@@ -18,6 +118,10 @@ class Alert(object):
         if type(self.search_terms) == str:
             self.search_terms = search_terms.split("|")
         self.phone_number = phone_number
+        # bumped on every update or archive, and when that happened - only loaded for the alerting job
+        self.version = version
+        self.updated = updated
+        self.active = active
 
     @staticmethod
     def build_alert_from_json_and_user(json_obj, user):
@@ -84,21 +188,100 @@ class ActivationKeyPair(object):
         self.activation_key = activation_key
 
 
+@instrument_dao_methods
 class Model(object):
-    """ DAO for our MySQL DB. """
+    """ DAO for our DB - MySQL, or SQLite if properties.DB_BACKEND says so. Every public method's statements, rows and
+    connection waits are added up in query_stats (see database.query_stats). """
 
-    def __init__(self, conn_pool_size=1, premade_db_conn_pool=None):
+    def __init__(self, conn_pool_size=1, premade_db_conn_pool=None, user_cache_ttl_seconds=60,
+                 current_steal_cache_ttl_seconds=60, check_current_steal_version=False,
+                 slow_query_threshold_seconds=None, replica_db_conn_pool=None, replica_lag_check=None,
+                 replica_max_staleness_seconds=None):
         if premade_db_conn_pool is not None:
             # this just makes it easy to mock out the back end (behind our model object) for testing
-            self.conn_pool = premade_db_conn_pool
+            conn_pool = premade_db_conn_pool
+        elif properties.DB_BACKEND == "sqlite":
+            conn_pool = sqlite.SQLiteConnPool(properties.SQLITE_DB_FILE_PATH, conn_count=conn_pool_size)
         else:
-            self.conn_pool = mysql.DBConnPool(conn_count=conn_pool_size)
+            conn_pool = mysql.DBConnPool(conn_count=conn_pool_size)
+            if replica_db_conn_pool is None and properties.MYSQL_REPLICA_HOST:
+                # min_conns=0, so that an unreachable replica doesn't stop us starting - the routing pool just reads
+                # from the primary until the replica's lag can be checked
+                replica_db_conn_pool = mysql.DBConnPool(conn_count=conn_pool_size, min_conns=0,
+                                                        host=properties.MYSQL_REPLICA_HOST)
+        if replica_db_conn_pool is not None:
+            # read-only checkouts go to the replica while it's fresh enough (see database.replicas)
+            if replica_lag_check is None:
+                replica_lag_check = mysql.replication_lag_seconds
+            if replica_max_staleness_seconds is None:
+                replica_max_staleness_seconds = properties.REPLICA_MAX_STALENESS_SECONDS
+            conn_pool = ReplicaRoutingPool(conn_pool, replica_db_conn_pool, replica_lag_check,
+                                           max_staleness_seconds=replica_max_staleness_seconds)
+        if slow_query_threshold_seconds is None:
+            slow_query_threshold_seconds = properties.SLOW_QUERY_THRESHOLD_SECONDS
+        self.query_stats = QueryStats(slow_query_threshold_seconds=slow_query_threshold_seconds)
+        if properties.SLOW_QUERY_LOG_FILE_PATH:
+            log_slow_queries_to(properties.SLOW_QUERY_LOG_FILE_PATH)
+        self.conn_pool = InstrumentedConnPool(conn_pool, self.query_stats)
+        # activated users by username - entries are dropped whenever we write to that user's row
+        self.user_cache = TTLCache(ttl_seconds=user_cache_ttl_seconds)
+        # the latest deal - dropped when we save a new one, and (if check_current_steal_version is set) re-checked
+        # against the newest deal ID on every read, to pick up deals saved by other processes straight away
+        self.current_steal_cache = TTLCache(ttl_seconds=current_steal_cache_ttl_seconds, max_size=1)
+        self.check_current_steal_version = check_current_steal_version
 
     def __del__(self):
         logging.debug("Closing all DB connections")
         self.conn_pool.close_all()
         logging.debug("All db connections closed")
 
+    #
+    # units of work
+    #
+
+    @contextmanager
+    def transaction(self):
+        """ Runs a unit of work on one connection with one commit, like:
+
+            with model.transaction() as cursor:
+                model.save_alerts(new_alerts, cursor=cursor)
+                model.archive_alerts(old_alerts, cursor=cursor)
+
+        Everything is rolled back (and the exception re-raised) if the block raises. """
+        db_conn = self.conn_pool.get_conn()
+        try:
+            db_conn.begin()
+            yield db_conn.cursor()
+            db_conn.commit()
+        except Exception:
+            try:
+                db_conn.rollback()
+            except Exception as e:
+                logging.exception(e)
+            raise
+        finally:
+            self.conn_pool.return_conn(db_conn)
+
+    def __run_in_unit_of_work(self, work, cursor, description):
+        """ Calls work(cursor) - in the caller's unit of work if given a cursor (letting exceptions through so that it
+        rolls back), or in a transaction of its own otherwise. Returns True on success. """
+        if cursor is not None:
+            work(cursor)
+            return True
+        try:
+            with self.transaction() as cursor:
+                work(cursor)
+            return True
+        except Exception as e:
+            logging.exception("An exception occurred %s:" % description)
+            return False
+
+    def __run_batch(self, sql, rows, cursor, description):
+        """ executemany()s one statement as a unit of work (see __run_in_unit_of_work). """
+        if len(rows) == 0:
+            return True
+        return self.__run_in_unit_of_work(lambda c: c.executemany(sql, rows), cursor, description)
+
     #
     # read/write activation key mappings
     #
@@ -119,15 +302,15 @@ class Model(object):
                 self.conn_pool.return_conn(db_conn)
 
     def load_activation_key_pairs(self):
-        ten_mins_ago = datetime.utcnow() - timedelta(minutes=120)
-        logging.info("Loading recent activation key pairs more recent than %s" % str(ten_mins_ago))
-        sql = "select phone_number, activation_key from account_activation_keys" # where created > '%s'" % str(ten_mins_ago).split(".")[0]
-        logging.error(sql)
+        """ Returns a list of the unexpired ActivationKeyPairs. """
+        logging.info("Loading activation key pairs from the last %d minutes" % ACTIVATION_KEY_LIFETIME_MINUTES)
+        sql = "select phone_number, activation_key from account_activation_keys " \
+              "where created > now() - interval %s minute"
         db_conn = None
         try:
-            db_conn = self.conn_pool.get_conn()
+            db_conn = self.conn_pool.get_conn(read_only=True)
             cursor = db_conn.cursor()
-            cursor.execute(sql)
+            cursor.execute(sql, (ACTIVATION_KEY_LIFETIME_MINUTES,))
             rs = cursor.fetchall()
             logging.info(rs)
             results = []
@@ -141,6 +324,42 @@ class Model(object):
             if db_conn is not None:
                 self.conn_pool.return_conn(db_conn)
 
+    def is_valid_activation_key_pair(self, phone_number, account_activation_key):
+        """ True if this activation key was issued to this phone number and has not expired yet. """
+        logging.info("Checking activation key pair for %s" % phone_number)
+        sql = IS_VALID_ACTIVATION_KEY_PAIR_SQL
+        db_conn = None
+        try:
+            # from the primary, not a read replica: the key was usually saved moments ago, by another request thread
+            db_conn = self.conn_pool.get_conn()
+            cursor = db_conn.cursor()
+            cursor.execute(sql, (phone_number, account_activation_key, ACTIVATION_KEY_LIFETIME_MINUTES))
+            return len(cursor.fetchall()) > 0
+        except Exception as e:
+            logging.exception("An exception occurred checking an activation key pair:")
+            return False
+        finally:
+            if db_conn is not None:
+                self.conn_pool.return_conn(db_conn)
+
+    def purge_expired_activation_keys(self):
+        """ Deletes expired activation keys and returns the number of rows removed (or None on failure). """
+        logging.info("Purging activation keys older than %d minutes" % ACTIVATION_KEY_LIFETIME_MINUTES)
+        sql = PURGE_EXPIRED_ACTIVATION_KEYS_SQL
+        db_conn = None
+        try:
+            db_conn = self.conn_pool.get_conn()
+            cursor = db_conn.cursor()
+            deleted = cursor.execute(sql, (ACTIVATION_KEY_LIFETIME_MINUTES,))
+            db_conn.commit()
+            logging.info("Purged %d expired activation keys" % deleted)
+            return deleted
+        except Exception as e:
+            logging.exception("An exception occurred purging expired activation keys:")
+        finally:
+            if db_conn is not None:
+                self.conn_pool.return_conn(db_conn)
+
     #
     # read/write users
     #
@@ -152,7 +371,7 @@ class Model(object):
         results = []
         db_conn = None
         try:
-            db_conn = self.conn_pool.get_conn()
+            db_conn = self.conn_pool.get_conn(read_only=True)
             cursor = db_conn.cursor()
             cursor.execute(sql)
             rs = cursor.fetchall()
@@ -167,6 +386,31 @@ class Model(object):
         logging.info("Loaded %d users" % len(results))
         return results
 
+    def load_user_by_username(self, user_name):
+        """ Returns the activated User with this username, or None. Served from the user cache when possible. """
+        user = self.user_cache.get(user_name)
+        if user is not None:
+            return user
+        logging.debug("User cache miss for %s - loading from the database" % user_name)
+        sql = LOAD_USER_BY_USERNAME_SQL
+        db_conn = None
+        try:
+            # from the primary, not a read replica, so that a user can log in as soon as they've been activated
+            db_conn = self.conn_pool.get_conn()
+            cursor = db_conn.cursor()
+            cursor.execute(sql, (user_name,))
+            rs = cursor.fetchall()
+            if len(rs) > 0:
+                _id, phone_number, loaded_user_name, password = rs[0]
+                user = User(_id, phone_number, loaded_user_name, password)
+                self.user_cache.put(user_name, user)
+        except Exception as e:
+            logging.exception("An exception occurred loading a user from the database:")
+        finally:
+            if db_conn is not None:
+                self.conn_pool.return_conn(db_conn)
+        return user
+
     def save_user(self, phone_number, user_name, password):
         """ Returns a User object representing the new record, or None if the save failed.
         NOTE: Password should already be encrypted before it gets passed in here! """
@@ -190,6 +434,7 @@ class Model(object):
         except Exception as e:
             logging.exception("An exception occurred saving a new user to the database:")
         finally:
+            self.user_cache.invalidate(user_name)
             if db_conn is not None:
                 self.conn_pool.return_conn(db_conn)
         return result
@@ -207,6 +452,7 @@ class Model(object):
         except Exception as e:
             logging.exception(e)
         finally:
+            self.user_cache.invalidate(username)
             if db_conn is not None:
                 return self.conn_pool.return_conn(db_conn)
 
@@ -215,63 +461,136 @@ class Model(object):
     #
 
     def save_alert(self, alert):
-        """ Saves a new alert and returns None. """
+        """ Saves a new alert (and its search terms), sets its alert_id, and returns True on success. """
         logging.info("Saving new alert...")
-        save_sql = "insert into alerts (user_id, alert_name, search_terms) values (%s, %s, %s)"
-        db_conn = None
-        try:
-            # save the new record
-            db_conn = self.conn_pool.get_conn()
-            cursor = db_conn.cursor()
-            cursor.execute(save_sql, (alert.user_id, alert.alert_name, alert.get_db_search_terms()))
-            db_conn.commit()
-        except Exception as e:
-            logging.exception("An exception occurred saving a new alert:")
-        finally:
-            if db_conn is not None:
-                self.conn_pool.return_conn(db_conn)
+        return self.save_alerts([alert])
 
     def update_alert(self, alert):
-        """ Updates the alert row with the matching ID. """
+        """ Updates the alert row with the matching ID, replacing its search terms. Returns True on success. """
         logging.info("Updating alert...")
-        save_sql = "update alerts " \
-                   "set " \
-                   "alerts.user_id = %s, " \
-                   "alerts.alert_name = %s, " \
-                   "alerts.search_terms = %s " \
-                   "where alerts.id = %s"
+        return self.update_alerts([alert])
+
+    def archive_alert(self, alert):
+        logging.info("Archiving alert with ID %d" % int(alert.alert_id))
+        archive_sql = _ARCHIVE_ALERT_SQL
         db_conn = None
         try:
-            # save the new record
             db_conn = self.conn_pool.get_conn()
             cursor = db_conn.cursor()
-            cursor.execute(save_sql, (alert.user_id, alert.alert_name, alert.get_db_search_terms(), alert.alert_id))
+            cursor.execute(archive_sql, (alert.alert_id,))
             db_conn.commit()
         except Exception as e:
-            logging.exception("An exception occurred updating an alert:")
+            logging.exception("An exception occurred archiving an alert:")
         finally:
             if db_conn is not None:
                 self.conn_pool.return_conn(db_conn)
 
-    def archive_alert(self, alert):
-        logging.info("Archiving alert with ID %d" % int(alert.alert_id))
-        archive_sql = "update alerts set alerts.active = 0 where alerts.id = %s"
+    @staticmethod
+    def __insert_search_terms(cursor, alerts):
+        rows = []
+        for alert in alerts:
+            for position, search_term in enumerate(alert.search_terms):
+                rows.append((alert.alert_id, position, search_term, normalize_search_term(search_term)))
+        if len(rows) > 0:
+            cursor.executemany(_SAVE_ALERT_SEARCH_TERM_SQL, rows)
+
+    @staticmethod
+    def __insert_alerts(cursor, alerts):
+        # one insert per alert, since we need each new row's ID for its search terms - all in one transaction, though
+        for alert in alerts:
+            cursor.execute(_SAVE_ALERT_SQL, (alert.user_id, alert.alert_name, alert.get_db_search_terms()))
+            alert.alert_id = cursor.lastrowid
+        Model.__insert_search_terms(cursor, alerts)
+
+    @staticmethod
+    def __update_alerts(cursor, alerts):
+        cursor.executemany(
+            _UPDATE_ALERT_SQL,
+            [(a.user_id, a.alert_name, a.get_db_search_terms(), a.alert_id) for a in alerts]
+        )
+        alert_ids = [a.alert_id for a in alerts]
+        cursor.execute(
+            "delete from alert_search_terms where alert_id in (%s)" % ", ".join(["%s"] * len(alert_ids)),
+            alert_ids
+        )
+        Model.__insert_search_terms(cursor, alerts)
+
+    def save_alerts(self, alerts, cursor=None):
+        """ Saves new alerts and their search terms, setting each one's alert_id. Returns True on success. """
+        logging.info("Saving %d new alerts..." % len(alerts))
+        if len(alerts) == 0:
+            return True
+        return self.__run_in_unit_of_work(lambda c: Model.__insert_alerts(c, alerts), cursor, "saving new alerts")
+
+    def update_alerts(self, alerts, cursor=None):
+        """ Updates the alert rows with matching IDs, replacing their search terms. Returns True on success. """
+        logging.info("Updating %d alerts..." % len(alerts))
+        if len(alerts) == 0:
+            return True
+        return self.__run_in_unit_of_work(lambda c: Model.__update_alerts(c, alerts), cursor, "updating alerts")
+
+    def archive_alerts(self, alerts, cursor=None):
+        """ Archives the alert rows with matching IDs. Returns True on success. """
+        logging.info("Archiving %d alerts..." % len(alerts))
+        rows = [(a.alert_id,) for a in alerts]
+        return self.__run_batch(_ARCHIVE_ALERT_SQL, rows, cursor, "archiving alerts")
+
+    def apply_alert_changes(self, new_alerts, updated_alerts, archived_alerts):
+        """ Saves, updates and archives lists of alerts in a single transaction, with one batched statement per
+        kind of change. Returns True if everything was committed, False if nothing was. """
+        logging.info("Applying alert changes: %d new, %d updated, %d archived"
+                     % (len(new_alerts), len(updated_alerts), len(archived_alerts)))
+        try:
+            with self.transaction() as cursor:
+                self.save_alerts(new_alerts, cursor=cursor)
+                self.update_alerts(updated_alerts, cursor=cursor)
+                self.archive_alerts(archived_alerts, cursor=cursor)
+            return True
+        except Exception as e:
+            logging.exception("An exception occurred applying alert changes - rolled back:")
+            return False
+
+    @staticmethod
+    def __load_search_terms(cursor, alerts_where_sql, params):
+        """ Returns a dict of alert IDs to their (ordered) search terms, for the alerts matching the where clause.
+        Alerts saved before the alert_search_terms table existed and not yet backfilled won't be in it. """
+        cursor.execute(
+            "select alert_search_terms.alert_id, alert_search_terms.search_term "
+            "from alert_search_terms "
+            "join alerts "
+            "on alerts.id = alert_search_terms.alert_id "
+            "where " + alerts_where_sql + " "
+            "order by alert_search_terms.alert_id, alert_search_terms.position",
+            params
+        )
+        terms = {}
+        for alert_id, search_term in cursor.fetchall():
+            terms.setdefault(alert_id, []).append(search_term)
+        return terms
+
+    def load_active_alert_ids_by_search_term(self, search_term):
+        """ Returns a list of the IDs of active alerts with this search term (compared in normalized form). """
+        logging.info("Loading active alert IDs for search term %s" % search_term)
+        sql = LOAD_ACTIVE_ALERT_IDS_BY_SEARCH_TERM_SQL
+        results = []
         db_conn = None
         try:
-            db_conn = self.conn_pool.get_conn()
+            db_conn = self.conn_pool.get_conn(read_only=True)
             cursor = db_conn.cursor()
-            cursor.execute(archive_sql, (alert.alert_id,))
-            db_conn.commit()
+            cursor.execute(sql, (normalize_search_term(search_term),))
+            results = [r[0] for r in cursor.fetchall()]
         except Exception as e:
-            logging.exception("An exception occurred archiving an alert:")
+            logging.exception("An exception occurred loading alert IDs by search term:")
         finally:
             if db_conn is not None:
                 self.conn_pool.return_conn(db_conn)
+        return results
 
     def load_all_active_alerts_with_phone_numbers(self):
-        """ Returns a list of Alert instances (or an empty list).  """
+        """ Returns a list of Alert instances, with their versions (or an empty list).  """
         logging.info("Loading active alerts...")
-        sql = "select alerts.id, alerts.user_id, alerts.alert_name, alerts.search_terms, users.phone_number " \
+        sql = "select alerts.id, alerts.user_id, alerts.alert_name, alerts.search_terms, users.phone_number, " \
+              "alerts.version, alerts.updated " \
               "from alerts " \
               "join users " \
               "on users.id = alerts.user_id " \
@@ -279,12 +598,14 @@ class Model(object):
         results = []
         db_conn = None
         try:
-            db_conn = self.conn_pool.get_conn()
+            db_conn = self.conn_pool.get_conn(read_only=True)
             cursor = db_conn.cursor()
             cursor.execute(sql)
             rs = cursor.fetchall()
-            for alert_id, user_id, alert_name, search_terms, phone_number in rs:
-                results.append(Alert(user_id, alert_id, alert_name, search_terms, phone_number))
+            terms = Model.__load_search_terms(cursor, "alerts.active = 1", ())
+            for alert_id, user_id, alert_name, search_terms, phone_number, version, updated in rs:
+                results.append(Alert(user_id, alert_id, alert_name, terms.get(alert_id, search_terms), phone_number,
+                                     version=version, updated=updated))
         except Exception as e:
             logging.exception("An exception occurred loading active alerts from the database:")
         finally:
@@ -292,6 +613,75 @@ class Model(object):
                 self.conn_pool.return_conn(db_conn)
         return results
 
+    def load_alerts_changed_since(self, datetime_obj):
+        """ Returns a list of the Alerts (active or not - see Alert.active) created, updated or archived at or after
+        the given time, with their versions. Returns None if the load fails. """
+        logging.info("Loading alerts changed since %s" % str(datetime_obj))
+        sql = LOAD_ALERTS_CHANGED_SINCE_SQL
+        db_conn = None
+        try:
+            db_conn = self.conn_pool.get_conn(read_only=True)
+            cursor = db_conn.cursor()
+            cursor.execute(sql, (datetime_obj,))
+            rs = cursor.fetchall()
+            terms = Model.__load_search_terms(cursor, "alerts.updated >= %s", (datetime_obj,))
+            results = []
+            for alert_id, user_id, alert_name, search_terms, phone_number, version, updated, active in rs:
+                results.append(Alert(user_id, alert_id, alert_name, terms.get(alert_id, search_terms), phone_number,
+                                     version=version, updated=updated, active=active == 1))
+            return results
+        except Exception as e:
+            logging.exception("An exception occurred loading changed alerts from the database:")
+        finally:
+            if db_conn is not None:
+                self.conn_pool.return_conn(db_conn)
+
+    def load_active_alerts_for_user(self, user_id):
+        """ Returns a list of the given user's active Alert instances (or an empty list). """
+        logging.info("Loading active alerts for user %s..." % str(user_id))
+        sql = LOAD_ACTIVE_ALERTS_FOR_USER_SQL
+        results = []
+        db_conn = None
+        try:
+            # from the primary: the alerts API lists a user's alerts straight after saving one, and the replica
+            # read-your-writes window only covers the thread that wrote (each HTTP request gets its own thread)
+            db_conn = self.conn_pool.get_conn()
+            cursor = db_conn.cursor()
+            cursor.execute(sql, (user_id,))
+            rs = cursor.fetchall()
+            terms = Model.__load_search_terms(cursor, "alerts.user_id = %s and alerts.active = 1", (user_id,))
+            for alert_id, user_id, alert_name, search_terms, phone_number in rs:
+                results.append(Alert(user_id, alert_id, alert_name, terms.get(alert_id, search_terms), phone_number))
+        except Exception as e:
+            logging.exception("An exception occurred loading a user's active alerts from the database:")
+        finally:
+            if db_conn is not None:
+                self.conn_pool.return_conn(db_conn)
+        return results
+
+    def load_active_alert_for_user(self, user_id, alert_id):
+        """ Returns the active Alert with this ID if it belongs to the given user, or None. """
+        logging.info("Loading active alert %s for user %s..." % (str(alert_id), str(user_id)))
+        sql = LOAD_ACTIVE_ALERT_FOR_USER_SQL
+        result = None
+        db_conn = None
+        try:
+            # from the primary, for the alerts API's ownership checks - see load_active_alerts_for_user
+            db_conn = self.conn_pool.get_conn()
+            cursor = db_conn.cursor()
+            cursor.execute(sql, (alert_id, user_id))
+            rs = cursor.fetchall()
+            if len(rs) > 0:
+                alert_id, user_id, alert_name, search_terms, phone_number = rs[0]
+                terms = Model.__load_search_terms(cursor, "alerts.id = %s", (alert_id,))
+                result = Alert(user_id, alert_id, alert_name, terms.get(alert_id, search_terms), phone_number)
+        except Exception as e:
+            logging.exception("An exception occurred loading an alert from the database:")
+        finally:
+            if db_conn is not None:
+                self.conn_pool.return_conn(db_conn)
+        return result
+
     #
     # read/write current steal records
     #
@@ -316,21 +706,47 @@ class Model(object):
             logging.info("Save success for name: %s" % (current_steal_obj.product_name,))
         except Exception as e:
             logging.exception(e)
+        finally:
+            self.current_steal_cache.invalidate(_CURRENT_STEAL_CACHE_KEY)
+            if db_conn is not None:
+                self.conn_pool.return_conn(db_conn)
+
+    def __load_latest_deal_id(self):
+        """ The newest deal's ID (a primary key lookup), or None. """
+        db_conn = None
+        try:
+            db_conn = self.conn_pool.get_conn(read_only=True)
+            cursor = db_conn.cursor()
+            cursor.execute(LOAD_LATEST_DEAL_ID_SQL)
+            return cursor.fetchall()[0][0]
+        except Exception as e:
+            logging.exception("An exception occurred loading the latest deal ID:")
         finally:
             if db_conn is not None:
                 self.conn_pool.return_conn(db_conn)
 
     def load_current_steal(self):
-        """ Returns a CurrentSteal instance, or None. """
+        """ Returns a CurrentSteal instance, or None. Served from the current steal cache when possible. """
+        cached = self.current_steal_cache.get(_CURRENT_STEAL_CACHE_KEY)
+        if cached is not None:
+            if not self.check_current_steal_version:
+                return cached
+            latest_deal_id = self.__load_latest_deal_id()
+            if latest_deal_id is not None and int(latest_deal_id) == cached.deal_id:
+                return cached
+            logging.info("Current steal cache is stale - newest deal ID is now %s" % str(latest_deal_id))
+        result = self.__load_current_steal_from_db()
+        if result is not None:
+            self.current_steal_cache.put(_CURRENT_STEAL_CACHE_KEY, result)
+        return result
+
+    def __load_current_steal_from_db(self):
         logging.info("Loading current steal...")
-        sql = "select " \
-              "deals.id, deals.product_name, deals.product_description, deals.brand_name, deals.sale_price, deals.url, deals.created " \
-              "from deals " \
-              "order by deals.created desc limit 1 "
+        sql = LOAD_CURRENT_STEAL_SQL
         result = None
         db_conn = None
         try:
-            db_conn = self.conn_pool.get_conn()
+            db_conn = self.conn_pool.get_conn(read_only=True)
             cursor = db_conn.cursor()
             cursor.execute(sql)
             r = cursor.fetchall()[0]
@@ -346,13 +762,11 @@ class Model(object):
     def load_all_steals_since(self, datetime_obj):
         """ Returns a list of 0 or more CurrentSteals. """
         logging.info("Loading current steals since %s" % str(datetime_obj))
-        sql = "select " \
-              "deals.id, deals.product_name, deals.product_description, deals.brand_name, deals.sale_price, deals.url, deals.created " \
-              "from deals where deals.created > %s and deals.url is not null"
+        sql = LOAD_STEALS_SINCE_SQL
         results = []
         db_conn = None
         try:
-            db_conn = self.conn_pool.get_conn()
+            db_conn = self.conn_pool.get_conn(read_only=True)
             cursor = db_conn.cursor()
             cursor.execute(sql, datetime_obj,)
             rs = cursor.fetchall()
@@ -365,6 +779,36 @@ class Model(object):
                 self.conn_pool.return_conn(db_conn)
         return results
 
+    def iter_steals_since(self, datetime_obj, batch_size=500):
+        """ Yields CurrentSteals like load_all_steals_since, in deal ID order, reading them a page of batch_size at a
+        time (keyed on deal ID) so memory use doesn't grow with the deal history. A connection is only held while a
+        page is read, not while the caller works through it. Raises if a page can't be read, rather than quietly
+        ending the stream early. """
+        logging.info("Streaming current steals since %s" % str(datetime_obj))
+        sql = LOAD_STEALS_SINCE_PAGE_SQL
+        last_deal_id = 0
+        count = 0
+        while True:
+            db_conn = None
+            try:
+                db_conn = self.conn_pool.get_conn(read_only=True)
+                cursor = db_conn.cursor()
+                cursor.execute(sql, (datetime_obj, last_deal_id, batch_size))
+                rs = cursor.fetchall()
+            except Exception as e:
+                logging.exception("An exception occurred streaming current steals, after %d of them:" % count)
+                raise
+            finally:
+                if db_conn is not None:
+                    self.conn_pool.return_conn(db_conn)
+            for r in rs:
+                count += 1
+                yield CurrentSteal(r[0], r[1], r[2], r[3], r[4], r[5], r[6])
+            if len(rs) < batch_size:
+                break
+            last_deal_id = rs[-1][0]
+        logging.info("Streamed %d current steals" % count)
+
     #
     # read/write sent alert records
     #
@@ -372,11 +816,11 @@ class Model(object):
     def load_sent_alerts_by_deal_id(self, deal_id):
         """ Returns a list of alert IDs.  """
         logging.info("Loading previously sent alerts for current deal...")
-        sql = "select sent_alerts.alert_id from sent_alerts where sent_alerts.deal_id = %s "
+        sql = LOAD_SENT_ALERTS_BY_DEAL_ID_SQL
         results = []
         db_conn = None
         try:
-            db_conn = self.conn_pool.get_conn()
+            db_conn = self.conn_pool.get_conn(read_only=True)
             cursor = db_conn.cursor()
             cursor.execute(sql, (deal_id,))
             rs = cursor.fetchall()
@@ -396,7 +840,7 @@ class Model(object):
         sql = "select user_id, count(id) from sent_alerts group by user_id"
         db_conn = None
         try:
-            db_conn = self.conn_pool.get_conn()
+            db_conn = self.conn_pool.get_conn(read_only=True)
             cursor = db_conn.cursor()
             cursor.execute(sql)
             rs = cursor.fetchall()
@@ -412,19 +856,112 @@ class Model(object):
             if db_conn is not None:
                 self.conn_pool.return_conn(db_conn)
 
+    def load_recent_sent_alert_counts_by_user_id(self, days):
+        """ Returns a dict mapping user ids to how many alerts we've sent them in the last `days` days (counting
+        today), read from the per-day counters rather than counting sent_alerts. Users sent nothing aren't in it. """
+        logging.info("Loading sent alert counts by user id for the last %d days" % days)
+        sql = LOAD_RECENT_SENT_ALERT_COUNTS_SQL
+        db_conn = None
+        try:
+            db_conn = self.conn_pool.get_conn(read_only=True)
+            cursor = db_conn.cursor()
+            cursor.execute(sql, (days,))
+            return dict((user_id, int(count)) for user_id, count in cursor.fetchall())
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            if db_conn is not None:
+                self.conn_pool.return_conn(db_conn)
+
+    @staticmethod
+    def __insert_sent_alerts(cursor, alerts, deal_id):
+        cursor.executemany(_SAVE_SENT_ALERT_SQL, [(alert.user_id, deal_id, alert.alert_id) for alert in alerts])
+        # and bump each user's counter for today, creating it if this is their first alert of the day (in user ID
+        # order, so that concurrent writers lock the counters in the same order)
+        counts = {}
+        for alert in alerts:
+            counts[alert.user_id] = counts.get(alert.user_id, 0) + 1
+        cursor.executemany(_ADD_TO_SENT_ALERT_COUNT_SQL, sorted(counts.items()))
+
     def save_sent_alert(self, alert, deal_id):
-        """ Write down in the DB that we sent out this alert. """
+        """ Write down in the DB that we sent out this alert. Returns True on success. """
         logging.info("Saving sent alert, alert id: %d, deal id: %d" % (alert.alert_id, deal_id))
+        return self.save_sent_alerts([alert], deal_id)
+
+    def save_sent_alerts(self, alerts, deal_id, cursor=None):
+        """ Write down in the DB that we sent out these alerts, and count them in the per-day counters, in one unit of
+        work. Returns True on success. """
+        logging.info("Saving %d sent alerts for deal id: %d" % (len(alerts), deal_id))
+        if len(alerts) == 0:
+            return True
+        return self.__run_in_unit_of_work(
+            lambda c: Model.__insert_sent_alerts(c, alerts, deal_id), cursor, "saving sent alert records"
+        )
+
+    #
+    # read/write alert match results
+    #
+
+    def load_alert_match_results(self, deal_id, alert_ids):
+        """ Returns a dict mapping those of these alert IDs already scored against this deal to (the alert version
+        that was scored, the scoring version it was scored with, whether it matched). One query either way - see
+        ALERT_MATCH_RESULTS_LOAD_BATCH_SIZE. Returns None if the load fails. """
+        logging.info("Loading alert match results for %d alerts for deal id: %d" % (len(alert_ids), deal_id))
+        results = {}
+        if len(alert_ids) == 0:
+            return results
         db_conn = None
         try:
-            db_conn = self.conn_pool.get_conn()
+            db_conn = self.conn_pool.get_conn(read_only=True)
             cursor = db_conn.cursor()
-            sql = "insert into sent_alerts (user_id, deal_id, alert_id) values (%s, %s, %s)"
-            cursor.execute(sql, (alert.user_id, deal_id, alert.alert_id))
-            db_conn.commit()
+            if len(alert_ids) > ALERT_MATCH_RESULTS_LOAD_BATCH_SIZE:
+                cursor.execute(LOAD_DEAL_ALERT_MATCH_RESULTS_SQL, (deal_id,))
+            else:
+                cursor.execute(LOAD_ALERT_MATCH_RESULTS_SQL.format(", ".join(["%s"] * len(alert_ids))),
+                               [deal_id] + list(alert_ids))
+            wanted = set(alert_ids)
+            for alert_id, alert_version, scoring_version, matched in cursor.fetchall():
+                if alert_id in wanted:
+                    results[alert_id] = (alert_version, scoring_version, bool(matched))
+            return results
         except Exception as e:
-            logging.error("An exception occurred saving a sent alert record:")
-            logging.error(e)
+            logging.exception("An exception occurred loading alert match results:")
         finally:
             if db_conn is not None:
                 self.conn_pool.return_conn(db_conn)
+
+    def save_alert_match_results(self, deal_id, scoring_version, results, cursor=None):
+        """ Writes down whether alerts matched this deal, given the scoring version and (alert ID, alert version,
+        matched) tuples - replacing what was saved for those alerts before. Returns True on success. """
+        logging.info("Saving %d alert match results for deal id: %d" % (len(results), deal_id))
+        return self.__run_batch(
+            _SAVE_ALERT_MATCH_RESULT_SQL,
+            [(deal_id, alert_id, alert_version, scoring_version, 1 if matched else 0)
+             for alert_id, alert_version, matched in results],
+            cursor,
+            "saving alert match results"
+        )
+
+    def has_alert_match_results_before(self, deal_id):
+        """ Returns whether any match results are saved for deals older than this one, or None if the check fails. """
+        db_conn = None
+        try:
+            db_conn = self.conn_pool.get_conn(read_only=True)
+            cursor = db_conn.cursor()
+            cursor.execute(HAS_ALERT_MATCH_RESULTS_BEFORE_SQL, (deal_id,))
+            return len(cursor.fetchall()) > 0
+        except Exception as e:
+            logging.exception("An exception occurred checking for old alert match results:")
+        finally:
+            if db_conn is not None:
+                self.conn_pool.return_conn(db_conn)
+
+    def purge_alert_match_results_before(self, deal_id):
+        """ Deletes the match results for deals older than this one, which won't be scored against again. Returns True
+        on success. """
+        logging.info("Purging alert match results for deals before deal id: %d" % deal_id)
+        return self.__run_in_unit_of_work(
+            lambda c: c.execute("delete from alert_match_results where deal_id < %s", (deal_id,)),
+            None,
+            "purging alert match results"
+        )
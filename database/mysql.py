@@ -1,26 +1,73 @@
 import logging
-from Queue import Queue
+import threading
+import time
+from collections import deque
+
 import pymysql
 from utils import properties
 
 
+class PoolTimeout(Exception):
+    """ Raised by get_conn when no connection frees up within the acquire timeout. """
+    pass
+
+
+def replication_lag_seconds(conn):
+    """ How many seconds a replica connection's server is behind its primary, or None if it isn't replicating. """
+    cursor = conn.cursor()
+    cursor.execute("show slave status")
+    rs = cursor.fetchall()
+    if len(rs) == 0:
+        return None
+    columns = [d[0] for d in cursor.description]
+    return rs[0][columns.index("Seconds_Behind_Master")]
+
+
 class DBConnPool(object):
-    """ Wraps one sync'd pool of X DB conns - use get() to get them out and put() to put them back. """
+    """ Wraps one sync'd, elastic pool of DB conns - use get_conn() to get them out and return_conn() to put them back.
 
-    def __init__(self, conn_count=5):
-        self.conn_count = conn_count
-        self.pool = Queue()
-        for x in range(self.conn_count):
-            self.pool.put(DBConnPool.__get_db_conn())
+    The pool opens connections on demand up to max_conns, and a background thread closes ones that sit idle past
+    idle_timeout_seconds (down to min_conns) and pings the rest, so checkouts don't have to. Connections run in
+    autocommit mode: multi-statement writes must begin() their own transaction, and read-only checkouts (which never
+    leave anything to commit) skip the commit that return_conn otherwise does. """
 
-    @staticmethod
-    def __get_db_conn():
-        """ Produces one DB connection - close it using close_db_conn(). """
+    def __init__(self, conn_count=5, min_conns=1, acquire_timeout_seconds=30,
+                 idle_timeout_seconds=300, validation_interval_seconds=60, host=None):
+        self.host = properties.MYSQL_HOST if host is None else host
+        self.max_conns = max(conn_count, 1)
+        self.min_conns = min(min_conns, self.max_conns)
+        self.acquire_timeout_seconds = acquire_timeout_seconds
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.cond = threading.Condition(threading.Lock())
+        self.__idle = deque()  # (conn, time it was returned), most recently returned on the right
+        self.__read_only_conns = set()  # ids of checked out conns that were checked out read-only
+        self.__total = 0  # idle + checked out + being opened
+        self.__closed = False
+        self.__stats = {
+            "acquisitions": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "connections_opened": 0,
+            "connections_closed": 0,
+        }
+        self.__waiters = 0
+        for x in range(self.min_conns):
+            self.__open_conn_slot()
+            self.__idle.append((self.__connect_or_release_slot(), time.time()))
+        self.__stop_validating = threading.Event()
+        self.__validator = threading.Thread(target=self.__validate_forever, args=(validation_interval_seconds,))
+        self.__validator.daemon = True
+        self.__validator.start()
+
+    def _new_db_conn(self):
+        """ Produces one DB connection - close it using close_db_conn(). Other backends' pools override this. """
         return pymysql.connect(
-            host=properties.MYSQL_HOST,
+            host=self.host,
             user=properties.MYSQL_USER,
             password=properties.MYSQL_PASSWORD,
-            db=properties.MYSQL_DB_NAME
+            db=properties.MYSQL_DB_NAME,
+            autocommit=True
         )
 
     @staticmethod
@@ -30,26 +77,148 @@ class DBConnPool(object):
             try:
                 conn.close()
             except Exception as e:
-                print e
+                logging.error(e)
+
+    def __open_conn_slot(self):
+        with self.cond:
+            self.__total += 1
+
+    def __connect_or_release_slot(self):
+        """ Opens a connection for a slot already counted in __total, giving the slot back if that fails. """
+        try:
+            conn = self._new_db_conn()
+        except Exception:
+            self.__discard_slot()
+            raise
+        with self.cond:
+            self.__stats["connections_opened"] += 1
+        return conn
 
-    def get_conn(self):
-        conn = self.pool.get()
-        if not conn.ping(reconnect=True):
-            conn = self.__get_db_conn()
+    def __discard_slot(self, conn=None):
+        DBConnPool.__close_db_conn(conn)
+        with self.cond:
+            self.__total -= 1
+            if conn is not None:
+                self.__stats["connections_closed"] += 1
+            self.cond.notify()
+
+    def get_conn(self, read_only=False, timeout=None):
+        """ Returns a connection, opening a new one if none are idle and we're under max_conns. Waits up to timeout
+        (default acquire_timeout_seconds) for one to be returned otherwise, then raises PoolTimeout. """
+        timeout = self.acquire_timeout_seconds if timeout is None else timeout
+        deadline = None
+        conn = None
+        with self.cond:
+            while True:
+                if self.__idle:
+                    conn = self.__idle.pop()[0]
+                    break
+                if self.__total < self.max_conns:
+                    self.__total += 1
+                    break
+                now = time.time()
+                if deadline is None:
+                    deadline = now + timeout
+                    self.__stats["waits"] += 1
+                elif now >= deadline:
+                    self.__stats["timeouts"] += 1
+                    raise PoolTimeout("No DB connection available after %s seconds" % timeout)
+                self.__waiters += 1
+                try:
+                    self.cond.wait(deadline - now)
+                finally:
+                    self.__waiters -= 1
+                    self.__stats["wait_seconds"] += time.time() - now
+            self.__stats["acquisitions"] += 1
+        if conn is None:
+            conn = self.__connect_or_release_slot()
+        if read_only:
+            with self.cond:
+                self.__read_only_conns.add(id(conn))
         return conn
 
     def return_conn(self, conn):
-        try:
-            logging.debug("attempting commit before returning conn to the pool")
-            conn.commit()
-            logging.debug("commit went ok")
-        except Exception as e:
-            logging.error("Commit threw an exception in return_conn")
-        finally:
-            self.pool.put(conn)
+        with self.cond:
+            read_only = id(conn) in self.__read_only_conns
+            self.__read_only_conns.discard(id(conn))
+        if not read_only:
+            try:
+                logging.debug("attempting commit before returning conn to the pool")
+                conn.commit()
+                logging.debug("commit went ok")
+            except Exception as e:
+                logging.error("Commit threw an exception in return_conn - discarding the connection")
+                self.__discard_slot(conn)
+                return
+        with self.cond:
+            if not self.__closed:
+                self.__idle.append((conn, time.time()))
+                self.cond.notify()
+                return
+        self.__discard_slot(conn)
+
+    def __validate_forever(self, interval_seconds):
+        while not self.__stop_validating.wait(interval_seconds):
+            try:
+                self.validate_idle_conns()
+            except Exception as e:
+                logging.exception(e)
+
+    def validate_idle_conns(self):
+        """ Closes connections idle past the idle timeout (keeping min_conns around), and pings the rest, dropping any
+        that are dead. Only the connection being pinged is out of the pool, so checkouts meanwhile still find the
+        others idle rather than opening new ones. """
+        now = time.time()
+        with self.cond:
+            to_close = []
+            surplus = self.__total - self.min_conns
+            for conn, returned in list(self.__idle):  # oldest first
+                if surplus > 0 and now - returned > self.idle_timeout_seconds:
+                    self.__idle.remove((conn, returned))
+                    to_close.append(conn)
+                    surplus -= 1
+            to_check = list(self.__idle)
+        for conn in to_close:
+            self.__discard_slot(conn)
+        # newest first, each put back at the old end, so the idle order is unchanged and hot conns stay hot
+        for conn, returned in reversed(to_check):
+            with self.cond:
+                if (conn, returned) not in self.__idle:
+                    continue  # checked out since - it'll be used, or pinged next time
+                self.__idle.remove((conn, returned))
+            try:
+                conn.ping(reconnect=True)
+            except Exception as e:
+                logging.error("Dropping dead idle DB connection: %s" % str(e))
+                self.__discard_slot(conn)
+                continue
+            with self.cond:
+                if not self.__closed:
+                    self.__idle.appendleft((conn, returned))
+                    self.cond.notify()
+                    continue
+            self.__discard_slot(conn)
+        if to_close:
+            logging.debug("Closed %d idle DB connections" % len(to_close))
+
+    def stats(self):
+        """ Returns a dict of pool counters - sizes, waiters, total acquire wait time, and connection churn. """
+        with self.cond:
+            result = dict(self.__stats)
+            result["total"] = self.__total
+            result["idle"] = len(self.__idle)
+            result["in_use"] = self.__total - len(self.__idle)
+            result["waiters"] = self.__waiters
+            result["max_conns"] = self.max_conns
+        return result
 
     def close_all(self):
         logging.debug("Closing all DB connections")
-        for x in range(self.conn_count):
-            DBConnPool.__close_db_conn(self.pool.get())
-        logging.debug("All DB connections closed.")
+        self.__stop_validating.set()
+        with self.cond:
+            self.__closed = True
+            idle = [conn for conn, returned in self.__idle]
+            self.__idle.clear()
+        for conn in idle:
+            self.__discard_slot(conn)
+        logging.debug("All idle DB connections closed - checked out ones will be closed when returned.")
@@ -0,0 +1,303 @@
+import functools
+import inspect
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+Per-DAO-method query instrumentation. Model wraps its connection pool in an InstrumentedConnPool, whose connections
+hand out cursors that time every statement and count the rows it touched, and whose get_conn() times the wait for a
+connection. All of it is added up under the Model method that was running at the time (the outermost one, when Model
+methods call each other), in a QueryStats that the web metrics and batch jobs read aggregates from.
+
+Statements slower than the threshold are written to the slow query log - with their parameters redacted, since
+they're things like phone numbers and password hashes.
+"""
+
+NO_METHOD = "(none)"
+
+slow_query_log = logging.getLogger("watchsac.slow_queries")
+
+
+def log_slow_queries_to(file_path):
+    """ Sends the slow query log to its own file (as well as wherever the root logger goes). Safe to call again. """
+    for handler in slow_query_log.handlers:
+        if getattr(handler, "baseFilename", None) == os.path.abspath(file_path):
+            return
+    handler = logging.FileHandler(file_path)
+    handler.setFormatter(logging.Formatter('%(asctime)s  -  %(message)s'))
+    slow_query_log.addHandler(handler)
+
+
+def redact_params(params):
+    """ Describes statement parameters by type only, e.g. "(str, int)", or "[3 rows of (str, int)]" for a batch. """
+    if params is None:
+        return "()"
+    if isinstance(params, list) and len(params) > 0 and isinstance(params[0], (tuple, list)):
+        return "[%d rows of %s]" % (len(params), redact_params(tuple(params[0])))
+    if not isinstance(params, (tuple, list)):
+        params = (params,)
+    return "(" + ", ".join(type(p).__name__ for p in params) + ")"
+
+
+class _MethodStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.rows = 0
+        self.acquire_wait_seconds = 0.0
+        self.slow_queries = 0
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class QueryStats(object):
+    """ Thread-safe per-method aggregates of call time, statement time and count, rows read or written, and
+    connection acquire wait. """
+
+    def __init__(self, slow_query_threshold_seconds=0.5):
+        self.slow_query_threshold_seconds = slow_query_threshold_seconds
+        self.lock = threading.Lock()
+        self.__methods = {}  # method name -> _MethodStats
+        self.__current = threading.local()
+
+    def current_method(self):
+        return getattr(self.__current, "method", None) or NO_METHOD
+
+    def __stats_for(self, method):
+        # must be called with the lock held
+        stats = self.__methods.get(method)
+        if stats is None:
+            stats = self.__methods[method] = _MethodStats()
+        return stats
+
+    @contextmanager
+    def method(self, name, count_call=True):
+        """ Attributes everything recorded on this thread in the with block to the named method - unless we're
+        already inside another one, which then gets it all. """
+        if getattr(self.__current, "method", None) is not None:
+            yield
+            return
+        self.__current.method = name
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.__current.method = None
+            elapsed = time.time() - start
+            with self.lock:
+                stats = self.__stats_for(name)
+                if count_call:
+                    stats.calls += 1
+                stats.seconds += elapsed
+                stats.max_seconds = max(stats.max_seconds, elapsed)
+
+    def record_acquire(self, seconds):
+        with self.lock:
+            self.__stats_for(self.current_method()).acquire_wait_seconds += seconds
+
+    def record_rows(self, rows):
+        with self.lock:
+            self.__stats_for(self.current_method()).rows += rows
+
+    def record_query(self, sql, params, seconds):
+        method = self.current_method()
+        slow = seconds >= self.slow_query_threshold_seconds
+        with self.lock:
+            stats = self.__stats_for(method)
+            stats.queries += 1
+            stats.query_seconds += seconds
+            if slow:
+                stats.slow_queries += 1
+        if slow:
+            slow_query_log.warning("%.3fs in %s: %s params=%s" % (seconds, method, " ".join(sql.split()),
+                                                                  redact_params(params)))
+
+    def snapshot(self):
+        """ Returns a dict of method names to dicts of their aggregates. """
+        with self.lock:
+            return dict((name, stats.to_dict()) for name, stats in self.__methods.items())
+
+    def reset(self):
+        with self.lock:
+            self.__methods.clear()
+
+    def summary(self):
+        """ The aggregates as text, one method per line, most time spent first - for batch jobs to log. """
+        lines = []
+        for name, s in sorted(self.snapshot().items(), key=lambda item: -item[1]["seconds"]):
+            lines.append("%-40s calls=%d seconds=%.3f max=%.3f queries=%d query_seconds=%.3f rows=%d "
+                         "acquire_wait=%.3f slow=%d"
+                         % (name, s["calls"], s["seconds"], s["max_seconds"], s["queries"], s["query_seconds"],
+                            s["rows"], s["acquire_wait_seconds"], s["slow_queries"]))
+        return "\n".join(lines)
+
+
+def instrument_dao_methods(cls):
+    """ Class decorator that runs each public method of a DAO inside self.query_stats.method(). A generator method is
+    attributed one step at a time, so that the caller's code between steps isn't counted against it. A method that
+    returns a context manager (Model.transaction) is attributed for the whole with block, including the caller's
+    statements and any DAO methods it calls inside it. """
+    for name, func in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.isfunction(func):
+            continue
+        if inspect.isgeneratorfunction(func):
+            setattr(cls, name, _instrumented_generator(name, func))
+        else:
+            setattr(cls, name, _instrumented_function(name, func))
+    return cls
+
+
+def _instrumented_function(name, func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.query_stats.method(name):
+            result = func(self, *args, **kwargs)
+        if hasattr(result, "__enter__") and hasattr(result, "__exit__"):
+            return _AttributedContextManager(result, self.query_stats, name)
+        return result
+    return wrapper
+
+
+class _AttributedContextManager(object):
+    """ A DAO method's context manager, with everything in the with block attributed to the method. """
+
+    def __init__(self, context_manager, stats, name):
+        self.__context_manager = context_manager
+        self.__attribution = stats.method(name, count_call=False)
+
+    def __enter__(self):
+        self.__attribution.__enter__()
+        try:
+            return self.__context_manager.__enter__()
+        except Exception:
+            self.__attribution.__exit__(*sys.exc_info())
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return self.__context_manager.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.__attribution.__exit__(None, None, None)
+
+
+def _instrumented_generator(name, func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        gen = func(self, *args, **kwargs)
+        first = True
+        try:
+            while True:
+                with self.query_stats.method(name, count_call=first):
+                    first = False
+                    try:
+                        item = next(gen)
+                    except StopIteration:
+                        return
+                yield item
+        finally:
+            with self.query_stats.method(name, count_call=False):
+                gen.close()
+    return wrapper
+
+
+class InstrumentedCursor(object):
+    """ Times each statement, and counts the rows it wrote or (as they're fetched) read. """
+
+    def __init__(self, cursor, stats):
+        self.__cursor = cursor
+        self.__stats = stats
+
+    def __timed(self, run, sql, params):
+        start = time.time()
+        try:
+            return run()
+        finally:
+            self.__stats.record_query(sql, params, time.time() - start)
+
+    def __record_written(self):
+        # statements without a result set are writes - rowcount is how many rows they touched
+        if self.__cursor.description is None and self.__cursor.rowcount > 0:
+            self.__stats.record_rows(self.__cursor.rowcount)
+
+    def execute(self, sql, params=None):
+        result = self.__timed(lambda: self.__cursor.execute(sql, params), sql, params)
+        self.__record_written()
+        return result
+
+    def executemany(self, sql, rows):
+        result = self.__timed(lambda: self.__cursor.executemany(sql, rows), sql, rows)
+        self.__record_written()
+        return result
+
+    def fetchone(self):
+        r = self.__cursor.fetchone()
+        if r is not None:
+            self.__stats.record_rows(1)
+        return r
+
+    def fetchmany(self, size):
+        rs = self.__cursor.fetchmany(size)
+        self.__stats.record_rows(len(rs))
+        return rs
+
+    def fetchall(self):
+        rs = self.__cursor.fetchall()
+        self.__stats.record_rows(len(rs))
+        return rs
+
+    def __getattr__(self, attr):
+        return getattr(self.__cursor, attr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__cursor.close()
+
+
+class InstrumentedConnection(object):
+    """ A pooled connection whose cursors are InstrumentedCursors. """
+
+    def __init__(self, conn, stats):
+        self.conn = conn
+        self.__stats = stats
+
+    def cursor(self):
+        return InstrumentedCursor(self.conn.cursor(), self.__stats)
+
+    def __getattr__(self, attr):
+        return getattr(self.conn, attr)
+
+
+class InstrumentedConnPool(object):
+    """ Wraps a DBConnPool (or anything like one) to time connection checkouts and instrument the connections. """
+
+    def __init__(self, pool, stats):
+        self.pool = pool
+        self.__stats = stats
+
+    def get_conn(self, read_only=False, timeout=None):
+        start = time.time()
+        try:
+            if timeout is None:
+                conn = self.pool.get_conn(read_only=read_only)
+            else:
+                conn = self.pool.get_conn(read_only=read_only, timeout=timeout)
+        finally:
+            self.__stats.record_acquire(time.time() - start)
+        return InstrumentedConnection(conn, self.__stats)
+
+    def return_conn(self, conn):
+        self.pool.return_conn(conn.conn)
+
+    def __getattr__(self, attr):
+        return getattr(self.pool, attr)
@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+
+"""
+Read replica routing. ReplicaRoutingPool sits where Model's DBConnPool would and sends read-only checkouts to a replica
+pool while the replica is keeping up, and everything else to the primary. Reads go to the primary instead when:
+
+  - the replica is further behind than max_staleness_seconds, or its lag couldn't be checked
+  - the replica pool can't hand out a connection
+  - the reading thread wrote to the primary within the last max_staleness_seconds, so it reads its own writes
+"""
+
+
+class ReplicaRoutingPool(object):
+    """ A DBConnPool look-alike that routes read-only checkouts between a primary and a replica pool. lag_check(conn)
+    returns how many seconds behind the primary a replica connection is (or None if it isn't replicating), and is run
+    on a background thread every check_interval_seconds. """
+
+    def __init__(self, primary, replica, lag_check, max_staleness_seconds=5, check_interval_seconds=5):
+        self.primary = primary
+        self.replica = replica
+        self.lag_check = lag_check
+        self.max_staleness_seconds = max_staleness_seconds
+        self.lock = threading.Lock()
+        self.__owners = {}  # id of a checked out conn -> the pool it came from
+        self.__writes = threading.local()
+        self.__replica_lag_seconds = None  # None until the replica's been checked and found to be replicating
+        self.__stats = {"replica_reads": 0, "primary_reads": 0, "replica_fallbacks": 0, "writes": 0}
+        self.check_replica_lag()
+        self.__stop_checking = threading.Event()
+        self.__checker = threading.Thread(target=self.__check_forever, args=(check_interval_seconds,))
+        self.__checker.daemon = True
+        self.__checker.start()
+
+    def __check_forever(self, interval_seconds):
+        while not self.__stop_checking.wait(interval_seconds):
+            self.check_replica_lag()
+
+    def check_replica_lag(self):
+        """ Re-checks how far behind the replica is. Returns the lag in seconds, or None if it can't be used. """
+        lag = None
+        conn = None
+        try:
+            conn = self.replica.get_conn(read_only=True)
+            lag = self.lag_check(conn)
+        except Exception as e:
+            logging.error("Couldn't check the read replica's lag: %s" % str(e))
+        finally:
+            if conn is not None:
+                self.replica.return_conn(conn)
+        if lag is None or lag > self.max_staleness_seconds:
+            logging.warning("Read replica lag is %s (tolerance %s seconds) - reading from the primary"
+                            % (str(lag), str(self.max_staleness_seconds)))
+        with self.lock:
+            self.__replica_lag_seconds = lag
+        return lag
+
+    def __replica_is_fresh(self):
+        with self.lock:
+            lag = self.__replica_lag_seconds
+        if lag is None or lag > self.max_staleness_seconds:
+            return False
+        last_write = getattr(self.__writes, "time", None)
+        return last_write is None or time.time() - last_write > self.max_staleness_seconds
+
+    def __check_out(self, pool, conn, stat):
+        with self.lock:
+            self.__owners[id(conn)] = pool
+            self.__stats[stat] += 1
+        return conn
+
+    def get_conn(self, read_only=False, timeout=None):
+        if read_only and self.__replica_is_fresh():
+            try:
+                return self.__check_out(self.replica, self.replica.get_conn(read_only=True), "replica_reads")
+            except Exception as e:
+                logging.error("Couldn't get a read replica connection, reading from the primary: %s" % str(e))
+                with self.lock:
+                    self.__stats["replica_fallbacks"] += 1
+        if not read_only:
+            self.__writes.time = time.time()
+        if timeout is None:
+            conn = self.primary.get_conn(read_only=read_only)
+        else:
+            conn = self.primary.get_conn(read_only=read_only, timeout=timeout)
+        return self.__check_out(self.primary, conn, "primary_reads" if read_only else "writes")
+
+    def return_conn(self, conn):
+        with self.lock:
+            pool = self.__owners.pop(id(conn), self.primary)
+        pool.return_conn(conn)
+
+    def stats(self):
+        """ The primary pool's stats, plus routing counters and the replica's last known lag (-1 if unusable). """
+        result = dict(self.primary.stats()) if hasattr(self.primary, "stats") else {}
+        with self.lock:
+            result.update(self.__stats)
+            result["replica_lag_seconds"] = -1 if self.__replica_lag_seconds is None else self.__replica_lag_seconds
+        return result
+
+    def close_all(self):
+        self.__stop_checking.set()
+        self.primary.close_all()
+        self.replica.close_all()
@@ -0,0 +1,88 @@
+-- the SQLite backend's schema: the same tables as schema.ddl with every migration in migrate.py applied
+-- SQLiteConnPool runs this when it opens a database, so every statement has to be safe to re-run
+-- timestamps are local time, like MySQL's now()
+
+create table if not exists deals (
+    id integer primary key autoincrement,
+    created timestamp default (datetime('now', 'localtime')),
+    product_name varchar(255),
+    product_description varchar(4095),
+    sale_price decimal(6,2),
+    brand_name varchar(64),
+    url varchar(128)
+);
+create index if not exists deals_created on deals (created);
+
+create table if not exists alerts (
+    id integer primary key autoincrement,
+    user_id int,
+    alert_name varchar(127),
+    search_terms varchar(1024),
+    created timestamp default (datetime('now', 'localtime')),
+    active int default 1,
+    version int not null default 1,
+    updated timestamp default (datetime('now', 'localtime'))
+);
+create index if not exists alerts_user_id_active on alerts (user_id, active);
+create index if not exists alerts_updated on alerts (updated);
+-- what MySQL's "on update current_timestamp" does for alerts.updated
+create trigger if not exists alerts_touch_updated after update on alerts for each row when new.updated is old.updated
+begin
+    update alerts set updated = datetime('now', 'localtime') where id = new.id;
+end;
+
+create table if not exists users (
+    id integer primary key autoincrement,
+    phone_number varchar(55),
+    username varchar(255) unique,
+    password varchar(514),
+    active int default 0,
+    unique (phone_number, username)
+);
+
+create table if not exists sent_alerts (
+    id integer primary key autoincrement,
+    user_id int,
+    deal_id int references deals(id),
+    alert_id int references alerts(id),
+    sent timestamp default (datetime('now', 'localtime'))
+);
+create index if not exists sent_alerts_deal_id on sent_alerts (deal_id);
+create index if not exists sent_alerts_user_id on sent_alerts (user_id);
+
+create table if not exists account_activation_keys (
+    id integer primary key autoincrement,
+    phone_number varchar(55),
+    activation_key varchar(128),
+    received int default 0,
+    created timestamp default (datetime('now', 'localtime'))
+);
+create index if not exists account_activation_keys_pn_key on account_activation_keys (phone_number, activation_key);
+create index if not exists account_activation_keys_created on account_activation_keys (created);
+
+create table if not exists alert_search_terms (
+    id integer primary key autoincrement,
+    alert_id int not null references alerts(id),
+    position int not null,
+    search_term varchar(1024),
+    normalized_term varchar(255)
+);
+create index if not exists alert_search_terms_alert_id on alert_search_terms (alert_id, position);
+create index if not exists alert_search_terms_normalized_term on alert_search_terms (normalized_term);
+
+create table if not exists sent_alert_counts (
+    user_id int not null,
+    day date not null,
+    sent_count int not null default 0,
+    primary key (user_id, day)
+);
+create index if not exists sent_alert_counts_day on sent_alert_counts (day);
+
+create table if not exists alert_match_results (
+    deal_id int not null,
+    alert_id int not null,
+    alert_version int not null,
+    scoring_version int not null,
+    matched int not null,
+    primary key (deal_id, alert_id)
+);
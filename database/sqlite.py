@@ -0,0 +1,188 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from mysql import DBConnPool
+
+"""
+SQLite backend for Model, for single-node instances and running the tests without a MySQL server. Model's SQL is
+written for MySQL/pymysql, so connections from this pool wrap sqlite3's to look like pymysql's: %s placeholders and
+the few MySQL-only expressions Model uses are rewritten as statements are executed, connections are in autocommit
+mode until begin() is called, and execute() returns the affected row count.
+
+Needs SQLite 3.35 or later, for "on conflict do update" without a conflict target (what Model's "on duplicate key
+update" upserts become).
+"""
+
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+SCHEMA_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema_sqlite.sql")
+
+_NOW_MINUS_MINUTES = re.compile(r"now\(\)\s*-\s*interval\s+%s\s+minute", re.IGNORECASE)
+_CURRENT_DATE_MINUS_DAYS = re.compile(r"current_date\s*-\s*interval\s+%s\s+day", re.IGNORECASE)
+_CURRENT_DATE = re.compile(r"\bcurrent_date\b", re.IGNORECASE)
+_ON_DUPLICATE_KEY_UPDATE = re.compile(r"\bon\s+duplicate\s+key\s+update\b", re.IGNORECASE)
+_VALUES_OF_COLUMN = re.compile(r"\bvalues\((\w+)\)", re.IGNORECASE)
+_UPDATE_TABLE = re.compile(r"^\s*update\s+(\w+)\s", re.IGNORECASE)
+
+_translated_sql = {}  # MySQL statement -> SQLite statement, since Model runs the same few over and over
+_translated_sql_lock = threading.Lock()
+_TRANSLATED_SQL_CACHE_SIZE = 1000
+
+
+def translate_sql(sql):
+    """ Rewrites one of Model's MySQL statements for SQLite. """
+    with _translated_sql_lock:
+        translated = _translated_sql.get(sql)
+    if translated is not None:
+        return translated
+    translated = _NOW_MINUS_MINUTES.sub("datetime('now', 'localtime', '-' || %s || ' minutes')", sql)
+    translated = _CURRENT_DATE_MINUS_DAYS.sub("date('now', 'localtime', '-' || %s || ' days')", translated)
+    translated = _CURRENT_DATE.sub("date('now', 'localtime')", translated)  # SQLite's current_date is UTC
+    m = _ON_DUPLICATE_KEY_UPDATE.search(translated)
+    if m is not None:
+        upsert = _VALUES_OF_COLUMN.sub(r"excluded.\1", translated[m.end():])
+        translated = translated[:m.start()] + "on conflict do update set" + upsert
+    m = _UPDATE_TABLE.match(translated)
+    if m is not None:
+        # SQLite doesn't allow "set table.column = ..." - and an update only has the one table to qualify with
+        translated = re.sub(r"\b%s\." % m.group(1), "", translated)
+    translated = translated.replace("%s", "?")
+    with _translated_sql_lock:
+        if len(_translated_sql) >= _TRANSLATED_SQL_CACHE_SIZE:
+            _translated_sql.clear()
+        _translated_sql[sql] = translated
+    return translated
+
+
+def _as_params(params):
+    # pymysql takes a lone value where sqlite3 needs a sequence
+    if params is None:
+        return ()
+    if isinstance(params, (tuple, list, dict)):
+        return params
+    return (params,)
+
+
+class SQLiteCursor(object):
+    """ A sqlite3 cursor that takes Model's MySQL statements. """
+
+    def __init__(self, cursor):
+        self.__cursor = cursor
+
+    def execute(self, sql, params=None):
+        self.__cursor.execute(translate_sql(sql), _as_params(params))
+        return self.__cursor.rowcount
+
+    def executemany(self, sql, rows):
+        self.__cursor.executemany(translate_sql(sql), [_as_params(r) for r in rows])
+        return self.__cursor.rowcount
+
+    def fetchone(self):
+        return self.__cursor.fetchone()
+
+    def fetchmany(self, size):
+        return self.__cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.__cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.__cursor)
+
+    @property
+    def lastrowid(self):
+        return self.__cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.__cursor.rowcount
+
+    @property
+    def description(self):
+        return self.__cursor.description
+
+    def close(self):
+        self.__cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SQLiteConnection(object):
+    """ A sqlite3 connection that behaves like an autocommit pymysql one: every statement commits on its own unless
+    it's between begin() and commit()/rollback(). """
+
+    def __init__(self, conn):
+        self.__conn = conn
+        self.__in_transaction = False
+
+    def cursor(self):
+        return SQLiteCursor(self.__conn.cursor())
+
+    def begin(self):
+        # take the write lock up front, so a transaction never has to upgrade a read lock (which can't wait it out)
+        self.__conn.execute("begin immediate")
+        self.__in_transaction = True
+
+    def commit(self):
+        if self.__in_transaction:
+            self.__in_transaction = False
+            self.__conn.execute("commit")
+
+    def rollback(self):
+        if self.__in_transaction:
+            self.__in_transaction = False
+            self.__conn.execute("rollback")
+
+    def ping(self, reconnect=False):
+        self.__conn.execute("select 1").fetchall()
+
+    def close(self):
+        self.__conn.close()
+
+
+class SQLiteConnPool(DBConnPool):
+    """ DBConnPool for one SQLite database file, in WAL mode so that readers don't block the writer (or each other).
+    Creates the schema on first use. Writers still take turns - each waits up to busy_timeout_seconds for the lock. """
+
+    def __init__(self, db_file_path, conn_count=5, busy_timeout_seconds=30, **kwargs):
+        if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+            raise RuntimeError("The SQLite backend needs SQLite %s or later, and this is %s"
+                               % (".".join(str(v) for v in MIN_SQLITE_VERSION), sqlite3.sqlite_version))
+        self.db_file_path = db_file_path
+        self.busy_timeout_seconds = busy_timeout_seconds
+        self.__create_schema()
+        super(SQLiteConnPool, self).__init__(conn_count=conn_count, **kwargs)
+
+    def __connect(self):
+        conn = sqlite3.connect(
+            self.db_file_path,
+            timeout=self.busy_timeout_seconds,
+            isolation_level=None,  # we issue our own begin/commit, see SQLiteConnection
+            detect_types=sqlite3.PARSE_DECLTYPES,  # timestamp columns come back as datetimes, like with pymysql
+            check_same_thread=False  # pooled connections move between (but are never shared by) threads
+        )
+        conn.execute("pragma foreign_keys = on")
+        conn.execute("pragma synchronous = normal")  # durable enough in WAL mode, and much cheaper than full
+        return conn
+
+    def __create_schema(self):
+        conn = self.__connect()
+        try:
+            # WAL mode is a property of the database file, so this sticks for every later connection
+            mode = conn.execute("pragma journal_mode = wal").fetchall()[0][0]
+            if mode.lower() != "wal":
+                logging.warning("Couldn't put %s in WAL mode - it's in %s mode" % (self.db_file_path, mode))
+            with open(SCHEMA_FILE_PATH) as f:
+                conn.executescript(f.read())
+        finally:
+            conn.close()
+
+    def _new_db_conn(self):
+        return SQLiteConnection(self.__connect())
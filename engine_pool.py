@@ -0,0 +1,67 @@
+import logging
+
+import forecasting
+import spellchecking
+from utils.worker_pool import BoundedProcessPool
+
+"""
+The spellchecking and forecasting engines are pure CPU work over in-memory data. These helpers run them either
+in-process or, through EnginePool, in worker processes which each load their own copy of the engines' data.
+"""
+
+# each worker process' own engines, built once by _init_worker
+_spellchecker = None
+_forecaster = None
+
+
+def correct_all(service, search_terms):
+    """ Returns a list of spelling-corrected search terms, in the same order. """
+    recommendations = []
+    for st in search_terms:
+        recommended_alt = service.try_to_correct(st)
+        if recommended_alt is None:
+            recommended_alt = st  # same string as input, if we couldn't make an improvement
+        recommendations.append(recommended_alt)
+    return recommendations
+
+
+def count_all(service, search_terms):
+    """ Returns a dict mapping each search term (and all of them combined) to its recent match count. """
+    counts = {}
+    for st in search_terms:
+        counts[st] = service.get_count_for(st)
+    counts["(all of them combined)"] = service.get_count_for_all(search_terms)
+    return counts
+
+
+def _init_worker():
+    global _spellchecker, _forecaster
+    logging.info("Loading spellchecking and forecasting engines in worker process")
+    _spellchecker = spellchecking.SpellcheckingService()
+    _forecaster = forecasting.ForecastingService()
+
+
+def _correct_all_in_worker(search_terms):
+    return correct_all(_spellchecker, search_terms)
+
+
+def _count_all_in_worker(search_terms):
+    return count_all(_forecaster, search_terms)
+
+
+class EnginePool(BoundedProcessPool):
+    """ Runs spellchecking and forecasting requests in worker processes (see BoundedProcessPool). """
+
+    def __init__(self, processes=2, max_pending=32, timeout_seconds=30):
+        super(EnginePool, self).__init__(
+            processes=processes,
+            max_pending=max_pending,
+            timeout_seconds=timeout_seconds,
+            initializer=_init_worker
+        )
+
+    def correct_all(self, search_terms):
+        return self.run(_correct_all_in_worker, search_terms)
+
+    def count_all(self, search_terms):
+        return self.run(_count_all_in_worker, search_terms)
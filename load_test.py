@@ -0,0 +1,89 @@
+import argparse
+import threading
+import time
+
+import requests
+
+"""
+Simple concurrent load generator for the JSON API. To compare serving configurations (e.g. ENGINE_POOL_PROCESSES
+set to 0 vs. a few workers, or different WEB_THREAD_POOL_SIZEs), restart the web service with each config and run
+the same command against it, e.g.:
+
+    python load_test.py --user my_user --password my_password --endpoint spellcheck --concurrency 20
+
+It prints throughput, error count, and latency percentiles for the run.
+"""
+
+REQUEST_BODIES = {
+    "alerts": None,
+    "spellcheck": ["arcterx", "pallm leaf rofs", "breathable hiking pnts"],
+    "forecast": ["palisade pants", "provide", "down jacket"],
+}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_worker(url, auth, body, request_count, latencies, errors, lock):
+    session = requests.Session()
+    session.auth = auth
+    for x in range(request_count):
+        start = time.time()
+        try:
+            if body is None:
+                resp = session.get(url)
+            else:
+                resp = session.post(url, json=body)
+            failed = resp.status_code >= 400
+        except Exception:
+            failed = True
+        elapsed = time.time() - start
+        with lock:
+            latencies.append(elapsed)
+            if failed:
+                errors.append(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test one watchsac API endpoint")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--endpoint", choices=sorted(REQUEST_BODIES.keys()), default="alerts")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests-per-client", type=int, default=100)
+    args = parser.parse_args()
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    url = args.url + "/" + args.endpoint
+    threads = [
+        threading.Thread(
+            target=run_worker,
+            args=(url, (args.user, args.password), REQUEST_BODIES[args.endpoint], args.requests_per_client,
+                  latencies, errors, lock)
+        )
+        for x in range(args.concurrency)
+    ]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    print("endpoint:    %s" % url)
+    print("requests:    %d (%d errors)" % (len(latencies), len(errors)))
+    print("throughput:  %.1f req/s" % (len(latencies) / elapsed))
+    for pct in (50, 95, 99):
+        print("p%d latency: %.1f ms" % (pct, percentile(latencies, pct) * 1000.0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+In-process request/latency metrics, rendered in the Prometheus text exposition format.
+Latencies are kept in fixed buckets and reported as summaries with estimated p50/p95/p99.
+"""
+
+LATENCY_BUCKETS_SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class LatencyHistogram(object):
+    """ Bucketed latency observations. Not thread-safe on its own - the registry locks around it. """
+
+    def __init__(self, buckets=LATENCY_BUCKETS_SECONDS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot counts everything past the largest bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """ Estimates the q-th quantile by interpolating linearly inside the bucket it falls in. """
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for i, bucket_count in enumerate(self.counts):
+            if bucket_count > 0 and cumulative + bucket_count >= target:
+                lower = 0.0 if i == 0 else self.buckets[i - 1]
+                upper = self.max if i == len(self.buckets) else min(self.buckets[i], self.max)
+                return lower + (upper - lower) * (target - cumulative) / float(bucket_count)
+            cumulative += bucket_count
+        return self.max
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append('%s="%s"' % (k, v))
+    return "{" + ",".join(parts) + "}"
+
+
+class MetricsRegistry(object):
+    """ Thread-safe store of counters and latency histograms, keyed by metric name and label set. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.__counters = {}  # name -> {sorted label tuple -> count}
+        self.__histograms = {}  # name -> {sorted label tuple -> LatencyHistogram}
+        self.__help = {}
+        self.__gauge_collectors = []
+        self.__counter_collectors = []
+
+    def describe(self, name, help_text):
+        self.__help[name] = help_text
+
+    def increment(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.__counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.__histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = LatencyHistogram()
+            series[key].observe(seconds)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """ Records the time spent in the with block as one observation. """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def add_gauge_collector(self, collector):
+        """ collector() is called at render time and returns a list of (name, labels dict, value) gauges. """
+        self.__gauge_collectors.append(collector)
+
+    def add_counter_collector(self, collector):
+        """ Like add_gauge_collector, for values kept elsewhere that only ever go up - rendered as counters. """
+        self.__counter_collectors.append(collector)
+
+    def get_counter(self, name, **labels):
+        with self.lock:
+            return self.__counters.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def get_histogram(self, name, **labels):
+        with self.lock:
+            return self.__histograms.get(name, {}).get(tuple(sorted(labels.items())))
+
+    def render(self):
+        """ Returns everything in the Prometheus text exposition format. """
+        lines = []
+        with self.lock:
+            for name in sorted(self.__counters):
+                self.__render_header(lines, name, "counter")
+                for key, value in sorted(self.__counters[name].items()):
+                    lines.append("%s%s %d" % (name, _format_labels(key), value))
+            for name in sorted(self.__histograms):
+                self.__render_header(lines, name, "summary")
+                for key, histogram in sorted(self.__histograms[name].items()):
+                    for q in QUANTILES:
+                        labels = _format_labels(tuple(sorted(key + (("quantile", q),))))
+                        lines.append("%s%s %f" % (name, labels, histogram.quantile(q)))
+                    lines.append("%s_sum%s %f" % (name, _format_labels(key), histogram.sum))
+                    lines.append("%s_count%s %d" % (name, _format_labels(key), histogram.count))
+        self.__render_collected(lines, self.__counter_collectors, "counter")
+        self.__render_collected(lines, self.__gauge_collectors, "gauge")
+        return "\n".join(lines) + "\n"
+
+    def __render_collected(self, lines, collectors, metric_type):
+        collected = {}
+        for collector in collectors:
+            for name, labels, value in collector():
+                collected.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+        for name in sorted(collected):
+            self.__render_header(lines, name, metric_type)
+            for key, value in sorted(collected[name]):
+                lines.append("%s%s %f" % (name, _format_labels(key), value))
+
+    def __render_header(self, lines, name, metric_type):
+        if name in self.__help:
+            lines.append("# HELP %s %s" % (name, self.__help[name]))
+        lines.append("# TYPE %s %s" % (name, metric_type))
+
+
+class TimedProxy(object):
+    """ Wraps an object so that every public method call on it is timed into a registry histogram,
+    labelled with the method name. """
+
+    def __init__(self, target, registry, metric_name):
+        self.__target = target
+        self.__registry = registry
+        self.__metric_name = metric_name
+
+    def __getattr__(self, attr):
+        value = getattr(self.__target, attr)
+        if attr.startswith("_") or not callable(value):
+            return value
+        registry = self.__registry
+        metric_name = self.__metric_name
+
+        def timed_call(*args, **kwargs):
+            with registry.timed(metric_name, method=attr):
+                return value(*args, **kwargs)
+        return timed_call
+
+
+# the web service's registry
+registry = MetricsRegistry()
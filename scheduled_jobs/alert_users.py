@@ -1,16 +1,41 @@
+import argparse
+import datetime
 import logging
-
-from fuzzywuzzy import fuzz
+import signal
+import threading
+import time
 
 import sms
+from alert_matching import SCORING_VERSION, AlertIndex, MatchingEngine
+from utils import properties
 from database.model import Model
 
 """
 This process loads active alerts, determines whether these alerts
 match the latest current steal in our DB, and sends messages as necessary.
+
+Run with --daemon, it stays up instead: it keeps the alerts (and what's been sent for the current steal) in memory,
+picks up alert changes as they happen, and evaluates as soon as a new deal is saved - see AlertDaemon.
 """
 
-logging.basicConfig(filename='alert_users.log', level=logging.DEBUG)
+# sent alerts are recorded this many at a time - small enough that a crash mid-run loses few records (and so
+# re-sends few texts on the next run), big enough to save most of the per-row round trips and commits
+SENT_ALERTS_RECORD_BATCH_SIZE = 50
+
+# no user gets more than this many alerts in any window of this many days (counting today)
+SENT_ALERTS_CAP = 3
+SENT_ALERTS_CAP_WINDOW_DAYS = 1
+
+# in daemon mode: how often to check for a new deal and changed alerts, how far back to re-read alert changes (so
+# that ones committed late, with an earlier timestamp, aren't missed), and how often to reload every alert from
+# scratch and re-evaluate them all (which also retries failed sends, and picks up users' new phone numbers)
+DAEMON_POLL_INTERVAL_SECONDS = 2
+DAEMON_ALERT_CHANGES_OVERLAP_SECONDS = 60
+DAEMON_FULL_RELOAD_INTERVAL_SECONDS = 600
+
+
+# keeps search terms' tokens around between deals (and runs, once this runs as a long-lived process)
+matching_engine = MatchingEngine()
 
 
 def filter_alerts_by_previously_sent(all_active_alerts, previously_sent_alert_ids):
@@ -27,56 +52,236 @@ def filter_alerts_by_previously_sent(all_active_alerts, previously_sent_alert_id
     return filtered_alerts
 
 
-def filter_alerts_by_current_steal_is_relevant(all_active_alerts, current_steal):
-    """ Returns a list of Alerts. """
+def filter_alerts_by_current_steal_is_relevant(all_active_alerts, current_steal, alert_index=None):
+    """ Returns a list of Alerts. Given an AlertIndex of the alerts, only scores the ones that could match. """
     logging.info("Filtering alerts by relevance...")
     logging.info("All active alerts: %s" % str(all_active_alerts))
     logging.info("Current steal deal ID: %s" % str(current_steal.deal_id))
-    filtered_alerts = []
+    # an alert's search terms must average > 90 token_set_ratio against the description, with one > 90 against the
+    # name - see alert_matching
+    return matching_engine.filter_relevant(
+        all_active_alerts,
+        current_steal,
+        alert_index=alert_index,
+        processes=properties.ALERT_SCORING_PROCESSES,
+        timeout_seconds=properties.ALERT_SCORING_TIMEOUT_SECONDS
+    )
+
+
+def filter_alerts_by_match_results(all_active_alerts, current_steal, model, alert_index=None):
+    """ Returns a list of the Alerts that match the current steal, like filter_alerts_by_current_steal_is_relevant -
+    but reusing what earlier runs found for this deal, so that only alerts created or edited since then (or scored by
+    other matching rules) get scored. Saves the new results for the next run. Indexes the alerts to score, unless
+    given an AlertIndex of them. """
+    deal_id = current_steal.deal_id
+    match_results = model.load_alert_match_results(deal_id, [a.alert_id for a in all_active_alerts])
+    if match_results is None:
+        logging.error("Couldn't load alert match results - scoring every alert")
+        match_results = {}
+    matching_ids = set()
+    unscored_alerts = []
     for alert in all_active_alerts:
-        search_term_desc_scores = [fuzz.token_set_ratio(search_term, current_steal.product_description) for search_term in alert.search_terms]
-        avg_search_term__desc_score = float(sum(search_term_desc_scores)) / float(len(search_term_desc_scores))
-        top_search_term_title_score = float(max([fuzz.token_set_ratio(search_term, current_steal.product_name) for search_term in alert.search_terms]))
-        if avg_search_term__desc_score > 90.0 and top_search_term_title_score > 90.0:
-            filtered_alerts.append(alert)
-    return filtered_alerts
+        result = match_results.get(alert.alert_id)
+        if alert.version is not None and result is not None and result[:2] == (alert.version, SCORING_VERSION):
+            if result[2]:
+                matching_ids.add(alert.alert_id)
+        else:
+            unscored_alerts.append(alert)
+    logging.info("Reusing match results for %d alerts, scoring %d"
+                 % (len(all_active_alerts) - len(unscored_alerts), len(unscored_alerts)))
+    if len(unscored_alerts) > 0:
+        if alert_index is None:
+            alert_index = AlertIndex(matching_engine, unscored_alerts)
+        newly_matching_ids = set(a.alert_id for a in filter_alerts_by_current_steal_is_relevant(
+            unscored_alerts, current_steal, alert_index))
+        matching_ids.update(newly_matching_ids)
+        model.save_alert_match_results(deal_id, SCORING_VERSION, [
+            (a.alert_id, a.version, a.alert_id in newly_matching_ids) for a in unscored_alerts if a.version is not None
+        ])
+    return [alert for alert in all_active_alerts if alert.alert_id in matching_ids]
 
 
-def send_and_record_alerts(alerts_to_send, current_steal, model):
-    """ Sends out text messages and records each one sent out in the DB. """
-    sms_client = sms.TwilioSMSClient()
+def send_and_record_alerts(alerts_to_send, current_steal, model, batch_size=SENT_ALERTS_RECORD_BATCH_SIZE,
+                           sms_client=None):
+    """ Sends out text messages and records the ones sent out in the DB, a batch at a time. Returns the sent Alerts. """
+    if sms_client is None:
+        sms_client = sms.TwilioSMSClient()
+    all_sent_alerts = []
+    sent_alerts = []
     for alert in alerts_to_send:
         if sms_client.send_alert(alert):
-            model.save_sent_alert(alert, current_steal.deal_id)
+            sent_alerts.append(alert)
+            all_sent_alerts.append(alert)
+            if len(sent_alerts) >= batch_size:
+                model.save_sent_alerts(sent_alerts, current_steal.deal_id)
+                sent_alerts = []
+    if len(sent_alerts) > 0:
+        model.save_sent_alerts(sent_alerts, current_steal.deal_id)
+    return all_sent_alerts
 
 
-def filter_alerts_by_phone_number_cap(alerts_to_send, sent_counts_by_user_id):
+def filter_alerts_by_phone_number_cap(alerts_to_send, sent_counts_by_user_id, cap=SENT_ALERTS_CAP):
+    """ Drops alerts that would take their user over the cap. Users missing from the counts haven't been sent any. """
     filtered_alerts_to_send = []
     for alert in alerts_to_send:
-        if alert.user_id in sent_counts_by_user_id:
-            if sent_counts_by_user_id[alert.user_id] < 3:
-                filtered_alerts_to_send.append(alert)
-                sent_counts_by_user_id[alert.user_id] += 1
+        sent_count = sent_counts_by_user_id.get(alert.user_id, 0)
+        if sent_count < cap:
+            filtered_alerts_to_send.append(alert)
+            sent_counts_by_user_id[alert.user_id] = sent_count + 1
     return filtered_alerts_to_send
 
 
+class AlertDaemon(object):
+    """ The alerting job as a long-running process. Keeps the active alerts indexed in memory and applies changes to
+    them as they're made (see Model.load_alerts_changed_since), and remembers which alerts it's sent for the current
+    steal. Each tick() is then a couple of small reads unless there's something new to evaluate - a new deal (every
+    alert is evaluated against it), or new or edited alerts (just those are evaluated against the current steal).
+    The model should check_current_steal_version, so that new deals are seen straight away. """
+
+    def __init__(self, model, sms_client=None, full_reload_interval_seconds=DAEMON_FULL_RELOAD_INTERVAL_SECONDS):
+        self.model = model
+        self.sms_client = sms_client
+        self.full_reload_interval_seconds = full_reload_interval_seconds
+        self.alerts = {}  # alert ID -> active Alert
+        self.alert_index = AlertIndex(matching_engine)
+        self.changes_since = None  # the latest alerts.updated we've seen
+        self.last_full_reload = None
+        self.current_steal = None
+        self.sent_alert_ids = set()  # alerts already sent for the current steal
+        self.retry_alert_ids = set()  # alerts that matched the current steal but failed to send - retried every tick
+
+    def reload_alerts(self):
+        """ Replaces the in-memory alerts with every active alert in the DB. """
+        alerts = self.model.load_all_active_alerts_with_phone_numbers()
+        self.alerts = dict((alert.alert_id, alert) for alert in alerts)
+        self.alert_index = AlertIndex(matching_engine, alerts)
+        self.changes_since = max([a.updated for a in alerts if a.updated is not None] or [datetime.datetime(1970, 1, 1)])
+        self.last_full_reload = time.time()
+        logging.info("Loaded %d active alerts" % len(alerts))
+
+    def apply_alert_changes(self):
+        """ Applies alerts created, edited or archived since the last check. Returns the new and edited ones. """
+        changed = self.model.load_alerts_changed_since(
+            self.changes_since - datetime.timedelta(seconds=DAEMON_ALERT_CHANGES_OVERLAP_SECONDS)
+        )
+        if changed is None:
+            return []
+        fresh = []
+        for alert in changed:
+            if alert.updated is not None:
+                self.changes_since = max(self.changes_since, alert.updated)
+            known = self.alerts.get(alert.alert_id)
+            if not alert.active:
+                if known is not None:
+                    del self.alerts[alert.alert_id]
+                    self.alert_index.remove_alert(alert.alert_id)
+            elif known is None or known.version != alert.version:
+                self.alerts[alert.alert_id] = alert
+                self.alert_index.add_alert(alert)
+                fresh.append(alert)
+        if len(fresh) > 0:
+            logging.info("Picked up %d new or edited alerts" % len(fresh))
+        return fresh
+
+    def tick(self):
+        """ Checks for a new deal and changed alerts, and sends whatever alerts that calls for. Returns the sent Alerts. """
+        if self.last_full_reload is None or time.time() - self.last_full_reload > self.full_reload_interval_seconds:
+            self.reload_alerts()
+            to_evaluate = self.alerts.values()
+        else:
+            to_evaluate = self.apply_alert_changes()
+        current_steal = self.model.load_current_steal()
+        if current_steal is None:
+            return []
+        if self.current_steal is None or current_steal.deal_id != self.current_steal.deal_id:
+            logging.info("Evaluating alerts for new current steal, deal ID %s" % str(current_steal.deal_id))
+            self.current_steal = current_steal
+            self.sent_alert_ids = set(self.model.load_sent_alerts_by_deal_id(current_steal.deal_id))
+            self.retry_alert_ids = set()
+            # the results saved for the deals before this one won't be used again
+            self.model.purge_alert_match_results_before(current_steal.deal_id)
+            to_evaluate = self.alerts.values()
+        else:
+            to_evaluate = dict((a.alert_id, a) for a in to_evaluate)
+            for alert_id in self.retry_alert_ids:
+                if alert_id in self.alerts:
+                    to_evaluate.setdefault(alert_id, self.alerts[alert_id])
+            to_evaluate = to_evaluate.values()
+        return self.evaluate(to_evaluate)
+
+    def evaluate(self, alerts):
+        """ Sends (and records) the alerts that match the current steal and haven't been sent for it. Ones that match
+        but fail to send are kept for retrying. """
+        self.retry_alert_ids.difference_update(a.alert_id for a in alerts)
+        alerts = filter_alerts_by_previously_sent(sorted(alerts, key=lambda a: a.alert_id), self.sent_alert_ids)
+        if len(alerts) == 0:
+            return []
+        alerts = filter_alerts_by_match_results(alerts, self.current_steal, self.model, self.alert_index)
+        if len(alerts) == 0:
+            return []
+        sent_alerts_counts = self.model.load_recent_sent_alert_counts_by_user_id(SENT_ALERTS_CAP_WINDOW_DAYS)
+        if sent_alerts_counts is None:
+            raise Exception("Couldn't load sent alert counts - not sending anything uncapped")
+        alerts = filter_alerts_by_phone_number_cap(alerts, sent_alerts_counts)
+        sent_alerts = send_and_record_alerts(alerts, self.current_steal, self.model, sms_client=self.sms_client)
+        self.sent_alert_ids.update(a.alert_id for a in sent_alerts)
+        self.retry_alert_ids.update(a.alert_id for a in alerts if a.alert_id not in self.sent_alert_ids)
+        if len(self.retry_alert_ids) > 0:
+            logging.warning("%d matching alerts failed to send - retrying next tick" % len(self.retry_alert_ids))
+        return sent_alerts
+
+
+def run_daemon(poll_interval_seconds=DAEMON_POLL_INTERVAL_SECONDS):
+    """ Runs an AlertDaemon until interrupted, or until SIGTERM (from a supervisor, say). """
+    daemon = AlertDaemon(Model(check_current_steal_version=True))
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    logging.info("Alert daemon started - polling every %s seconds" % str(poll_interval_seconds))
+    try:
+        while not stopping.is_set():
+            try:
+                daemon.tick()
+            except Exception as e:
+                logging.exception(e)
+            stopping.wait(poll_interval_seconds)
+    except KeyboardInterrupt:
+        pass
+    logging.info("Alert daemon stopping")
+    logging.info("DB time by DAO method:\n%s" % daemon.model.query_stats.summary())
+
+
 def main():
     """ Exit 0 on success, 1 on failure. """
+    logging.basicConfig(filename='alert_users.log', level=logging.DEBUG)
+    parser = argparse.ArgumentParser(description="Send out alerts matching the current steal")
+    parser.add_argument("--daemon", action="store_true", help="keep running, and send alerts as deals come in")
+    parser.add_argument("--poll-interval-seconds", type=float, default=DAEMON_POLL_INTERVAL_SECONDS)
+    args = parser.parse_args()
+    if args.daemon:
+        run_daemon(args.poll_interval_seconds)
+        return 0
     exit_code = 0
+    model = None
     try:
         model = Model()
         all_active_alerts = model.load_all_active_alerts_with_phone_numbers()
         current_steal = model.load_current_steal()
-        sent_alerts_counts = model.load_sent_alerts_count_by_user_id()
+        sent_alerts_counts = model.load_recent_sent_alert_counts_by_user_id(SENT_ALERTS_CAP_WINDOW_DAYS)
+        if sent_alerts_counts is None:
+            raise Exception("Couldn't load sent alert counts - not sending anything uncapped")
         if current_steal is not None:
             previously_sent_alert_ids = model.load_sent_alerts_by_deal_id(current_steal.deal_id)
             alerts_to_send = filter_alerts_by_previously_sent(all_active_alerts, previously_sent_alert_ids)
-            alerts_to_send = filter_alerts_by_current_steal_is_relevant(alerts_to_send, current_steal)
+            if model.has_alert_match_results_before(current_steal.deal_id):
+                model.purge_alert_match_results_before(current_steal.deal_id)
+            alerts_to_send = filter_alerts_by_match_results(alerts_to_send, current_steal, model)
             alerts_to_send = filter_alerts_by_phone_number_cap(alerts_to_send, sent_alerts_counts)
             send_and_record_alerts(alerts_to_send, current_steal, model)
     except Exception as e:
         logging.error(e)
         exit_code = 1
+    if model is not None:
+        logging.info("DB time by DAO method:\n%s" % model.query_stats.summary())
     return exit_code
 
 
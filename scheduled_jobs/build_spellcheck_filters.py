@@ -24,6 +24,7 @@ NOTE: removed CM-sketch - not scaling well, need a different approach
 """
 
 DAYS_BACK_TO_LOAD_DEALS = 14
+DEALS_LOAD_BATCH_SIZE = 200
 UP_TO_K_MOST_FREQUENT_PHRASES = 1000000
 TEMP_SQLITE_BLOOM_BUILDER_FILE_PATH = properties.SEARCH_TERMS_SUGGESTION_TEMP_DB_FILE_PATH
 SPELLCHECK_FILTERS_OUTPUT_DIR = properties.SEARCH_TERMS_SUGGESTION_BLOOM_FILTER_OUTPUT_DIR
@@ -48,9 +49,12 @@ def set_up_temp_db():
 
 
 def load_recent_deals():
+    """ Yields the recent deals, streamed from the DB a batch at a time. """
     model = Model()
-    deals = model.load_all_steals_since(datetime.utcnow() - timedelta(days=DAYS_BACK_TO_LOAD_DEALS))
-    return deals
+    return model.iter_steals_since(
+        datetime.utcnow() - timedelta(days=DAYS_BACK_TO_LOAD_DEALS),
+        batch_size=DEALS_LOAD_BATCH_SIZE
+    )
 
 
 def get_all_phrases_for(deal):
@@ -0,0 +1,26 @@
+import logging
+
+from database.model import Model
+
+"""
+This process deletes expired account activation keys, so the table stays small as signups accumulate.
+"""
+
+logging.basicConfig(filename='purge_activation_keys.log', level=logging.DEBUG)
+
+
+def main():
+    """ Exit 0 on success, 1 on failure. """
+    exit_code = 0
+    try:
+        model = Model()
+        if model.purge_expired_activation_keys() is None:
+            exit_code = 1
+    except Exception as e:
+        logging.error(e)
+        exit_code = 1
+    return exit_code
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,60 +1,138 @@
-import threading
-from datetime import datetime, timedelta
+import heapq
 import logging
+import threading
+import time
 
 
-class TokenManager(object):
+class _TokenShard(object):
+    """ One lock-protected slice of the token store, with a min-heap of expiration times for cheap eviction. """
 
     def __init__(self):
-        self.__tokens_to_users_and_timestamps = {}
         self.lock = threading.Lock()
+        self.tokens = {}  # token -> (expiration time, username, password)
+        self.expirations = []  # heap of (expiration time, token) - may hold stale entries for re-set tokens
+        self.evictions = 0
+        self.lock_wait_seconds = 0.0
 
-    def __clean_cache(self):
-        try:
-            self.lock.acquire()
-            new_dict = {}
-            for token in self.__tokens_to_users_and_timestamps:
-                pair = self.__tokens_to_users_and_timestamps[token]
-                ts = pair[0]
-                if ts > datetime.utcnow():  # still fresh enough
-                    new_dict[token] = pair
-            self.__tokens_to_users_and_timestamps = new_dict
-        finally:
-            self.lock.release()
+    def acquire(self):
+        start = time.time()
+        self.lock.acquire()
+        self.lock_wait_seconds += time.time() - start
+
+    def release(self):
+        self.lock.release()
+
+    def evict_expired(self, now, max_evictions=None):
+        """ Pops expired tokens off the top of the heap - must be called with the lock held. Returns the count. """
+        evicted = 0
+        while self.expirations and self.expirations[0][0] <= now:
+            if max_evictions is not None and evicted >= max_evictions:
+                break
+            expires, token = heapq.heappop(self.expirations)
+            entry = self.tokens.get(token)
+            if entry is not None and entry[0] == expires:  # otherwise the token was re-set with a later expiration
+                del self.tokens[token]
+                evicted += 1
+        self.evictions += evicted
+        return evicted
+
+
+class TokenManager(object):
+    """ In-memory store of session tokens, striped across several locks so that concurrent requests rarely
+    contend. Expired tokens are evicted a few at a time as new ones are set, and optionally by a sweeper thread. """
+
+    EVICTIONS_PER_SET = 8
+
+    def __init__(self, shard_count=16, sweep_interval_seconds=None, token_lifetime_seconds=15 * 60):
+        self.token_lifetime_seconds = token_lifetime_seconds
+        self.__shards = [_TokenShard() for x in range(shard_count)]
+        self.__sweeper = None
+        self.__stop_sweeping = threading.Event()
+        if sweep_interval_seconds is not None:
+            self.__sweeper = threading.Thread(target=self.__sweep_forever, args=(sweep_interval_seconds,))
+            self.__sweeper.daemon = True
+            self.__sweeper.start()
+
+    def __shard_for(self, token):
+        return self.__shards[hash(token) % len(self.__shards)]
+
+    def __sweep_forever(self, interval_seconds):
+        while not self.__stop_sweeping.wait(interval_seconds):
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.exception(e)
+
+    def sweep(self):
+        """ Evicts every expired token from every shard. Returns the number evicted. """
+        now = time.time()
+        evicted = 0
+        for shard in self.__shards:
+            shard.acquire()
+            try:
+                evicted += shard.evict_expired(now)
+            finally:
+                shard.release()
+        if evicted > 0:
+            logging.debug("Token sweep evicted %d expired tokens" % evicted)
+        return evicted
+
+    def stop(self):
+        """ Stops the background sweeper thread, if there is one. """
+        self.__stop_sweeping.set()
+        if self.__sweeper is not None:
+            self.__sweeper.join()
+            self.__sweeper = None
 
     def is_token_good(self, token):
-        # purge our check our in-memory token store, then check to see if this token is OK
-        # returns the user name if ok
-        logging.info("Checking token %s" % (token,))
+        # check our in-memory token store to see if this token is OK
+        # returns the user name and password if ok
+        shard = self.__shard_for(token)
+        shard.acquire()
         try:
-            self.lock.acquire()
-            if token in self.__tokens_to_users_and_timestamps:
-                user_and_ts = self.__tokens_to_users_and_timestamps[token]
-                our_expiration_ts = user_and_ts[0]
-                our_user = user_and_ts[1]
-                our_pwd = user_and_ts[2]
-                # if they have a correct token and the expiration time that we stored for it has not yet passed, return username
-                if our_expiration_ts > datetime.utcnow():
-                    logging.info("Token %s is ok for user %s" % (token, our_user))
-                    return our_user, our_pwd
-                else:
-                    logging.info("Token %s is expired - %s <= %s" % (token, str(our_expiration_ts), str(datetime.utcnow())))
-                    return None, None
-            logging.info("Token %s not found" % token)
+            entry = shard.tokens.get(token)
+            if entry is None:
+                logging.debug("Token not found")
+                return None, None
+            our_expiration_ts, our_user, our_pwd = entry
+            # if they have a correct token and the expiration time that we stored for it has not yet passed, return username
+            if our_expiration_ts > time.time():
+                logging.debug("Token is ok for user %s" % our_user)
+                return our_user, our_pwd
+            logging.debug("Token for user %s is expired" % our_user)
+            del shard.tokens[token]
+            shard.evictions += 1
             return None, None
         except Exception as e:
             logging.exception(e)
             return None, None
         finally:
-            self.lock.release()
+            shard.release()
 
     def set_token_for_user(self, token, username, password):
-        self.__clean_cache()
+        now = time.time()
+        expires = now + self.token_lifetime_seconds
+        shard = self.__shard_for(token)
+        shard.acquire()
         try:
-            self.lock.acquire()
-            self.__tokens_to_users_and_timestamps[token] = (datetime.utcnow() + timedelta(minutes=15), username, password)
+            shard.evict_expired(now, max_evictions=TokenManager.EVICTIONS_PER_SET)
+            shard.tokens[token] = (expires, username, password)
+            heapq.heappush(shard.expirations, (expires, token))
         finally:
-            self.lock.release()
+            shard.release()
 
     def get_user_for_token(self, token):
-        return self.__tokens_to_users_and_timestamps[token][1]
+        """ Returns the username for a live token, or None. """
+        return self.is_token_good(token)[0]
+
+    def stats(self):
+        """ Returns a dict with the current token count, lifetime eviction count, and total seconds spent waiting
+        on shard locks. """
+        size = 0
+        evictions = 0
+        lock_wait_seconds = 0.0
+        for shard in self.__shards:
+            size += len(shard.tokens)
+            evictions += shard.evictions
+            lock_wait_seconds += shard.lock_wait_seconds
+        return {"size": size, "evictions": evictions, "lock_wait_seconds": lock_wait_seconds}
@@ -1,15 +1,23 @@
+import datetime
 import json
 import logging
 import os
+import threading
+import time
 import unittest
 
+import cherrypy
 import requests
+from fuzzywuzzy import fuzz
 
+import alert_matching
 import forecasting
+import metrics
+import session_token_manager
 import spellchecking
-from database import model, mysql
-from scheduled_jobs import build_spellcheck_filters
-from utils import properties, utils
+from database import migrate, model, mysql, query_stats, sqlite
+from scheduled_jobs import alert_users, build_spellcheck_filters
+from utils import cache, properties, utils, worker_pool
 
 logging.basicConfig(level=logging.DEBUG)
 model_obj = model.Model()
@@ -21,6 +29,16 @@ model_obj = model.Model()
 """
 
 
+def _fresh_sqlite_path(path):
+    """ Deletes the SQLite database at path (and its WAL files), so it's created from scratch. Returns path. """
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+    return path
+
+
 class TestAccountService(unittest.TestCase):
 
     @staticmethod
@@ -88,6 +106,15 @@ class TestAccountService(unittest.TestCase):
         self.assertEqual(resp.status_code, 405)
 
 
+class TestMetricsService(unittest.TestCase):
+
+    def test_only_served_on_the_metrics_listener(self):
+        self.assertEqual(requests.get("http://localhost:8080/metrics").status_code, 404)
+        resp = requests.get("http://localhost:%d/metrics" % properties.METRICS_PORT)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("watchsac_", resp.text)
+
+
 class TestAlertService(unittest.TestCase):
 
     EP = "http://localhost:8080/alerts"
@@ -224,6 +251,48 @@ class TestAlertService(unittest.TestCase):
         self.assertEqual(len(json_resp), 1)
         self.assertEqual(json_resp[0]["name"], name_2)
 
+    def test_bulk_changes(self):
+        u = "my_bulk_alerts_user"
+        p = "my_bulk_alerts_pwd"
+        self.assertEqual(TestAccountService.sign_up(u, p, "valid_new_account_key", "+10123456780"), 200)
+
+        # create two alerts at once, with one malformed one in between
+        resp = requests.patch(
+            TestAlertService.EP,
+            auth=(u, p),
+            json={"create": [
+                {"name": "first", "search_terms": ["patagonia"]},
+                {"naaame": "broken", "search_terms": ["borked"]},
+                {"name": "second", "search_terms": ["down", "jacket"]}
+            ]}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([x["status"] for x in json.loads(resp.text)["create"]], [200, 400, 200])
+        alerts = json.loads(requests.get(TestAlertService.EP, auth=(u, p)).text)
+        self.assertEqual(sorted([a["name"] for a in alerts]), ["first", "second"])
+        first_id = [a["id"] for a in alerts if a["name"] == "first"][0]
+        second_id = [a["id"] for a in alerts if a["name"] == "second"][0]
+
+        # update one, archive the other, and try to archive someone else's alert
+        resp = requests.patch(
+            TestAlertService.EP,
+            auth=(u, p),
+            json={
+                "update": [{"id": first_id, "name": "first, renamed", "search_terms": ["wool"]}],
+                "archive": [second_id, TestAlertService.u2_alert_id]
+            }
+        )
+        self.assertEqual(resp.status_code, 200)
+        results = json.loads(resp.text)
+        self.assertEqual(results["update"], [{"id": first_id, "status": 200}])
+        self.assertEqual(results["archive"], [{"id": second_id, "status": 200}, {"id": TestAlertService.u2_alert_id, "status": 400}])
+        alerts = json.loads(requests.get(TestAlertService.EP, auth=(u, p)).text)
+        self.assertEqual(len(alerts), 1)
+        self.assertEqual(alerts[0]["name"], "first, renamed")
+        self.assertEqual(alerts[0]["search_terms"], ["wool"])
+        user_2_alerts = json.loads(requests.get(TestAlertService.EP, auth=(TestAlertService.u2, TestAlertService.p2)).text)
+        self.assertEqual(len(user_2_alerts), 1)
+
     def test_nonexistent_user_401(self):
         resp = requests.get(TestAlertService.EP, auth=("user_not_real", TestAlertService.p))
         self.assertEqual(resp.status_code, 401)
@@ -287,6 +356,601 @@ class TestAlertService(unittest.TestCase):
         self.assertEqual(len(user_2_alerts), 1)
 
 
+@unittest.skipIf(properties.DB_BACKEND == "sqlite", "migrations are MySQL-only")
+class TestMigrations(unittest.TestCase):
+
+    def test_migrations_are_idempotent(self):
+        conn_pool = mysql.DBConnPool(conn_count=1)
+        conn = conn_pool.get_conn()
+        try:
+            self.assertEqual(migrate.run_migrations(conn), [])
+        finally:
+            conn_pool.return_conn(conn)
+            conn_pool.close_all()
+
+    def test_migrations_leave_an_up_to_date_schema_alone(self):
+        conn_pool = mysql.DBConnPool(conn_count=1)
+        conn = conn_pool.get_conn()
+        try:
+            cursor = conn.cursor()
+            statements = []
+            execute = cursor.execute
+            cursor.execute = lambda sql, args=None: statements.append(sql) or execute(sql, args)
+            for version, description, migration in migrate.MIGRATIONS:
+                migration(cursor)
+            self.assertEqual([sql for sql in statements if sql.startswith("alter")], [])
+        finally:
+            conn_pool.return_conn(conn)
+            conn_pool.close_all()
+
+    def test_hot_queries_use_indexes(self):
+        conn_pool = mysql.DBConnPool(conn_count=1)
+        conn = conn_pool.get_conn()
+        try:
+            for name, ok, rows in migrate.check_query_plans(conn):
+                self.assertTrue(ok, "%s would scan: %s" % (name, str(rows)))
+        finally:
+            conn_pool.return_conn(conn)
+            conn_pool.close_all()
+
+
+class TestQueryPlanCheck(unittest.TestCase):
+
+    def test_full_scans_fail_even_with_possible_keys(self):
+        self.assertTrue(migrate._uses_index({"type": "ref", "key": "alerts_user_id_active", "extra": None}))
+        self.assertFalse(migrate._uses_index({"type": "ALL", "key": None, "possible_keys": "deals_created"}))
+        self.assertFalse(migrate._uses_index({"type": "ALL", "key": "deals_created"}))
+        self.assertTrue(migrate._uses_index({"type": None, "key": None, "extra": "Impossible WHERE"}))
+
+
+class TestDBConnPool(unittest.TestCase):
+
+    DB_FILE_PATH = "/tmp/watchsac_test_conn_pool.sqlite3"
+
+    class WatchedConnPool(sqlite.SQLiteConnPool):
+        """ Counts commits, and records how many conns were idle during each ping. """
+
+        def __init__(self, *args, **kwargs):
+            self.commits = 0
+            self.idle_during_pings = []
+            super(TestDBConnPool.WatchedConnPool, self).__init__(*args, **kwargs)
+
+        def _new_db_conn(self):
+            conn = super(TestDBConnPool.WatchedConnPool, self)._new_db_conn()
+            commit, ping = conn.commit, conn.ping
+
+            def counting_commit():
+                self.commits += 1
+                commit()
+
+            def watched_ping(reconnect=False):
+                self.idle_during_pings.append(self.stats()["idle"])
+                ping(reconnect)
+            conn.commit, conn.ping = counting_commit, watched_ping
+            return conn
+
+    def new_pool(self, **kwargs):
+        self.pool = TestDBConnPool.WatchedConnPool(_fresh_sqlite_path(TestDBConnPool.DB_FILE_PATH), **kwargs)
+        return self.pool
+
+    def tearDown(self):
+        self.pool.close_all()
+
+    def test_grows_from_min_conns_up_to_conn_count_then_times_out(self):
+        pool = self.new_pool(conn_count=3, min_conns=1, acquire_timeout_seconds=0.05)
+        self.assertEqual((pool.stats()["total"], pool.stats()["idle"]), (1, 1))
+        conns = [pool.get_conn() for x in range(3)]
+        self.assertEqual((pool.stats()["total"], pool.stats()["connections_opened"]), (3, 3))
+        started = time.time()
+        self.assertRaises(mysql.PoolTimeout, pool.get_conn)
+        self.assertGreaterEqual(time.time() - started, 0.05)
+        self.assertEqual((pool.stats()["timeouts"], pool.stats()["total"]), (1, 3))
+        for conn in conns:
+            pool.return_conn(conn)
+
+    def test_returned_conns_go_to_waiters(self):
+        pool = self.new_pool(conn_count=1)
+        conn = pool.get_conn()
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(pool.get_conn(timeout=5)))
+        waiter.start()
+        while pool.stats()["waiters"] == 0:
+            time.sleep(0.01)
+        pool.return_conn(conn)
+        waiter.join()
+        self.assertIs(got[0], conn)
+        self.assertEqual((pool.stats()["waits"], pool.stats()["total"]), (1, 1))
+        pool.return_conn(got[0])
+
+    def test_idle_conns_shrink_to_min_conns(self):
+        pool = self.new_pool(conn_count=3, min_conns=1, idle_timeout_seconds=0.01)
+        conns = [pool.get_conn() for x in range(3)]
+        for conn in conns:
+            pool.return_conn(conn)
+        time.sleep(0.02)
+        pool.validate_idle_conns()
+        stats = pool.stats()
+        self.assertEqual((stats["total"], stats["idle"], stats["connections_closed"]), (1, 1, 2))
+        self.assertIs(pool.get_conn(), conns[-1])  # the most recently used one is kept
+        pool.return_conn(conns[-1])
+
+    def test_validation_pings_one_conn_at_a_time(self):
+        pool = self.new_pool(conn_count=3)
+        conns = [pool.get_conn() for x in range(3)]
+        for conn in conns:
+            pool.return_conn(conn)
+        pool.validate_idle_conns()
+        self.assertEqual(pool.idle_during_pings, [2, 2, 2])
+        checked_out = [pool.get_conn() for x in range(3)]
+        self.assertEqual(checked_out, list(reversed(conns)))  # same order as before
+        for conn in checked_out:
+            pool.return_conn(conn)
+
+    def test_read_only_checkouts_skip_the_commit(self):
+        pool = self.new_pool()
+        pool.return_conn(pool.get_conn(read_only=True))
+        self.assertEqual(pool.commits, 0)
+        pool.return_conn(pool.get_conn())
+        self.assertEqual(pool.commits, 1)
+
+
+class TestSQLiteBackend(unittest.TestCase):
+
+    DB_FILE_PATH = "/tmp/watchsac_test_backend.sqlite3"
+
+    def setUp(self):
+        self.conn_pool = sqlite.SQLiteConnPool(_fresh_sqlite_path(TestSQLiteBackend.DB_FILE_PATH), conn_count=2)
+        self.model = model.Model(premade_db_conn_pool=self.conn_pool)
+
+    def test_translate_sql(self):
+        self.assertEqual(
+            sqlite.translate_sql("update alerts set alerts.active = 0 where alerts.id = %s"),
+            "update alerts set active = 0 where id = ?"
+        )
+        self.assertEqual(
+            sqlite.translate_sql("delete from account_activation_keys where created <= now() - interval %s minute"),
+            "delete from account_activation_keys where created <= datetime('now', 'localtime', '-' || ? || ' minutes')"
+        )
+        self.assertEqual(
+            sqlite.translate_sql("insert into t (k, day, n) values (%s, current_date, %s) "
+                                 "on duplicate key update n = n + values(n)"),
+            "insert into t (k, day, n) values (?, date('now', 'localtime'), ?) "
+            "on conflict do update set n = n + excluded.n"
+        )
+        self.assertEqual(
+            sqlite.translate_sql("select k from t where day > current_date - interval %s day"),
+            "select k from t where day > date('now', 'localtime', '-' || ? || ' days')"
+        )
+
+    def test_wal_mode(self):
+        conn = self.conn_pool.get_conn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("pragma journal_mode")
+            self.assertEqual(cursor.fetchall()[0][0], "wal")
+        finally:
+            self.conn_pool.return_conn(conn)
+
+    def test_model_round_trip(self):
+        user = self.model.save_user("+10000000000", "sqlite_user", "hashed")
+        self.model.activate_user("sqlite_user", "+10000000000")
+        self.assertEqual(self.model.load_user_by_username("sqlite_user")._id, user._id)
+        alert = model.Alert(user._id, None, "a", ["Palisade  Pants", "arc'teryx"], user.phone_number)
+        self.assertTrue(self.model.save_alert(alert))
+        alert.search_terms = ["palisade pants"]
+        self.assertTrue(self.model.update_alert(alert))
+        alerts = self.model.load_active_alerts_for_user(user._id)
+        self.assertEqual([a.search_terms for a in alerts], [["palisade pants"]])
+        self.assertEqual(self.model.load_active_alert_ids_by_search_term("PALISADE pants"), [alert.alert_id])
+        self.assertTrue(self.model.apply_alert_changes([], [], [alert]))
+        self.assertEqual(self.model.load_active_alerts_for_user(user._id), [])
+        self.model.save_activation_key_pair("+10000000000", "abc")
+        self.assertTrue(self.model.is_valid_activation_key_pair("+10000000000", "abc"))
+        self.assertEqual(self.model.purge_expired_activation_keys(), 0)
+
+    def test_sent_alert_counters(self):
+        self.model.save_current_steal(model.CurrentSteal(None, "n", "d", "b", 1.0, "u", None))
+        deal_id = self.model.load_current_steal().deal_id
+        alerts = [model.Alert(7, None, "a", ["x"], "+10000000000"), model.Alert(7, None, "b", ["y"], "+10000000000")]
+        self.assertTrue(self.model.save_alerts(alerts))
+        self.assertTrue(self.model.save_sent_alerts(alerts, deal_id))
+        self.assertTrue(self.model.save_sent_alert(alerts[0], deal_id))
+        self.assertEqual(self.model.load_recent_sent_alert_counts_by_user_id(1), {7: 3})
+        conn = self.conn_pool.get_conn()
+        try:
+            conn.cursor().execute(
+                "insert into sent_alert_counts (user_id, day, sent_count) values (%s, %s, %s)",
+                (7, datetime.date.today() - datetime.timedelta(days=5), 4)
+            )
+        finally:
+            self.conn_pool.return_conn(conn)
+        self.assertEqual(self.model.load_recent_sent_alert_counts_by_user_id(1), {7: 3})
+        self.assertEqual(self.model.load_recent_sent_alert_counts_by_user_id(7), {7: 7})
+
+    def test_current_steal_is_the_newest_deal_id(self):
+        # the version check compares against max(deals.id), so the selection has to agree with it even when
+        # deals.created doesn't (clock skew, or two deals in the same second)
+        self.model.check_current_steal_version = True
+        self.model.save_current_steal(model.CurrentSteal(None, "first", "d", "b", 1.0, "u", None))
+        self.model.save_current_steal(model.CurrentSteal(None, "second", "d", "b", 1.0, "u", None))
+        conn = self.conn_pool.get_conn()
+        try:
+            conn.cursor().execute("update deals set created = %s where product_name = %s",
+                                  (datetime.datetime.now() - datetime.timedelta(days=1), "second"))
+        finally:
+            self.conn_pool.return_conn(conn)
+        self.assertEqual(self.model.load_current_steal().product_name, "second")
+        self.assertIs(self.model.load_current_steal(), self.model.load_current_steal())
+
+    def test_alert_match_results(self):
+        self.assertEqual(self.model.load_alert_match_results(2, [1, 2]), {})
+        self.assertTrue(self.model.save_alert_match_results(1, 7, [(1, 1, True)]))
+        self.assertTrue(self.model.save_alert_match_results(2, 7, [(1, 1, True), (2, 3, False)]))
+        self.assertTrue(self.model.save_alert_match_results(2, 8, [(1, 2, False)]))
+        self.assertEqual(self.model.load_alert_match_results(2, [1, 2, 3]), {1: (2, 8, False), 2: (3, 7, False)})
+        self.assertEqual(self.model.load_alert_match_results(2, [2]), {2: (3, 7, False)})
+        batch_size = model.ALERT_MATCH_RESULTS_LOAD_BATCH_SIZE
+        model.ALERT_MATCH_RESULTS_LOAD_BATCH_SIZE = 1
+        try:
+            self.assertEqual(self.model.load_alert_match_results(2, [2, 3]), {2: (3, 7, False)})
+        finally:
+            model.ALERT_MATCH_RESULTS_LOAD_BATCH_SIZE = batch_size
+        self.assertEqual(self.model.has_alert_match_results_before(2), True)
+        self.assertTrue(self.model.purge_alert_match_results_before(2))
+        self.assertEqual(self.model.has_alert_match_results_before(2), False)
+        self.assertEqual(self.model.load_alert_match_results(1, [1]), {})
+        self.assertEqual(len(self.model.load_alert_match_results(2, [1, 2])), 2)
+
+    def test_iter_steals_since_pages_and_fails_loudly(self):
+        for i in range(5):
+            self.model.save_current_steal(model.CurrentSteal(None, "n%d" % i, "d", "b", 1.0, "u", None))
+        deals = self.model.iter_steals_since("2000-01-01 00:00:00", batch_size=2)
+        self.assertEqual([d.product_name for d in deals], ["n%d" % i for i in range(5)])
+        deals = self.model.iter_steals_since("2000-01-01 00:00:00", batch_size=2)
+        self.assertEqual(next(deals).product_name, "n0")
+        self.assertEqual(self.conn_pool.stats()["in_use"], 0)  # no connection held between pages
+        self.assertEqual(next(deals).product_name, "n1")
+        conn = self.conn_pool.get_conn()
+        try:
+            conn.cursor().execute("alter table deals rename to deals_gone")
+        finally:
+            self.conn_pool.return_conn(conn)
+        self.assertRaises(Exception, lambda: list(deals))
+
+    def test_failed_transaction_rolls_back(self):
+        alert = model.Alert(1, None, "a", ["x"], "+10000000000")
+        try:
+            with self.model.transaction() as cursor:
+                self.model.save_alerts([alert], cursor=cursor)
+                raise ValueError("roll it back")
+        except ValueError:
+            pass
+        self.assertEqual(self.model.load_active_alerts_for_user(1), [])
+
+
+class TestReplicaRouting(unittest.TestCase):
+
+    PRIMARY_FILE_PATH = "/tmp/watchsac_test_primary.sqlite3"
+    REPLICA_FILE_PATH = "/tmp/watchsac_test_replica.sqlite3"
+
+    def setUp(self):
+        self.lag = 0
+        self.model = model.Model(
+            premade_db_conn_pool=sqlite.SQLiteConnPool(_fresh_sqlite_path(TestReplicaRouting.PRIMARY_FILE_PATH)),
+            replica_db_conn_pool=sqlite.SQLiteConnPool(_fresh_sqlite_path(TestReplicaRouting.REPLICA_FILE_PATH)),
+            replica_lag_check=lambda conn: self.lag,
+            replica_max_staleness_seconds=0.2
+        )
+
+    def routed(self):
+        stats = self.model.conn_pool.stats()
+        return stats["replica_reads"], stats["primary_reads"]
+
+    def test_reads_go_to_a_fresh_replica(self):
+        self.model.load_users()
+        self.assertEqual(self.routed(), (1, 0))
+
+    def test_reads_after_writes_stay_on_the_primary(self):
+        user = self.model.save_user("+10000000000", "replicated_user", "hashed")
+        self.model.save_alert(model.Alert(user._id, None, "a", ["x"], user.phone_number))
+        self.assertEqual(len(self.model.load_active_alert_ids_by_search_term("x")), 1)
+        self.assertEqual(self.routed(), (0, 1))
+        time.sleep(0.3)
+        self.assertEqual(self.model.load_active_alert_ids_by_search_term("x"), [])  # not replicated here
+        self.assertEqual(self.routed(), (1, 1))
+
+    def test_alerts_api_reads_see_writes_from_other_threads(self):
+        saved = []
+
+        def write():
+            user = self.model.save_user("+10000000000", "replicated_user", "hashed")
+            alert = model.Alert(user._id, None, "a", ["x"], user.phone_number)
+            self.model.save_alert(alert)
+            saved.append(alert)
+        writer = threading.Thread(target=write)
+        writer.start()
+        writer.join()
+        alert = saved[0]
+        self.assertEqual([a.alert_id for a in self.model.load_active_alerts_for_user(alert.user_id)], [alert.alert_id])
+        self.assertEqual(self.model.load_active_alert_for_user(alert.user_id, alert.alert_id).alert_id, alert.alert_id)
+
+    def test_auth_lookups_always_use_the_primary(self):
+        self.model.save_activation_key_pair("+10000000000", "abc")
+        time.sleep(0.3)
+        self.assertTrue(self.model.is_valid_activation_key_pair("+10000000000", "abc"))
+        self.assertEqual(self.model.load_user_by_username("nobody"), None)
+        self.assertEqual(self.routed(), (0, 0))
+
+    @unittest.skipIf(properties.DB_BACKEND == "sqlite", "the replica host setting is for MySQL")
+    def test_unreachable_replica_falls_back_to_the_primary(self):
+        replica_host = properties.MYSQL_REPLICA_HOST
+        properties.MYSQL_REPLICA_HOST = "replica.invalid"
+        try:
+            m = model.Model()
+        finally:
+            properties.MYSQL_REPLICA_HOST = replica_host
+        self.assertEqual(m.load_active_alerts_for_user(-1), [])
+        stats = m.conn_pool.stats()
+        self.assertEqual((stats["replica_reads"], stats["primary_reads"], stats["replica_lag_seconds"]), (0, 1, -1))
+
+    def test_stale_or_broken_replica_is_skipped(self):
+        for lag in (1, None):
+            self.lag = lag
+            self.model.conn_pool.check_replica_lag()
+            self.model.load_users()
+        self.assertEqual(self.routed(), (0, 2))
+        self.lag = 0
+        self.model.conn_pool.check_replica_lag()
+        self.model.load_users()
+        self.assertEqual(self.routed(), (1, 2))
+
+
+class TestAlertDaemon(unittest.TestCase):
+
+    DB_FILE_PATH = "/tmp/watchsac_test_alert_daemon.sqlite3"
+
+    class FakeSMSClient(object):
+
+        def __init__(self):
+            self.sent = []
+            self.failing = False
+
+        def send_alert(self, alert):
+            if self.failing:
+                return False
+            self.sent.append(alert.alert_id)
+            return True
+
+    def setUp(self):
+        conn_pool = sqlite.SQLiteConnPool(_fresh_sqlite_path(TestAlertDaemon.DB_FILE_PATH))
+        self.model = model.Model(premade_db_conn_pool=conn_pool, check_current_steal_version=True)
+        self.user = self.model.save_user("+10000000000", "daemon_user", "hashed")
+        self.sms_client = TestAlertDaemon.FakeSMSClient()
+        self.daemon = alert_users.AlertDaemon(self.model, sms_client=self.sms_client)
+
+    def new_alert(self, search_terms):
+        alert = model.Alert(self.user._id, None, "a", search_terms, self.user.phone_number)
+        self.model.save_alert(alert)
+        return alert
+
+    def save_deal(self, name, description):
+        self.model.save_current_steal(model.CurrentSteal(None, name, description, None, None, None, None))
+
+    def test_evaluates_new_deals_and_changed_alerts(self):
+        matching = self.new_alert(["palisade pants"])
+        self.new_alert(["down jacket"])
+        self.assertEqual(self.daemon.tick(), [])  # no deal yet
+        self.save_deal("Palisade Pants", "Arc'teryx palisade pants")
+        self.assertEqual([a.alert_id for a in self.daemon.tick()], [matching.alert_id])
+        self.assertEqual(self.daemon.tick(), [])  # already sent for this deal
+        edited = self.new_alert(["zzz"])
+        self.assertEqual(self.daemon.tick(), [])
+        edited.search_terms = ["pants palisade"]
+        self.model.update_alert(edited)
+        self.assertEqual([a.alert_id for a in self.daemon.tick()], [edited.alert_id])
+        self.model.archive_alert(matching)
+        self.daemon.tick()
+        self.assertNotIn(matching.alert_id, self.daemon.alerts)
+        self.assertEqual(self.sms_client.sent, [matching.alert_id, edited.alert_id])
+        self.assertEqual(self.model.load_sent_alerts_by_deal_id(self.model.load_current_steal().deal_id),
+                         [matching.alert_id, edited.alert_id])
+
+    def test_failed_sends_are_retried_next_tick(self):
+        matching = self.new_alert(["palisade pants"])
+        self.save_deal("Palisade Pants", "Arc'teryx palisade pants")
+        self.sms_client.failing = True
+        self.assertEqual(self.daemon.tick(), [])
+        self.assertEqual(self.daemon.retry_alert_ids, set([matching.alert_id]))
+        self.sms_client.failing = False
+        self.assertEqual([a.alert_id for a in self.daemon.tick()], [matching.alert_id])
+        self.assertEqual((self.daemon.retry_alert_ids, self.daemon.tick()), (set(), []))
+
+    def test_match_results_are_reused_until_the_alert_or_the_rules_change(self):
+        self.save_deal("Palisade Pants", "Arc'teryx palisade pants")
+        deal = self.model.load_current_steal()
+        self.new_alert(["zzz"])
+        alert = self.model.load_all_active_alerts_with_phone_numbers()[0]
+        scoring_version = alert_users.SCORING_VERSION
+        self.assertEqual(alert_users.filter_alerts_by_match_results([alert], deal, self.model), [])
+        self.assertEqual(self.model.load_alert_match_results(deal.deal_id, [alert.alert_id]),
+                         {alert.alert_id: (1, scoring_version, False)})
+        # a saved result stands in for scoring the alert again, as long as it's for the alert's current version...
+        self.model.save_alert_match_results(deal.deal_id, scoring_version, [(alert.alert_id, 1, True)])
+        self.assertEqual(alert_users.filter_alerts_by_match_results([alert], deal, self.model), [alert])
+        # ...and was scored by the current rules
+        self.model.save_alert_match_results(deal.deal_id, scoring_version + 1, [(alert.alert_id, 1, True)])
+        self.assertEqual(alert_users.filter_alerts_by_match_results([alert], deal, self.model), [])
+        self.model.save_alert_match_results(deal.deal_id, scoring_version, [(alert.alert_id, 1, True)])
+        alert.search_terms = ["hats"]
+        self.model.update_alert(alert)
+        alert = self.model.load_all_active_alerts_with_phone_numbers()[0]
+        self.assertEqual(alert_users.filter_alerts_by_match_results([alert], deal, self.model), [])
+        self.assertEqual(self.model.load_alert_match_results(deal.deal_id, [alert.alert_id]),
+                         {alert.alert_id: (2, scoring_version, False)})
+
+    def test_match_results_are_purged_only_when_the_deal_changes(self):
+        purged = []
+        purge = self.model.purge_alert_match_results_before
+        self.model.purge_alert_match_results_before = lambda deal_id: purged.append(deal_id) or purge(deal_id)
+        alert = self.new_alert(["zzz"])
+        self.save_deal("Palisade Pants", "Arc'teryx palisade pants")
+        first_deal_id = self.model.load_current_steal().deal_id
+        for search_terms in (None, ["yyy"], ["xxx"]):
+            if search_terms is not None:
+                self.new_alert(search_terms)
+            self.daemon.tick()
+        self.assertEqual(purged, [first_deal_id])
+        self.save_deal("Down Jacket", "A down jacket")
+        self.daemon.tick()
+        self.daemon.tick()
+        self.assertEqual(purged, [first_deal_id, first_deal_id + 1])
+        self.assertEqual(self.model.load_alert_match_results(first_deal_id, [alert.alert_id]), {})
+
+
+class TestQueryStats(unittest.TestCase):
+
+    DB_FILE_PATH = "/tmp/watchsac_test_query_stats.sqlite3"
+
+    def setUp(self):
+        conn_pool = sqlite.SQLiteConnPool(_fresh_sqlite_path(TestQueryStats.DB_FILE_PATH))
+        self.model = model.Model(premade_db_conn_pool=conn_pool)
+
+    def test_aggregates_by_outermost_method(self):
+        user = self.model.save_user("+10000000000", "stats_user", "hashed")
+        self.model.save_alert(model.Alert(user._id, None, "a", ["x", "y"], user.phone_number))
+        self.model.load_active_alerts_for_user(user._id)
+        stats = self.model.query_stats.snapshot()
+        self.assertEqual(stats["save_alert"]["calls"], 1)
+        self.assertNotIn("save_alerts", stats)  # it ran inside save_alert
+        self.assertEqual(stats["save_alert"]["rows"], 3)  # the alert and its two search terms
+        self.assertEqual(stats["load_active_alerts_for_user"]["queries"], 2)
+        self.assertEqual(stats["load_active_alerts_for_user"]["rows"], 3)  # one alert row, two search term rows
+        self.assertIn("load_active_alerts_for_user", self.model.query_stats.summary())
+
+    def test_transaction_is_attributed_for_the_whole_with_block(self):
+        with self.model.transaction() as cursor:
+            cursor.execute("insert into deals (product_name) values (%s)", ("n",))
+            self.model.save_alerts([model.Alert(7, None, "a", ["x"], "+10000000000")], cursor=cursor)
+        stats = self.model.query_stats.snapshot()
+        self.assertNotIn(query_stats.NO_METHOD, stats)
+        self.assertNotIn("save_alerts", stats)  # it ran inside the transaction
+        self.assertEqual((stats["transaction"]["calls"], stats["transaction"]["rows"]), (1, 3))
+
+    def test_streaming_generator_is_attributed(self):
+        self.model.save_current_steal(model.CurrentSteal(None, "n", "d", "b", 1.0, "u", None))
+        self.assertEqual(len(list(self.model.iter_steals_since("2000-01-01 00:00:00"))), 1)
+        stats = self.model.query_stats.snapshot()["iter_steals_since"]
+        self.assertEqual((stats["calls"], stats["queries"], stats["rows"]), (1, 1, 1))
+
+    def test_slow_queries_are_logged_redacted(self):
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        query_stats.slow_query_log.addHandler(handler)
+        try:
+            self.model.query_stats.slow_query_threshold_seconds = 0
+            self.model.load_user_by_username("secret_username")
+        finally:
+            query_stats.slow_query_log.removeHandler(handler)
+        self.assertEqual(len(messages), 1)
+        self.assertIn("load_user_by_username", messages[0])
+        self.assertIn("params=(str)", messages[0])
+        self.assertNotIn("secret_username", messages[0])
+        self.assertEqual(self.model.query_stats.snapshot()["load_user_by_username"]["slow_queries"], 1)
+
+
+class TestAlertMatching(unittest.TestCase):
+
+    DEALS = [
+        model.CurrentSteal(1, "Arc'teryx Palisade Pant - Men's", "The Arc'teryx Men's Palisade Pants provide an "
+                           "air-permeable construction that's better than any pair of breathable hiking pants.",
+                           None, None, None, None),
+        model.CurrentSteal(2, "Costa Palapa 580P Sunglasses - Polarized", "Palapas are open-sided dwellings made with "
+                           "thatched palm leaf roofs that provide protection from the harsh tropical sun.",
+                           None, None, None, None),
+        model.CurrentSteal(3, "???", "", None, None, None, None),
+        model.CurrentSteal(4, "Palisades", "palisades", None, None, None, None),
+    ]
+    TERMS = ["palisade pants", "arc'teryx", "Arc'teryx Palisade", "pants", "PANT", "hiking", "costa", "palapa",
+             "sunglasses polarized", "palm leaf roofs", "provide", "580p", "", "!!", u"caf\xe9 pants", "pallisade",
+             "men's palisade pant", "breathable hiking pants", "palisade"]
+
+    @staticmethod
+    def reference_is_relevant(alert, current_steal):
+        # the relevance test as alert_users has always done it
+        desc_scores = [fuzz.token_set_ratio(st, current_steal.product_description) for st in alert.search_terms]
+        avg_desc_score = float(sum(desc_scores)) / float(len(desc_scores))
+        top_title_score = float(max([fuzz.token_set_ratio(st, current_steal.product_name) for st in alert.search_terms]))
+        return avg_desc_score > 90.0 and top_title_score > 90.0
+
+    def test_scores_match_token_set_ratio(self):
+        engine = alert_matching.MatchingEngine()
+        for deal in TestAlertMatching.DEALS:
+            prepared = alert_matching.PreparedDeal(deal)
+            for term in TestAlertMatching.TERMS:
+                for text, prepared_text in ((deal.product_name, prepared.name),
+                                            (deal.product_description, prepared.description)):
+                    self.assertEqual(alert_matching.token_set_ratio(engine.term_tokens(term), prepared_text),
+                                     fuzz.token_set_ratio(term, text), "%r vs %r" % (term, text))
+
+    def test_filter_matches_reference(self):
+        engine = alert_matching.MatchingEngine()
+        terms = TestAlertMatching.TERMS
+        alerts = [model.Alert(1, i, "a", [terms[i % len(terms)], terms[(i * 7) % len(terms)]][:1 + i % 2], "+1")
+                  for i in range(3 * len(terms))]
+        alerts.append(model.Alert(1, 1000, "a", ["palisade pants", "arc'teryx palisade pant"], "+1"))
+        for deal in TestAlertMatching.DEALS:
+            expected = [a for a in alerts if TestAlertMatching.reference_is_relevant(a, deal)]
+            self.assertEqual(engine.filter_relevant(alerts, deal), expected)
+        self.assertTrue(engine.filter_relevant(alerts[-1:], TestAlertMatching.DEALS[0]))
+
+    def test_index_only_prunes_alerts_that_cant_match(self):
+        engine = alert_matching.MatchingEngine()
+        terms = TestAlertMatching.TERMS
+        alerts = [model.Alert(1, i, "a", [terms[i % len(terms)], terms[(i * 5) % len(terms)]][:1 + i % 2], "+1")
+                  for i in range(3 * len(terms))]
+        index = alert_matching.AlertIndex(engine, alerts)
+        for deal in TestAlertMatching.DEALS:
+            self.assertEqual(engine.filter_relevant(alerts, deal, alert_index=index), engine.filter_relevant(alerts, deal))
+            self.assertLess(len(index.candidate_ids(alert_matching.PreparedDeal(deal))), len(alerts))
+        # "palisade" shares no token with "palisades", but still scores 94 against it
+        alert = model.Alert(1, 0, "a", ["palisade"], "+1")
+        self.assertEqual(engine.filter_relevant([alert], TestAlertMatching.DEALS[3],
+                                                alert_index=alert_matching.AlertIndex(engine, [alert])), [alert])
+
+    def test_parallel_scoring_matches_serial(self):
+        engine = alert_matching.MatchingEngine()
+        terms = TestAlertMatching.TERMS
+        alerts = [model.Alert(1, i, "a", [terms[i % len(terms)], terms[(i * 3) % len(terms)]][:1 + i % 2], "+1")
+                  for i in range(20 * len(terms))]
+        for deal in TestAlertMatching.DEALS:
+            self.assertEqual(engine.filter_relevant(alerts, deal, processes=2, min_parallel_alerts=0),
+                             engine.filter_relevant(alerts, deal))
+
+    def test_shared_terms_are_scored_once(self):
+        engine = alert_matching.MatchingEngine()
+        deal = TestAlertMatching.DEALS[0]
+        alerts = [model.Alert(1, i, "a", ["palisade pants", ["Pants Palisade", "arc'teryx", "hiking"][i % 3]], "+1")
+                  for i in range(30)]
+        scores = alert_matching.ScoreTable(alert_matching.PreparedDeal(deal))
+        relevant = [a for a in alerts if engine.is_relevant(a, scores.prepared_deal, scores)]
+        self.assertEqual(relevant, [a for a in alerts if TestAlertMatching.reference_is_relevant(a, deal)])
+        # "palisade pants" and "Pants Palisade" have the same tokens, so there are three distinct terms to score
+        self.assertLessEqual(len(scores), 6)
+
+    def test_index_updates(self):
+        engine = alert_matching.MatchingEngine()
+        deal = alert_matching.PreparedDeal(model.CurrentSteal(1, "Palapa Sunglasses", "palapa", None, None, None, None))
+        alert = model.Alert(1, 1, "a", ["palapa sunglasses"], "+1")
+        index = alert_matching.AlertIndex(engine, [alert])
+        self.assertEqual(index.candidate_ids(deal), set([1]))
+        index.add_alert(model.Alert(1, 1, "a", ["zzzz"], "+1"))
+        self.assertEqual(index.candidate_ids(deal), set())
+        index.add_alert(alert)
+        index.remove_alert(1)
+        self.assertEqual((index.candidate_ids(deal), len(index)), (set(), 0))
+
+
 class TestUtils(unittest.TestCase):
 
     def test_encrypt_works(self):
@@ -307,6 +971,152 @@ class TestUtils(unittest.TestCase):
             self.assertTrue(c in utils._ACTIVATION_KEY_CHARS)
 
 
+class TestTTLCache(unittest.TestCase):
+
+    def test_get_put_invalidate(self):
+        c = cache.TTLCache(ttl_seconds=60, max_size=10)
+        self.assertEqual(c.get("a"), None)
+        c.put("a", 1)
+        self.assertEqual(c.get("a"), 1)
+        c.invalidate("a")
+        self.assertEqual(c.get("a"), None)
+
+    def test_expiry(self):
+        c = cache.TTLCache(ttl_seconds=-1)
+        c.put("a", 1)
+        self.assertEqual(c.get("a"), None)
+
+    def test_bounded_size_evicts_least_recently_used(self):
+        c = cache.TTLCache(ttl_seconds=60, max_size=2)
+        c.put("a", 1)
+        c.put("b", 2)
+        c.get("a")
+        c.put("c", 3)
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.get("a"), 1)
+        self.assertEqual(c.get("b"), None)
+        self.assertEqual(c.get("c"), 3)
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_saturated_pool_rejects_calls(self):
+        pool = worker_pool.BoundedProcessPool(processes=1, max_pending=1)
+        try:
+            busy = threading.Thread(target=pool.run, args=(time.sleep, 1))
+            busy.start()
+            time.sleep(0.2)
+            self.assertRaises(worker_pool.PoolSaturated, pool.run, time.sleep, 0)
+            busy.join()
+            self.assertEqual(pool.run(abs, -1), 1)
+        finally:
+            pool.close()
+
+    def test_saturation_is_a_503(self):
+        import web_service  # not at the top - it sets up logging to its own file when imported
+
+        def saturated():
+            raise worker_pool.PoolSaturated()
+        try:
+            web_service._run_pool_job(saturated)
+            self.fail("expected a 503")
+        except cherrypy.HTTPError as e:
+            self.assertEqual(e.status, 503)
+        self.assertEqual(web_service._run_pool_job(abs, -1), 1)
+
+
+class TestVerifiedCredentialCache(unittest.TestCase):
+
+    def test_remember_and_verify(self):
+        c = cache.VerifiedCredentialCache()
+        self.assertFalse(c.is_verified("user", "pwd", "hash"))
+        c.remember("user", "pwd", "hash")
+        self.assertTrue(c.is_verified("user", "pwd", "hash"))
+        self.assertFalse(c.is_verified("user", "wrong_pwd", "hash"))
+        self.assertFalse(c.is_verified("other_user", "pwd", "hash"))
+
+    def test_changed_password_hash_is_not_verified(self):
+        c = cache.VerifiedCredentialCache()
+        c.remember("user", "pwd", "old_hash")
+        self.assertFalse(c.is_verified("user", "pwd", "new_hash"))
+
+    def test_forget(self):
+        c = cache.VerifiedCredentialCache()
+        c.remember("user", "pwd", "hash")
+        c.forget("user", "pwd")
+        self.assertFalse(c.is_verified("user", "pwd", "hash"))
+
+
+class TestTokenManager(unittest.TestCase):
+
+    def test_set_and_check_token(self):
+        mgr = session_token_manager.TokenManager()
+        mgr.set_token_for_user("token", "user", "pwd")
+        self.assertEqual(mgr.is_token_good("token"), ("user", "pwd"))
+        self.assertEqual(mgr.get_user_for_token("token"), "user")
+        self.assertEqual(mgr.is_token_good("other_token"), (None, None))
+        self.assertEqual(mgr.get_user_for_token("other_token"), None)
+
+    def test_expired_tokens_are_evicted(self):
+        mgr = session_token_manager.TokenManager(shard_count=1, token_lifetime_seconds=-1)
+        mgr.set_token_for_user("token_1", "user", "pwd")
+        mgr.set_token_for_user("token_2", "user", "pwd")
+        self.assertEqual(mgr.is_token_good("token_1"), (None, None))
+        self.assertEqual(mgr.sweep(), 1)
+        stats = mgr.stats()
+        self.assertEqual(stats["size"], 0)
+        self.assertEqual(stats["evictions"], 2)
+
+    def test_background_sweeper(self):
+        mgr = session_token_manager.TokenManager(sweep_interval_seconds=0.01, token_lifetime_seconds=-1)
+        mgr.set_token_for_user("token", "user", "pwd")
+        for x in range(100):
+            if mgr.stats()["size"] == 0:
+                break
+            time.sleep(0.01)
+        mgr.stop()
+        self.assertEqual(mgr.stats()["size"], 0)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_quantiles(self):
+        h = metrics.LatencyHistogram()
+        for x in range(100):
+            h.observe(0.001 * (x + 1))
+        self.assertEqual(h.count, 100)
+        self.assertTrue(0.04 < h.quantile(0.5) < 0.06)
+        self.assertTrue(0.09 < h.quantile(0.99) <= 0.1)
+        self.assertEqual(metrics.LatencyHistogram().quantile(0.5), 0.0)
+
+    def test_render(self):
+        registry = metrics.MetricsRegistry()
+        registry.describe("requests_total", "Requests handled.")
+        registry.increment("requests_total", service="/alerts", method="GET")
+        with registry.timed("request_seconds", service="/alerts", method="GET"):
+            pass
+        text = registry.render()
+        self.assertTrue("# HELP requests_total Requests handled." in text)
+        self.assertTrue('requests_total{method="GET",service="/alerts"} 1' in text)
+        self.assertTrue('request_seconds{method="GET",quantile="0.99",service="/alerts"}' in text)
+        self.assertTrue('request_seconds_count{method="GET",service="/alerts"} 1' in text)
+
+    def test_collected_counters_and_gauges(self):
+        registry = metrics.MetricsRegistry()
+        registry.add_counter_collector(lambda: [("dao_calls_total", {"method": "load_users"}, 3)])
+        registry.add_gauge_collector(lambda: [("dao_max_seconds", {"method": "load_users"}, 0.5)])
+        text = registry.render()
+        self.assertTrue("# TYPE dao_calls_total counter" in text)
+        self.assertTrue('dao_calls_total{method="load_users"} 3.000000' in text)
+        self.assertTrue("# TYPE dao_max_seconds gauge" in text)
+
+    def test_timed_proxy(self):
+        registry = metrics.MetricsRegistry()
+        proxy = metrics.TimedProxy(utils, registry, "calls_seconds")
+        self.assertTrue(proxy.is_valid_username("valid_username"))
+        self.assertEqual(registry.get_histogram("calls_seconds", method="is_valid_username").count, 1)
+
+
 class TestSpellcheckFilters(unittest.TestCase):
 
     bloom_filter = None
@@ -454,11 +1264,16 @@ def set_up_db():
         os.remove(properties.SEARCH_TERMS_SUGGESTION_TEMP_DB_FILE_PATH)
     except:
         pass
-    conn_pool = mysql.DBConnPool()
-    cmd = "mysql --user=" + properties.MYSQL_USER + " --password=" + properties.MYSQL_PASSWORD + " < " + os.getcwd() + "/database/schema.ddl"
-    print(cmd)
-    os.system(cmd)
-    conn = conn_pool.get_conn()
+    if properties.DB_BACKEND == "sqlite":
+        conn_pool = sqlite.SQLiteConnPool(_fresh_sqlite_path(properties.SQLITE_DB_FILE_PATH))
+        conn = conn_pool.get_conn()
+    else:
+        conn_pool = mysql.DBConnPool()
+        cmd = "mysql --user=" + properties.MYSQL_USER + " --password=" + properties.MYSQL_PASSWORD + " < " + os.getcwd() + "/database/schema.ddl"
+        print(cmd)
+        os.system(cmd)
+        conn = conn_pool.get_conn()
+        migrate.run_migrations(conn)
     c = conn.cursor()
     c.execute(
         "insert into deals (product_name, product_description, url) values (%s, %s, %s)",
@@ -0,0 +1,85 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """ Thread-safe, size-bounded dict whose entries expire a fixed number of seconds after they are put in.
+    When full, the least recently used entry is evicted to make room. """
+
+    def __init__(self, ttl_seconds=60, max_size=10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.__entries = OrderedDict()  # key -> (expiration time, value), oldest use first
+
+    def get(self, key):
+        """ Returns the cached value, or None if it is missing or expired. """
+        with self.lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.time():
+                return None
+            self.__entries[key] = entry  # re-insert to mark it as recently used
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.__entries.pop(key, None)
+            while len(self.__entries) >= self.max_size:
+                self.__entries.popitem(last=False)
+            self.__entries[key] = (time.time() + self.ttl_seconds, value)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+class VerifiedCredentialCache(object):
+    """ Remembers recent successful password verifications, so repeat logins can skip the slow password hash.
+    Entries are keyed on an HMAC of the username and password attempt (under a secret that only lives in this
+    process), and are only honoured while the user's stored password hash is unchanged. """
+
+    def __init__(self, ttl_seconds=300, max_size=10000):
+        self.__secret = os.urandom(32)
+        self.__cache = TTLCache(ttl_seconds=ttl_seconds, max_size=max_size)
+
+    @staticmethod
+    def __to_bytes(s):
+        if isinstance(s, unicode):
+            return s.encode("utf-8")
+        return str(s)
+
+    def __digest(self, username, password_attempt):
+        msg = VerifiedCredentialCache.__to_bytes(username) + "\0" + VerifiedCredentialCache.__to_bytes(password_attempt)
+        return hmac.new(self.__secret, msg, hashlib.sha256).digest()
+
+    def is_verified(self, username, password_attempt, password_hash):
+        """ True if this exact attempt was verified recently against this same stored password hash. """
+        if password_hash is None:
+            return False
+        return self.__cache.get(self.__digest(username, password_attempt)) == password_hash
+
+    def remember(self, username, password_attempt, password_hash):
+        self.__cache.put(self.__digest(username, password_attempt), password_hash)
+
+    def forget(self, username, password_attempt):
+        self.__cache.invalidate(self.__digest(username, password_attempt))
+
+    def clear(self):
+        self.__cache.clear()
+
+    def __len__(self):
+        return len(self.__cache)
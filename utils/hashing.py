@@ -0,0 +1,12 @@
+from utils import utils
+from utils.worker_pool import BoundedProcessPool
+
+
+class HashingPool(BoundedProcessPool):
+    """ Runs the CPU-bound password hashing and verification in worker processes (see BoundedProcessPool). """
+
+    def encrypt(self, password):
+        return self.run(utils.encrypt, password)
+
+    def verify(self, password_attempt, hash):
+        return self.run(utils.verify, password_attempt, hash)
@@ -4,6 +4,14 @@ import ConfigParser
 config = ConfigParser.RawConfigParser()
 config.read('/opt/watchsac.cfg')
 
+
+def _get_optional(section, option, default):
+    """ For newer settings, so that older config files still load. """
+    if config.has_option(section, option):
+        return config.get(section, option)
+    return default
+
+
 # Twilio config
 TWILIO_ACCOUNT_SID = config.get("Twilio", "TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = config.get("Twilio", "TWILIO_AUTH_TOKEN")
@@ -15,6 +23,19 @@ MYSQL_USER = config.get("MySQL", "MYSQL_USER")
 MYSQL_PASSWORD = config.get("MySQL", "MYSQL_PASSWORD")
 MYSQL_DB_NAME = config.get("MySQL", "MYSQL_DB_NAME")
 
+# optional read replica (same user, password and DB name) - Model sends read-only queries there while it's no more
+# than REPLICA_MAX_STALENESS_SECONDS behind
+MYSQL_REPLICA_HOST = _get_optional("MySQL", "MYSQL_REPLICA_HOST", "")
+REPLICA_MAX_STALENESS_SECONDS = float(_get_optional("MySQL", "REPLICA_MAX_STALENESS_SECONDS", "5"))
+
+# storage backend for Model - "mysql", or "sqlite" for a single-node instance keeping everything in one file
+DB_BACKEND = _get_optional("database", "DB_BACKEND", "mysql")
+SQLITE_DB_FILE_PATH = _get_optional("database", "SQLITE_DB_FILE_PATH", "/opt/watchsac.sqlite3")
+
+# DB statements slower than this go to the slow query log - its own file if a path is set, otherwise the main log
+SLOW_QUERY_THRESHOLD_SECONDS = float(_get_optional("database", "SLOW_QUERY_THRESHOLD_SECONDS", "0.5"))
+SLOW_QUERY_LOG_FILE_PATH = _get_optional("database", "SLOW_QUERY_LOG_FILE_PATH", "")
+
 # client side app dir
 CLIENT_APP_DIR = config.get("webapp", "CLIENT_APP_DIR")
 
@@ -26,3 +47,21 @@ SEARCH_TERMS_SUGGESTION_BLOOM_FILTER_OUTPUT_DIR = config.get("etc", "SEARCH_TERM
 HISTORY_CHART_LOOKBACK_WINDOW = int(config.get("etc", "HISTORY_CHART_LOOKBACK_WINDOW"))
 
 USE_SMS_ACCOUNT_SETUP_VALIDATION = True if config.get("etc", "USE_SMS_ACCOUNT_SETUP_VALIDATION") == 'true' else False
+
+# worker processes for scoring alerts against a deal (0 or 1 scores them in the alerting process), and how long
+# scoring may take before the run gives up
+ALERT_SCORING_PROCESSES = int(_get_optional("etc", "ALERT_SCORING_PROCESSES", "0"))
+ALERT_SCORING_TIMEOUT_SECONDS = int(_get_optional("etc", "ALERT_SCORING_TIMEOUT_SECONDS", "600"))
+
+# password hashing worker processes, and how many hashing jobs may be queued before we start returning 503s
+HASHING_POOL_PROCESSES = int(_get_optional("webapp", "HASHING_POOL_PROCESSES", "2"))
+HASHING_POOL_MAX_PENDING = int(_get_optional("webapp", "HASHING_POOL_MAX_PENDING", "16"))
+
+# web server request threads, and spellcheck/forecast worker processes (0 runs them on the request threads instead)
+WEB_THREAD_POOL_SIZE = int(_get_optional("webapp", "WEB_THREAD_POOL_SIZE", "10"))
+ENGINE_POOL_PROCESSES = int(_get_optional("webapp", "ENGINE_POOL_PROCESSES", "0"))
+ENGINE_POOL_MAX_PENDING = int(_get_optional("webapp", "ENGINE_POOL_MAX_PENDING", "32"))
+
+# /metrics is only served on its own listener, which is localhost-only unless this says otherwise
+METRICS_SOCKET_HOST = _get_optional("webapp", "METRICS_SOCKET_HOST", "127.0.0.1")
+METRICS_PORT = int(_get_optional("webapp", "METRICS_PORT", "9090"))
@@ -0,0 +1,36 @@
+import logging
+import multiprocessing
+import threading
+
+
+class PoolSaturated(Exception):
+    """ Raised when too many jobs are already queued or running - callers should shed load (503). """
+    pass
+
+
+class BoundedProcessPool(object):
+    """ Runs CPU-bound work in a pool of worker processes, so that it runs across cores and doesn't hold the GIL on
+    the web server's request threads. At most max_pending jobs may be queued or running at once; past that, calls
+    fail fast with PoolSaturated instead of queueing without bound. """
+
+    def __init__(self, processes=2, max_pending=16, timeout_seconds=10, initializer=None):
+        self.timeout_seconds = timeout_seconds
+        self.__slots = threading.BoundedSemaphore(max_pending)
+        self.__pool = multiprocessing.Pool(processes=processes, initializer=initializer)
+
+    def run(self, func, *args):
+        """ Runs func(*args) in a worker process and returns the result. func must be a module-level function. """
+        if not self.__slots.acquire(False):
+            logging.warning("Worker pool saturated - rejecting %s call" % func.__name__)
+            raise PoolSaturated()
+        try:
+            return self.__pool.apply_async(func, args).get(self.timeout_seconds)
+        except multiprocessing.TimeoutError:
+            logging.error("Worker pool %s call timed out after %d seconds" % (func.__name__, self.timeout_seconds))
+            raise PoolSaturated()
+        finally:
+            self.__slots.release()
+
+    def close(self):
+        self.__pool.terminate()
+        self.__pool.join()
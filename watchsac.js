@@ -70,7 +70,7 @@ function SearchTermsJSONConverter()
 
 function ApiClient(u, p)
 {
-    // This client provides four methods to interact with the API:
+    // This client provides these methods to interact with the API:
     //      saveNewAccount
     //      getAllAlerts
     //      saveAlert
@@ -196,6 +196,27 @@ function ApiClient(u, p)
         );
     };
 
+    // changes is an object like {"create": [alert, ...], "update": [alert, ...], "archive": [alert_id, ...]}
+    // (not used by the UI yet)
+    this.bulkUpdateAlerts = function(changes) {
+        $.ajax({
+            url: api_url + alerts_ep,
+            dataType: "json",
+            beforeSend: this.addBasicAuth,
+            method: "PATCH",
+            data: JSON.stringify(changes),
+            contentType: 'application/json'
+        }).done(
+            function() {
+                handleRefreshAlerts();
+            }
+        ).fail(
+            function(data) {
+                alert("Save failed.");
+            }
+        );
+    };
+
     this.checkSpelling = function(textbox_input) {
         var searchTermsConverter = new SearchTermsJSONConverter();
         $.ajax({
@@ -1,4 +1,5 @@
 import logging
+import time
 
 import cherrypy
 
@@ -8,6 +9,11 @@ logging.basicConfig(filename='web_service.log', level=logging.DEBUG)
 
 from utils import utils
 from utils import properties
+from utils.cache import VerifiedCredentialCache
+from utils.hashing import HashingPool
+from utils.worker_pool import PoolSaturated
+import engine_pool
+import metrics
 import spellchecking
 import forecasting
 import sms
@@ -49,6 +55,15 @@ Header: 			Http basic auth username and password
 Method: 			DELETE
 Returns:			204 No Content on success, 401 on unauthorized, 404 otherwise
 
+save, update and delete many alerts at once (all of the valid changes are applied in one transaction)
+URL:      			https://watchsac.com/alerts
+Header: 			Http basic auth username and password
+Method: 			PATCH
+Request body:	    {"create": [{"name": "n", "search_terms": ["a"]}], "update": [{"id": 5, "name": "n", "search_terms": ["b"]}], "archive": [6, 7]}
+Returns:			200 and a JSON object with a list of per-item results for each of those keys, like
+                    {"create": [{"status": 200}], "update": [{"id": 5, "status": 200}], "archive": [{"id": 6, "status": 400}, ...]}
+                    400 if the body is malformed, 401 if unauthorized, 500 (with per-item 500s) if the transaction failed
+
 spellcheck some search terms
 URL:      			https://watchsac.com/spellcheck
 Header: 			Http basic auth username and password
@@ -68,12 +83,21 @@ class App(object):
     pass
 
 
+def _run_pool_job(func, *args):
+    """ Runs a worker pool call, turning pool saturation into a 503 for the client. """
+    try:
+        return func(*args)
+    except PoolSaturated:
+        raise cherrypy.HTTPError(503, "Server busy - please try again shortly")
+
+
 @cherrypy.expose  # /accounts
 class AccountService(object):
     """ Simple API for creating a new User. """
 
-    def __init__(self, model):
+    def __init__(self, model, hashing_pool):
         self.model = model
+        self.hashing_pool = hashing_pool
         self.sms_client = sms.TwilioSMSClient()
 
     @staticmethod
@@ -102,12 +126,9 @@ class AccountService(object):
             return True
 
     def __is_unique_username_and_number_combo(self, username, phone_number):
-        current_users = self.model.load_users()
-        for user in current_users:
-            existing_username = user.user_name
-            existing_phone_number = user.phone_number
-            if username == existing_username and phone_number == existing_phone_number:
-                return False
+        existing_user = self.model.load_user_by_username(username)
+        if existing_user is not None and existing_user.phone_number == phone_number:
+            return False
         return True
 
     def __is_authorized(self, req_json):
@@ -149,14 +170,8 @@ class AccountService(object):
             cherrypy.response.status = 400  # collision in the DB - assume it was a dup record
 
     def __is_valid_conf_pair(self, pn, conf_key):
-        """ load conf keys from DB and make sure this pn-conf_key pair is in there """
-        for pair in self.model.load_activation_key_pairs():
-            phone_number = pair.phone_number
-            activation_key = pair.activation_key
-            logging.debug("%s - %s" % (phone_number, activation_key))
-            if str(pn) == str(phone_number) and str(activation_key) == str(conf_key):
-                return True
-        return False
+        """ make sure this pn-conf_key pair is in the DB and hasn't expired """
+        return self.model.is_valid_activation_key_pair(str(pn), str(conf_key))
 
     def __send_activation_text_msg(self, phone_number, activation_key):
         if properties.USE_SMS_ACCOUNT_SETUP_VALIDATION:
@@ -171,13 +186,15 @@ class AccountService(object):
     def __save_new_account(self, username, password, phone_number):
         """ Takes a sanitized username, password, and phone number, then saves a row for them in the users table.
         Returns a User object if successful - None otherwise. """
+        # hash first, so that we don't text out a key for an account we then fail to save because we're overloaded
+        encrypted_password = _run_pool_job(self.hashing_pool.encrypt, password)
         activation_key = utils.generate_new_activation_key()
         self.model.save_activation_key_pair(phone_number, activation_key)
         if not self.__send_activation_text_msg(phone_number, activation_key):
             logging.error("An error occurred trying to send activation text message")
             cherrypy.response.status = 400
         else:
-            return self.model.save_user(phone_number, username, utils.encrypt(password))
+            return self.model.save_user(phone_number, username, encrypted_password)
 
     @cherrypy.tools.accept(media='application/json')
     @cherrypy.tools.json_in()
@@ -207,9 +224,11 @@ class AccountService(object):
 class AlertService(object):
     """ API for CRUD operations on Alerts. """
 
-    def __init__(self, model):
+    def __init__(self, model, hashing_pool):
         self.model = model
-        self.token_mgr = session_token_manager.TokenManager()
+        self.hashing_pool = hashing_pool
+        self.token_mgr = session_token_manager.TokenManager(sweep_interval_seconds=60)
+        self.verified_credentials = VerifiedCredentialCache()
 
     def __check_token(self, cherrypy_request):
         # use token_mgr to see if they've got a good token
@@ -231,47 +250,41 @@ class AlertService(object):
         cherrypy_response.cookie["watchsac"] = token
         cherrypy_response.cookie["watchsac"]['max-age'] = 3600
 
+    def __is_password_ok(self, user, password_attempt):
+        # skip the (deliberately slow) hash check if we verified this same attempt against this same hash recently
+        if self.verified_credentials.is_verified(user.user_name, password_attempt, user.password):
+            logging.debug("Credentials for user %s found in verified credential cache" % user.user_name)
+            return True
+        if _run_pool_job(self.hashing_pool.verify, password_attempt, user.password):
+            self.verified_credentials.remember(user.user_name, password_attempt, user.password)
+            return True
+        return False
+
     def validate_password(self, realm, username, password_attempt):
         """
         Cherrypy calls into here automatically before entering the handlers (see config below).
         This is on the AlertService object so that we can get easy access to the model.
         """
+        with metrics.registry.timed("watchsac_auth_seconds"):
+            return self.__validate_password(username, password_attempt)
 
+    def __validate_password(self, username, password_attempt):
         logging.debug("Checking cookie token first...")
         token_user_name, token_pwd = self.__check_token(cherrypy.request)
         if token_user_name is not None:
             logging.debug("Cookie token worked, user is %s, skipping u-p check" % token_user_name)
             return True
-        logging.debug("About to validate u-p - fetching users...")
-        users = self.model.load_users()
-        logging.debug("Validating u-p: found %d users" % len(users))
-        logging.debug("User-submitted name is %s" % username)
-        for user in users:
-            logging.debug("Checking if user %s is %s" % (username, user.user_name))
-            if str(user.user_name) == str(username):
-                if utils.verify(password_attempt, user.password):
-                    logging.info("User %s verified" % username)
-                    self.__set_token(username, password_attempt, cherrypy.response)
-                    return True
+        logging.debug("About to validate u-p - looking up user %s..." % username)
+        user = self.model.load_user_by_username(username)
+        if user is not None and self.__is_password_ok(user, password_attempt):
+            logging.info("User %s verified" % username)
+            self.__set_token(username, password_attempt, cherrypy.response)
+            return True
         return False
 
     def __get_user_by_name(self, username):
         logging.debug("getting user by name %s..." % username)
-        users = self.model.load_users()
-        logging.debug("loaded %d users" % len(users))
-        for user in users:
-            logging.debug("user name is %s" % user.user_name)
-            if user.user_name == username:
-                return user
-
-    def __get_alerts_for_user(self, user_id):
-        logging.debug("getting alerts for user with id: %s" % user_id)
-        alerts = self.model.load_all_active_alerts_with_phone_numbers()
-        results = []
-        for alert in alerts:
-            if int(alert.user_id) == int(user_id):
-                results.append(alert)
-        return results
+        return self.model.load_user_by_username(username)
 
     def __get_user_name(self, cherrypy_request):
         u = None
@@ -293,13 +306,12 @@ class AlertService(object):
     @cherrypy.tools.json_out()
     def GET(self):
         user_id = self.__get_user_by_name(self.__get_user_name(cherrypy.request))._id
-        return [x.to_dict() for x in self.__get_alerts_for_user(user_id)]
+        return [x.to_dict() for x in self.model.load_active_alerts_for_user(user_id)]
 
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
     def POST(self):
         user = self.__get_user_by_name(self.__get_user_name(cherrypy.request))
-        alerts = self.__get_alerts_for_user(user._id)
         data = cherrypy.request.json
         try:
             new_alert = Alert.build_alert_from_json_and_user(data, user)
@@ -309,12 +321,12 @@ class AlertService(object):
         logging.debug("received new alert: %s" % str(new_alert.to_dict()))
         if new_alert.alert_id is not None:
             cherrypy.response.status = 400  # might get this back if they pass someone else's alert_id
-            for existing_alert in alerts:
-                logging.debug("Comparing to this existing alert: %s" % str(existing_alert.to_dict()))
-                if int(existing_alert.alert_id) == int(new_alert.alert_id):
-                    self.model.update_alert(new_alert)
-                    cherrypy.response.status = 200
-                    return {}
+            existing_alert = self.model.load_active_alert_for_user(user._id, int(new_alert.alert_id))
+            if existing_alert is not None:
+                logging.debug("Updating this existing alert: %s" % str(existing_alert.to_dict()))
+                self.model.update_alert(new_alert)
+                cherrypy.response.status = 200
+                return {}
         else:
             self.model.save_alert(new_alert)
 
@@ -322,23 +334,89 @@ class AlertService(object):
     def DELETE(self, id):
         alert_id = int(id)
         user = self.__get_user_by_name(self.__get_user_name(cherrypy.request))
-        alerts = self.__get_alerts_for_user(user._id)
         cherrypy.response.status = 400
-        for alert in alerts:
-            if int(alert.alert_id) == alert_id:
-                self.model.archive_alert(alert)
-                cherrypy.response.status = 200
-                return {}
+        alert = self.model.load_active_alert_for_user(user._id, alert_id)
+        if alert is not None:
+            self.model.archive_alert(alert)
+            cherrypy.response.status = 200
+            return {}
+
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def PATCH(self):
+        """ Bulk create/update/archive. Ownership is checked once against the user's alerts, invalid items get a 400
+        result, and all of the valid changes are applied together in a single transaction. """
+        user = self.__get_user_by_name(self.__get_user_name(cherrypy.request))
+        data = cherrypy.request.json
+        try:
+            creates = list(data.get("create", []))
+            updates = list(data.get("update", []))
+            archives = list(data.get("archive", []))
+        except Exception as e:
+            cherrypy.response.status = 400
+            return  # malformed request - return 400 immediately
+        owned_alerts = dict((int(a.alert_id), a) for a in self.model.load_active_alerts_for_user(user._id))
+        results = {"create": [], "update": [], "archive": []}
+        new_alerts, updated_alerts, archived_alerts = [], [], []
+
+        for item in creates:
+            try:
+                new_alert = Alert.build_alert_from_json_and_user(item, user)
+                new_alert.alert_id = None
+            except Exception as e:
+                results["create"].append({"status": 400})
+                continue
+            new_alerts.append(new_alert)
+            results["create"].append({"status": 200})
+
+        for item in updates:
+            try:
+                updated_alert = Alert.build_alert_from_json_and_user(item, user)
+                alert_id = int(updated_alert.alert_id)
+            except Exception as e:
+                results["update"].append({"id": item.get("id") if isinstance(item, dict) else None, "status": 400})
+                continue
+            if alert_id not in owned_alerts:
+                results["update"].append({"id": alert_id, "status": 400})
+                continue
+            updated_alert.alert_id = alert_id
+            updated_alerts.append(updated_alert)
+            results["update"].append({"id": alert_id, "status": 200})
+
+        for item in archives:
+            try:
+                alert_id = int(item)
+            except Exception as e:
+                results["archive"].append({"id": None, "status": 400})
+                continue
+            if alert_id not in owned_alerts:
+                results["archive"].append({"id": alert_id, "status": 400})
+                continue
+            archived_alerts.append(owned_alerts[alert_id])
+            results["archive"].append({"id": alert_id, "status": 200})
+
+        cherrypy.response.status = 200
+        if len(new_alerts) + len(updated_alerts) + len(archived_alerts) > 0:
+            if not self.model.apply_alert_changes(new_alerts, updated_alerts, archived_alerts):
+                cherrypy.response.status = 500
+                for item_results in results.values():
+                    for item_result in item_results:
+                        if item_result["status"] == 200:
+                            item_result["status"] = 500
+        return results
 
 
 @cherrypy.expose  # /spellcheck
 class SpellcheckingService(object):
 
-    def __init__(self):
-        # build the internal spellchecking service
-        # this automatically loads our bloom filter from the configured location on disk
-        # the service will also handle re-loading on an hourly basis
-        self.service = spellchecking.SpellcheckingService()
+    def __init__(self, engines=None):
+        # if we have an engine pool, its worker processes do the spellchecking - otherwise we do it right here
+        self.engines = engines
+        if engines is None:
+            # build the internal spellchecking service
+            # this automatically loads our bloom filter from the configured location on disk
+            # the service will also handle re-loading on an hourly basis
+            self.service = spellchecking.SpellcheckingService()
 
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
@@ -347,14 +425,13 @@ class SpellcheckingService(object):
         data = cherrypy.request.json
         try:
             search_terms_list = [x for x in data]
-            recommendations = []
             logging.info("Received spellchecking request for terms: %s" % str(search_terms_list))
-            for st in search_terms_list:
-                recommended_alt = self.service.try_to_correct(st)
-                if recommended_alt is None:
-                    recommended_alt = st  # same string as input, if we couldn't make an improvement
-                recommendations.append(recommended_alt)
-            return recommendations
+            with metrics.registry.timed("watchsac_engine_seconds", engine="spellcheck"):
+                if self.engines is not None:
+                    return _run_pool_job(self.engines.correct_all, search_terms_list)
+                return engine_pool.correct_all(self.service, search_terms_list)
+        except cherrypy.HTTPError:
+            raise
         except Exception as e:
             logging.exception(e)
             cherrypy.response.status = 400
@@ -364,8 +441,11 @@ class SpellcheckingService(object):
 @cherrypy.expose  # /forecast
 class ForecastingService(object):
 
-    def __init__(self):
-        self.service = forecasting.ForecastingService()
+    def __init__(self, engines=None):
+        # if we have an engine pool, its worker processes do the forecasting - otherwise we do it right here
+        self.engines = engines
+        if engines is None:
+            self.service = forecasting.ForecastingService()
 
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
@@ -374,27 +454,121 @@ class ForecastingService(object):
         data = cherrypy.request.json
         try:
             search_terms_list = [x for x in data]
-            counts = {}
-            logging.info("Received spellchecking request for terms: %s" % str(search_terms_list))
-            for st in search_terms_list:
-                counts[st] = self.service.get_count_for(st)
-            counts["(all of them combined)"] = self.service.get_count_for_all(search_terms_list)
-            return counts
+            logging.info("Received forecasting request for terms: %s" % str(search_terms_list))
+            with metrics.registry.timed("watchsac_engine_seconds", engine="forecast"):
+                if self.engines is not None:
+                    return _run_pool_job(self.engines.count_all, search_terms_list)
+                return engine_pool.count_all(self.service, search_terms_list)
+        except cherrypy.HTTPError:
+            raise
         except Exception as e:
             logging.exception(e)
             cherrypy.response.status = 400
             return  # malformed request - return 400
 
 
+@cherrypy.expose  # /metrics
+class MetricsService(object):
+    """ Exposes the metrics registry in the Prometheus text format - only to requests that came in on the metrics
+    listener's port, since the main one is public and unauthenticated scrapes would give away our traffic. """
+
+    def __init__(self, port):
+        self.port = port
+
+    def GET(self):
+        if cherrypy.request.local.port != self.port:
+            raise cherrypy.NotFound()
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4"
+        return metrics.registry.render()
+
+
+class MetricsTool(cherrypy.Tool):
+    """ Records a count, an error count (status >= 400), and a latency histogram per mounted service and method. """
+
+    def __init__(self):
+        cherrypy.Tool.__init__(self, "on_start_resource", self.start_timer, priority=10)
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        cherrypy.request.hooks.attach("on_end_request", self.record)
+
+    @staticmethod
+    def start_timer():
+        cherrypy.request.metrics_start_time = time.time()
+
+    @staticmethod
+    def record():
+        request = cherrypy.request
+        start = getattr(request, "metrics_start_time", None)
+        if start is None:
+            return
+        service = request.script_name or "/"
+        status = int(str(cherrypy.response.status).split()[0])
+        metrics.registry.increment("watchsac_http_requests_total", service=service, method=request.method)
+        if status >= 400:
+            metrics.registry.increment(
+                "watchsac_http_errors_total", service=service, method=request.method, status=status
+            )
+        metrics.registry.observe(
+            "watchsac_http_request_seconds", time.time() - start, service=service, method=request.method
+        )
+
+
+cherrypy.tools.metrics = MetricsTool()
+
+
+def _describe_metrics():
+    metrics.registry.describe("watchsac_http_requests_total", "Requests handled, by mounted service and method.")
+    metrics.registry.describe("watchsac_http_errors_total", "Responses with a status of 400 or more.")
+    metrics.registry.describe("watchsac_http_request_seconds", "Request latency, by mounted service and method.")
+    metrics.registry.describe("watchsac_auth_seconds", "Time spent validating credentials.")
+    metrics.registry.describe("watchsac_engine_seconds", "Time spent in the spellcheck and forecast engines.")
+
+
 def start_webapp(premade_db_conn_pool=None):
 
+    _describe_metrics()
+    # start the worker processes first - before the web server's threads, and before Model opens DB connections and
+    # starts its pool validator and replica lag threads - so that they fork from a quiet process and inherit none of it
+    hashing_pool = HashingPool(
+        processes=properties.HASHING_POOL_PROCESSES,
+        max_pending=properties.HASHING_POOL_MAX_PENDING
+    )
+    cherrypy.engine.subscribe('stop', hashing_pool.close)
+    engines = None
+    if properties.ENGINE_POOL_PROCESSES > 0:
+        engines = engine_pool.EnginePool(
+            processes=properties.ENGINE_POOL_PROCESSES,
+            max_pending=properties.ENGINE_POOL_MAX_PENDING
+        )
+        cherrypy.engine.subscribe('stop', engines.close)
+    # Model times its own calls, per DAO method, in model.query_stats - exported below
     model = Model(conn_pool_size=5, premade_db_conn_pool=premade_db_conn_pool)
 
-    account_service = AccountService(model)
-    alert_service = AlertService(model)
+    account_service = AccountService(model, hashing_pool)
+    alert_service = AlertService(model, hashing_pool)
     static_app_service = App()
-    spellchecking_service = SpellcheckingService()
-    forecasting_service = ForecastingService()
+    spellchecking_service = SpellcheckingService(engines)
+    forecasting_service = ForecastingService(engines)
+    metrics_service = MetricsService(properties.METRICS_PORT)
+    metrics.registry.add_gauge_collector(lambda: [
+        ("watchsac_session_tokens_" + k, {}, v) for k, v in alert_service.token_mgr.stats().items()
+    ])
+    # the DAO aggregates are running totals (counters), except for the slowest call so far (a gauge)
+    metrics.registry.add_counter_collector(lambda: [
+        ("watchsac_dao_" + k + "_total", {"method": method}, v)
+        for method, stats in model.query_stats.snapshot().items() for k, v in stats.items() if k != "max_seconds"
+    ])
+    metrics.registry.add_gauge_collector(lambda: [
+        ("watchsac_dao_max_seconds", {"method": method}, stats["max_seconds"])
+        for method, stats in model.query_stats.snapshot().items()
+    ])
+    if hasattr(model.conn_pool, "stats"):
+        metrics.registry.add_gauge_collector(lambda: [
+            ("watchsac_db_pool_" + k, {}, v) for k, v in model.conn_pool.stats().items()
+        ])
+
+    cherrypy.config.update({'tools.metrics.on': True})
 
     cherrypy.tree.mount(static_app_service, "/", {
         '/':
@@ -441,8 +615,20 @@ def start_webapp(premade_db_conn_pool=None):
                 'tools.json_in.force': False
             }
     })
+    cherrypy.tree.mount(metrics_service, "/metrics", {
+        '/':
+            {
+                'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+            }
+    })
     cherrypy.server.socket_host = '0.0.0.0'
     cherrypy.server.socket_port = 8080
+    cherrypy.server.thread_pool = properties.WEB_THREAD_POOL_SIZE
+    metrics_server = cherrypy._cpserver.Server()
+    metrics_server.socket_host = properties.METRICS_SOCKET_HOST
+    metrics_server.socket_port = properties.METRICS_PORT
+    metrics_server.thread_pool = 2
+    metrics_server.subscribe()
     cherrypy.engine.start()
 
 